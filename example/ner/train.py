@@ -76,17 +76,21 @@ GLOBAL_FEATURES = [
 ]
 
 
-class LowercaseDAWGGlobalFeature(features.DAWGGlobalFeature):
-    def __call__(self, doc):
-        token_strings = [tok.token.lower() for tok, feat in doc]
-        for start, end, matched_text in self.lm.find_ranges(token_strings):
-            self.process_range(doc, start, end, matched_text)
-
-
 def _gazetteer_feature(filename: str, name: str) -> features.DAWGGlobalFeature:
     file_path = GAZETTEER_DATA / filename
     return features.DAWGGlobalFeature(str(file_path), name)
-    # return LowercaseDAWGGlobalFeature(str(file_path), name)
+    # case-insensitive matching (the gazetteer must be built lowercased,
+    # e.g. with build_gazetteers.compile_gazetteers_contacts(lowercase=True)):
+    # return features.DAWGGlobalFeature(str(file_path), name,
+    #                                   normalize=features.lowercase)
+
+
+def _gazetteer(filename: str, name: str):
+    """ Return (lexicon, featname) for MultiLongestMatchGlobalFeature """
+    import dawg
+    lexicon = dawg.CompletionDAWG()
+    lexicon.load(str(GAZETTEER_DATA / filename))
+    return lexicon, name
 
 
 class ContactsModel:
@@ -97,13 +101,16 @@ class ContactsModel:
         )
 
     def get_crf_pipeline(self):
+        # gazetteers share one feature; DAWGs are searched in place
         GAZETTEER_FEATURES = [
-            features.LongestMatchGlobalFeature(load_countries(), 'COUNTRY'),
-            _gazetteer_feature('cities1000.dafsa', 'CITY-1000'),
-            _gazetteer_feature('cities5000.dafsa', 'CITY-5000'),
-            _gazetteer_feature('cities15000.dafsa', 'CITY-15000'),
-            _gazetteer_feature('adm1.dafsa', 'ADM1'),
-            # _gazetteer_feature('adm2.dafsa', 'ADM2'),
+            features.MultiLongestMatchGlobalFeature([
+                (load_countries(), 'COUNTRY'),
+                _gazetteer('cities1000.dafsa', 'CITY-1000'),
+                _gazetteer('cities5000.dafsa', 'CITY-5000'),
+                _gazetteer('cities15000.dafsa', 'CITY-15000'),
+                _gazetteer('adm1.dafsa', 'ADM1'),
+                # _gazetteer('adm2.dafsa', 'ADM2'),
+            ]),
         ]
         pipe = webstruct.create_crfsuite_pipeline(
             token_features=TOKEN_FEATURES,
@@ -4,7 +4,7 @@ from __future__ import absolute_import
 from .loaders import WebAnnotatorLoader, GateLoader, HtmlLoader, load_trees
 from .sequence_encoding import IobEncoder, InputTokenProcessor
 from .feature_extraction import HtmlFeatureExtractor
-from .html_tokenizer import HtmlTokenizer, HtmlToken
+from .html_tokenizer import HtmlTokenizer, HtmlToken, HtmlTokenBatch
 from .wapiti import WapitiCRF, create_wapiti_pipeline
 from .crfsuite import create_crfsuite_pipeline
 from .model import NER
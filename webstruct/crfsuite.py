@@ -8,9 +8,12 @@ CRFsuite_ backend for webstruct based on python-crfsuite_ and sklearn-crfsuite_.
 
 """
 from __future__ import absolute_import
+from sklearn.base import BaseEstimator, TransformerMixin
 from sklearn.pipeline import Pipeline
+from six.moves import range
 
 from webstruct import HtmlFeatureExtractor
+from webstruct.feature_encoding import EncodedDocument
 
 
 class CRFsuitePipeline(Pipeline):
@@ -22,33 +25,162 @@ class CRFsuitePipeline(Pipeline):
     In addition to that, this class adds support for X_dev/y_dev arguments
     for :meth:`fit` and :meth:`fit_transform` methods - they work as expected,
     being transformed using feature extractor.
+
+    If the feature extractor has a ``feature_encoder``,
+    an :class:`ItemSequenceAdapter` step is added between the feature
+    extractor and the CRF.
     """
     def __init__(self, fe, crf):
         self.fe = fe
         self.crf = crf
-        super(CRFsuitePipeline, self).__init__([
-            ('vec', self.fe),
-            ('clf', self.crf),
-        ])
+        steps = [('vec', self.fe)]
+        if getattr(fe, 'feature_encoder', None) is not None:
+            steps.append(('items', ItemSequenceAdapter()))
+        steps.append(('clf', self.crf))
+        super(CRFsuitePipeline, self).__init__(steps)
 
     def fit(self, X, y=None, **fit_params):
         X_dev = fit_params.pop('X_dev', None)
-        if X_dev is not None:
-            fit_params['clf__X_dev'] = self.fe.transform(X_dev)
-            fit_params['clf__y_dev'] = fit_params.pop('y_dev', None)
-        return super(CRFsuitePipeline, self).fit(X, y, **fit_params)
+        y_dev = fit_params.pop('y_dev', None)
+        if X_dev is None and y_dev is None:
+            return super(CRFsuitePipeline, self).fit(X, y, **fit_params)
+        self._fit_with_dev(X, y, X_dev, y_dev, fit_params)
+        return self
 
     def fit_transform(self, X, y=None, **fit_params):
         X_dev = fit_params.pop('X_dev', None)
+        y_dev = fit_params.pop('y_dev', None)
+        if X_dev is None and y_dev is None:
+            return super(CRFsuitePipeline, self).fit_transform(X, y, **fit_params)
+        return self._fit_with_dev(X, y, X_dev, y_dev, fit_params)
+
+    def _fit_with_dev(self, X, y, X_dev, y_dev, fit_params):
+        # development data is transformed after the feature extractor
+        # is fitted, so that it is pruned and encoded the same way
+        step_params = self._step_fit_params(fit_params)
+        Xt = X
+        for name, transformer in self.steps[:-1]:
+            Xt = transformer.fit_transform(Xt, y, **step_params[name])
         if X_dev is not None:
-            fit_params['clf__X_dev'] = self.fe.transform(X_dev)
-            fit_params['clf__y_dev'] = fit_params.pop('y_dev', None)
-        return super(CRFsuitePipeline, self).fit_transform(X, y, **fit_params)
+            X_dev = self._transform_dev(X_dev)
+        clf_name = self.steps[-1][0]
+        self.crf.fit(Xt, y, X_dev=X_dev, y_dev=y_dev, **step_params[clf_name])
+        return Xt
+
+    def _step_fit_params(self, fit_params):
+        """ Split ``step__param`` fit parameters by step, like Pipeline """
+        step_params = dict((name, {}) for name, step in self.steps)
+        for key, value in fit_params.items():
+            step, sep, param = key.partition('__')
+            if not sep or step not in step_params:
+                raise ValueError(
+                    "Unknown fit parameter %r; pass parameters to pipeline "
+                    "steps using stepname__parameter format" % key)
+            step_params[step][param] = value
+        return step_params
+
+    def skip_unused_features(self):
+        """
+        Make the feature extractor compute only features the trained CRF
+        uses: attributes with non-zero weights (L1 regularization
+        usually zeroes most of them). Feature functions which can't
+        produce such features are skipped, so prediction is faster,
+        and predictions don't change. Refitting the pipeline
+        removes the restriction.
+        See :meth:`.HtmlFeatureExtractor.set_used_features`.
+        """
+        self.fe.set_used_features(get_used_attributes(self.crf, self.fe))
+        return self
+
+    def _transform_dev(self, X_dev):
+        X_dev = self.fe.transform(X_dev)
+        if 'items' in self.named_steps:
+            X_dev = self.named_steps['items'].transform(X_dev)
+        return X_dev
+
+
+class ItemSequenceAdapter(BaseEstimator, TransformerMixin):
+    """
+    Transformer which allows to pass :class:`~.EncodedDocument` instances
+    (see :mod:`webstruct.feature_encoding`) to sklearn-crfsuite.
+    It returns a sequence which converts encoded documents to
+    python-crfsuite ``ItemSequence`` objects when they are accessed,
+    so only documents being processed are converted. Feature ids
+    are used as CRFsuite attribute names. Other documents
+    are returned unchanged.
+    """
+    def fit(self, X, y=None):
+        return self
+
+    def transform(self, X):
+        return _ItemSequences(X)
+
+
+class _ItemSequences(object):
+    """ A sequence of documents converted by :func:`to_item_sequence` """
+    def __init__(self, docs):
+        self.docs = docs
+
+    def __len__(self):
+        return len(self.docs)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return _ItemSequences(self.docs[index])
+        return to_item_sequence(self.docs[index])
+
+    def __iter__(self):
+        for doc in self.docs:
+            yield to_item_sequence(doc)
+
+
+def to_item_sequence(doc):
+    """
+    Convert :class:`~.EncodedDocument` to python-crfsuite ``ItemSequence``.
+    Values of features with the same id are summed.
+    Other documents are returned unchanged.
+    """
+    if not isinstance(doc, EncodedDocument):
+        return doc
+    import pycrfsuite
+
+    ids, values, offsets = doc.ids, doc.values, doc.offsets
+    items = []
+    for token_index in range(len(doc)):
+        item = {}
+        for i in range(offsets[token_index], offsets[token_index + 1]):
+            name = '%d' % ids[i]
+            item[name] = item.get(name, 0.0) + values[i]
+        items.append(item)
+    return pycrfsuite.ItemSequence(items)
+
+
+def get_used_attributes(crf, fe=None):
+    """
+    Return a set of names of attributes with non-zero weights in a trained
+    sklearn-crfsuite CRF. If the CRF was trained on documents encoded
+    by a :class:`~webstruct.feature_encoding.FeatureVocabulary`
+    (``fe.feature_encoder``), feature ids are converted back
+    to feature names.
+    """
+    used = set()
+    for (attr, label), weight in crf.state_features_.items():
+        if weight != 0:
+            used.add(attr)
+
+    encoder = getattr(fe, 'feature_encoder', None)
+    if encoder is None:
+        return used
+    feature_names = getattr(encoder, 'feature_names_', None)
+    if feature_names is None:
+        raise ValueError("can't get names of features encoded by %r" % encoder)
+    return {feature_names[int(attr)] for attr in used}
 
 
 def create_crfsuite_pipeline(token_features=None,
                              global_features=None,
                              min_df=1,
+                             feature_encoder=None,
                              **crf_kwargs):
     """
     Create :class:`CRFsuitePipeline` for HTML tagging using CRFsuite.
@@ -85,13 +217,17 @@ def create_crfsuite_pipeline(token_features=None,
         # do a prediction
         y_pred = model.predict(X_test)
 
+    Pass ``feature_encoder`` (e.g.
+    :class:`~webstruct.feature_encoding.FeatureVocabulary`) to keep
+    features integer-encoded instead of storing them as dicts.
     """
     from sklearn_crfsuite import CRF
 
     if token_features is None:
         token_features = []
 
-    fe = HtmlFeatureExtractor(token_features, global_features, min_df=min_df)
+    fe = HtmlFeatureExtractor(token_features, global_features, min_df=min_df,
+                              feature_encoder=feature_encoder)
     crf = CRF(**crf_kwargs)
 
     return CRFsuitePipeline(fe, crf)
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""
+:mod:`webstruct.feature_encoding` contains encoders which convert
+feature dicts to compact integer-encoded documents.
+
+Feature dicts take a lot of memory, and CRF backends convert them
+to their own formats anyway. Pass an encoder as ``feature_encoder``
+argument of :class:`~.HtmlFeatureExtractor` to get
+:class:`EncodedDocument` instances instead of lists of feature dicts::
+
+    >>> from webstruct import HtmlFeatureExtractor
+    >>> fe = HtmlFeatureExtractor(token_features, feature_encoder=FeatureVocabulary())  # doctest: +SKIP
+    >>> X = fe.fit_transform(X_tokens)  # doctest: +SKIP
+
+Features are encoded the same way as python-crfsuite encodes feature dicts:
+a feature with a string value becomes a ``"key:value"`` feature
+with weight 1.0; other values (bools, numbers) are used as weights
+of ``"key"`` features. Lists of strings become ``"key:item"`` features
+with weight 1.0, and dicts are expanded to ``"key:subkey"`` features.
+
+:class:`FeatureVocabulary` assigns ids to features seen during fitting
+and ignores unknown features. :class:`FeatureHasher` doesn't need fitting;
+it computes ids by hashing feature names.
+
+Use :class:`webstruct.crfsuite.ItemSequenceAdapter` or
+:class:`webstruct.wapiti.WapitiObservationEncoder` to pass encoded
+documents to CRF backends.
+"""
+from __future__ import absolute_import
+import zlib
+from array import array
+
+import six
+from six.moves import range
+from sklearn.base import BaseEstimator, TransformerMixin
+
+
+class EncodedDocument(object):
+    """
+    Integer-encoded features of a document. Features of all tokens
+    are stored in ``ids`` and ``values`` arrays; features of i-th token
+    are ``ids[offsets[i]:offsets[i+1]]`` (and the same slice
+    of ``values``)::
+
+        >>> doc = FeatureVocabulary().fit_transform([[{'a': 'x'}, {'a': 'y', 'b': 2}]])[0]
+        >>> len(doc)
+        2
+        >>> doc.token_features(1)
+        (array('i', [1, 2]), array('d', [1.0, 2.0]))
+    """
+    __slots__ = ['ids', 'values', 'offsets']
+
+    def __init__(self, ids, values, offsets):
+        self.ids = ids
+        self.values = values
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def token_features(self, index):
+        """ Return ``(ids, values)`` arrays for a token """
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return self.ids[start:end], self.values[start:end]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.token_features(index)
+
+    def __eq__(self, other):
+        if not isinstance(other, EncodedDocument):
+            return NotImplemented
+        return (self.ids == other.ids and self.values == other.values and
+                self.offsets == other.offsets)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __getstate__(self):
+        return self.ids, self.values, self.offsets
+
+    def __setstate__(self, state):
+        self.ids, self.values, self.offsets = state
+
+    def __repr__(self):
+        return "<EncodedDocument: %d tokens, %d features>" % (
+            len(self), len(self.ids))
+
+
+class FeatureVocabulary(BaseEstimator, TransformerMixin):
+    """
+    Encoder which assigns ids to features in order they are seen
+    during fitting. Unknown features are dropped by :meth:`transform`::
+
+        >>> vocab = FeatureVocabulary().fit([[{'token': 'foo', 'upper': False}]])
+        >>> vocab.feature_names_
+        ['token:foo', 'upper']
+        >>> doc = vocab.transform_single([{'token': 'bar', 'upper': True}])
+        >>> doc.token_features(0)
+        (array('i', [1]), array('d', [1.0]))
+    """
+    def fit(self, X, y=None):
+        """
+        X should be a list of lists of dicts with features.
+        It can be obtained, for example, using
+        :class:`~.HtmlFeatureExtractor`.
+        """
+        self.reset()
+        return self.partial_fit(X)
+
+    def partial_fit(self, X, y=None):
+        for feature_dicts in X:
+            for featdict in feature_dicts:
+                self.update(six.iteritems(featdict))
+        return self
+
+    def update(self, items):
+        """ Add ``(key, value)`` features to the vocabulary """
+        if getattr(self, 'vocabulary_', None) is None:
+            self.vocabulary_, self.feature_names_ = {}, []
+        vocabulary = self.vocabulary_
+        for key, value in items:
+            if isinstance(value, _NESTED_TYPES):
+                self.update(item if isinstance(item, tuple) else (item, weight)
+                            for item, weight in _expand(key, value))
+                continue
+            item = _vocabulary_key(key, value)
+            if item not in vocabulary:
+                vocabulary[item] = len(vocabulary)
+                self.feature_names_.append(_feature_name(item))
+
+    def transform_single(self, feature_dicts):
+        """
+        Transform a list of dicts ``feature_dicts``
+        to an :class:`EncodedDocument`.
+        """
+        if getattr(self, 'vocabulary_', None) is None:
+            raise ValueError("FeatureVocabulary is not fitted")
+        return _encode(feature_dicts, self.vocabulary_.get)
+
+    def transform(self, X):
+        return [self.transform_single(feature_dicts) for feature_dicts in X]
+
+    def reset(self):
+        """ Forget the vocabulary """
+        self.__dict__.pop('vocabulary_', None)
+        self.__dict__.pop('feature_names_', None)
+
+
+class FeatureHasher(BaseEstimator, TransformerMixin):
+    """
+    Encoder which computes feature ids as hashes (CRC32) of feature names
+    modulo ``n_features``. It doesn't need fitting and uses no memory
+    for a vocabulary, but different features may get the same id::
+
+        >>> hasher = FeatureHasher(n_features=100)
+        >>> hasher.transform_single([{'token': 'foo', 'upper': False}]).ids
+        array('i', [56, 24])
+    """
+    def __init__(self, n_features=2 ** 20):
+        self.n_features = n_features
+
+    def fit(self, X, y=None):
+        return self
+
+    def partial_fit(self, X, y=None):
+        return self
+
+    def transform_single(self, feature_dicts):
+        """
+        Transform a list of dicts ``feature_dicts``
+        to an :class:`EncodedDocument`.
+        """
+        return _encode(feature_dicts, self._feature_id)
+
+    def transform(self, X):
+        return [self.transform_single(feature_dicts) for feature_dicts in X]
+
+    def reset(self):
+        pass
+
+    def _feature_id(self, item):
+        name = _feature_name(item).encode('utf8')
+        return (zlib.crc32(name) & 0xffffffff) % self.n_features
+
+
+def _vocabulary_key(key, value):
+    # string features are identified by (key, value) pairs,
+    # other features only by keys (their values are weights)
+    if isinstance(value, six.string_types):
+        return key, value
+    return key
+
+
+_NESTED_TYPES = (dict, list, tuple, set, frozenset)
+
+
+def _expand(key, value):
+    """
+    Yield ``(item, weight)`` tuples for a feature with a list or dict
+    value, the same way python-crfsuite expands them::
+
+        >>> list(_expand('a', {'b': 2, 'c': 'x'}))
+        [('a:b', 2.0), (('a:c', 'x'), 1.0)]
+        >>> list(_expand('a', ['x', 'y']))
+        [(('a', 'x'), 1.0), (('a', 'y'), 1.0)]
+    """
+    if isinstance(value, dict):
+        for subkey, subvalue in six.iteritems(value):
+            subkey = u'%s:%s' % (key, subkey)
+            if isinstance(subvalue, six.string_types):
+                yield (subkey, subvalue), 1.0
+            elif isinstance(subvalue, _NESTED_TYPES):
+                for item in _expand(subkey, subvalue):
+                    yield item
+            else:
+                yield subkey, _weight(subkey, subvalue)
+    else:
+        for elem in value:
+            if not isinstance(elem, six.string_types):
+                raise ValueError("Feature %r: list items must be strings, "
+                                 "got %r" % (key, elem))
+            yield (key, elem), 1.0
+
+
+def _weight(key, value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise ValueError("Feature %r has unsupported value %r" % (key, value))
+
+
+def _feature_name(item):
+    if isinstance(item, tuple):
+        return u'%s:%s' % item
+    return item
+
+
+def _encode(feature_dicts, get_id):
+    ids = array('i')
+    values = array('d')
+    offsets = array('i', [0])
+    for featdict in feature_dicts:
+        for key, value in six.iteritems(featdict):
+            if isinstance(value, six.string_types):
+                feature_id = get_id((key, value))
+                value = 1.0
+            elif isinstance(value, _NESTED_TYPES):
+                for item, weight in _expand(key, value):
+                    feature_id = get_id(item)
+                    if feature_id is not None:
+                        ids.append(feature_id)
+                        values.append(weight)
+                continue
+            else:
+                feature_id = get_id(key)
+                if not isinstance(value, (bool, float) + six.integer_types):
+                    value = _weight(key, value)
+            if feature_id is not None:
+                ids.append(feature_id)
+                values.append(value)
+        offsets.append(len(ids))
+    return EncodedDocument(ids, values, offsets)
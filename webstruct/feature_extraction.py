@@ -35,12 +35,32 @@ Usually, the approach is the following:
 
 """
 from __future__ import absolute_import, print_function
-from itertools import chain
-from collections import Counter
-from six.moves import zip
+from itertools import chain, groupby
+from operator import itemgetter
+from timeit import default_timer
+from collections import Counter, OrderedDict, namedtuple
+import numbers
+import six
+from six.moves import zip, map
 
 from sklearn.base import BaseEstimator, TransformerMixin
-from webstruct.utils import merge_dicts
+from webstruct.html_tokenizer import HtmlTokenBatch
+from webstruct.feature_encoding import _NESTED_TYPES
+from webstruct.features.utils import (
+    get_fill,
+    get_feature_keys,
+    get_feature_scope,
+    TOKEN_SCOPE,
+    ELEMENT_SCOPE,
+    CONSTANT_SCOPE,
+)
+from webstruct.features.global_features import combine_patterns
+from webstruct.utils import (
+    merge_dicts,
+    effective_n_jobs,
+    map_parallel,
+    CountMinSketch,
+)
 
 
 class HtmlFeatureExtractor(BaseEstimator, TransformerMixin):
@@ -58,6 +78,7 @@ class HtmlFeatureExtractor(BaseEstimator, TransformerMixin):
     :meth:`fit` / :meth:`transform` / :meth:`fit_transform` methods accept
     lists of documents (lists of lists of tokens), and return lists
     of documents' feature dicts (lists of lists of feature dicts).
+    A document can also be passed as :class:`~.HtmlTokenBatch`.
 
     .. _scikit-learn: http://scikit-learn.org
 
@@ -74,6 +95,10 @@ class HtmlFeatureExtractor(BaseEstimator, TransformerMixin):
             >>> def current_token(html_token):
             ...     return {'tok': html_token.token}
 
+        Feature functions can also write features to a shared dict
+        instead of returning new dicts; this is faster.
+        See :mod:`webstruct.features.utils`.
+
         :mod:`webstruct.features` module provides some predefined feature
         functions, e.g. :func:`parent_tag <webstruct.features.block_features.parent_tag>`
         which returns token's parent tag.
@@ -110,57 +135,532 @@ class HtmlFeatureExtractor(BaseEstimator, TransformerMixin):
 
         They should change feature dicts ``feature_dict`` inplace.
 
+        A global feature may declare names of features it adds
+        (``feature_keys`` attribute) and names of features it reads
+        (``required_keys`` attribute); they allow to skip it when
+        its features are not used by a model (see
+        :meth:`set_used_features`).
+
+        Gazetteer features which normalize token texts
+        (``shares_normalized_tokens`` attribute is True) also accept
+        ``normalized`` keyword argument - a dict created for each document,
+        so that tokens are normalized once per document for all features
+        using the same normalization function.
+
     min_df : integer or Mapping, optional
         Feature values that have a document frequency strictly
         lower than the given threshold are removed.
         If ``min_df`` is integer, its value is used as threshold.
+        Document frequencies are counted by :meth:`fit`;
+        :meth:`transform` removes the same features.
 
         TODO: if ``min_df`` is a dictionary, it should map feature names
         to thresholds.
 
+    token_cache_size : integer, optional
+        Results of token feature functions which depend only on token text
+        (see :func:`~webstruct.features.utils.token_pure`) are cached
+        for up to ``token_cache_size`` distinct tokens; the cache is kept
+        between :meth:`transform` calls. Pass 0 to disable caching.
+        Use :meth:`token_cache_info` to check how well the cache works.
+
+    df_sketch_width : integer, optional
+        By default document frequencies for ``min_df`` pruning are counted
+        exactly, so :meth:`fit` needs memory proportional to the number
+        of distinct feature values. If ``df_sketch_width`` is set,
+        they are counted approximately using a
+        :class:`~webstruct.utils.CountMinSketch` of this width, which
+        uses a fixed amount of memory. Frequencies are never underestimated,
+        so some rare features may be kept, but no frequent features
+        are removed.
+
+    feature_encoder : encoder, optional
+        If set, :meth:`transform` and :meth:`fit_transform` return
+        documents encoded by this encoder instead of lists of feature dicts,
+        e.g. :class:`~.EncodedDocument` instances if
+        :class:`~webstruct.feature_encoding.FeatureVocabulary` or
+        :class:`~webstruct.feature_encoding.FeatureHasher` is used.
+        The encoder is fitted by :meth:`fit` on pruned features.
+
+    n_jobs : integer, optional
+        Number of worker processes used for feature extraction
+        (-1 means "use all CPUs"); default is 1.
+        Documents are converted to :class:`~.HtmlTokenBatch` and sent
+        to workers in chunks, so feature functions shouldn't use
+        more of ``html_token.elem`` API than :class:`~.DetachedElement`
+        provides. The extractor (with its global features, e.g. gazetteers)
+        is sent to each worker only once. Document frequencies for
+        ``min_df`` are counted in workers and merged.
+
+    profile : boolean, optional
+        If True, time spent in each token and global feature function,
+        number of calls and number of emitted features are recorded;
+        use :meth:`profile_report` to get them. Default is False;
+        the instrumented code path is only used when profiling is enabled.
+
     """
-    def __init__(self, token_features, global_features=None, min_df=1):
+    def __init__(self, token_features, global_features=None, min_df=1,
+                 token_cache_size=10000, df_sketch_width=None,
+                 feature_encoder=None, n_jobs=1, profile=False):
         self.token_features = token_features
         self.global_features = global_features or []
         self.min_df = min_df
+        self.token_cache_size = token_cache_size
+        self.df_sketch_width = df_sketch_width
+        self.feature_encoder = feature_encoder
+        self.n_jobs = n_jobs
+        self.profile = profile
+
+    def token_cache_info(self):
+        """
+        Return token cache statistics: a ``(hits, misses, maxsize, currsize)``
+        named tuple. Hits and misses are counted for each token
+        and each group of adjacent token-pure feature functions.
+        """
+        plan = getattr(self, '_plan', None)
+        if plan is None or plan.token_cache is None:
+            return TokenCacheInfo(0, 0, self.token_cache_size, 0)
+        return plan.token_cache.info()
+
+    def profile_report(self):
+        """
+        Return a :class:`ProfileReport` with statistics collected
+        since profiling was enabled, or None if ``profile`` is False.
+        """
+        profiler = self._get_profiler()
+        if profiler is None:
+            return None
+        return profiler.report()
+
+    def set_used_features(self, used_features):
+        """
+        Restrict feature extraction to features a trained model uses.
+        ``used_features`` is a collection of CRFsuite attribute names:
+        ``"key:value"`` for features with string values and ``"key"``
+        for other features; a ``"key"`` item keeps all values of the key.
+        Pass None to remove the restriction.
+
+        Token feature functions and global features which can't produce
+        a used feature (according to their ``feature_keys``) are skipped,
+        and unused features are removed from feature dicts, so
+        the model gets the same input as without the restriction.
+        :meth:`fit` and :meth:`fit_transform` remove the restriction.
+
+        Usually it is called by
+        :meth:`CRFsuitePipeline.skip_unused_features <webstruct.crfsuite.CRFsuitePipeline.skip_unused_features>`
+        or :func:`webstruct.wapiti.skip_unused_features`.
+        """
+        if used_features is None:
+            self.used_features_ = None
+            self._used_filter = None
+        else:
+            self.used_features_ = frozenset(used_features)
+            self._used_filter = _UsedFeatureFilter(self.used_features_)
 
     def fit(self, html_token_lists, y=None):
-        self.fit_transform(html_token_lists)
+        """
+        Count document frequencies of features for ``min_df`` pruning
+        and fit ``feature_encoder``. Documents are processed one chunk
+        at a time; their feature dicts are not kept, so
+        ``html_token_lists`` may be a generator (unless both
+        ``df_sketch_width`` and a feature encoder which needs fitting
+        are used - then documents are processed twice).
+        """
+        self.set_used_features(None)
+        self.kept_features_ = None
+        encoder = getattr(self, 'feature_encoder', None)
+        vocabulary = encoder if hasattr(encoder, 'update') else None
+        if encoder is not None:
+            encoder.reset()
+
+        low = self.min_df
+        if low is not None and low > 1:
+            df = self._new_df_counter()
+            for _, chunk_df in self._map_chunks(html_token_lists,
+                                                count_df=True, keep_X=False):
+                df.update(chunk_df)
+            self.kept_features_ = self._kept_features(df, low)
+            if vocabulary is not None and isinstance(df, Counter):
+                # df counter keeps features in order they are first seen,
+                # so ids are the same as ids assigned by fit_transform
+                vocabulary.update(k for k, v in df.items() if v >= low)
+                return self
+            del df
+
+        if vocabulary is not None:
+            for chunk_X, _ in self._map_chunks(html_token_lists, encode=False):
+                vocabulary.partial_fit(chunk_X)
         return self
 
     def fit_transform(self, html_token_lists, y=None, **fit_params):
-        X = [self.transform_single(html_tokens) for html_tokens in html_token_lists]
-        return self._pruned(X, low=self.min_df)
+        self.set_used_features(None)
+        self.kept_features_ = None
+        encoder = getattr(self, 'feature_encoder', None)
+        low = self.min_df
+        prune = low is not None and low > 1
+        if not prune and not hasattr(encoder, 'update'):
+            if encoder is not None:
+                encoder.reset()
+            return self.transform(html_token_lists)
+
+        X, df = [], self._new_df_counter() if prune else None
+        for chunk_X, chunk_df in self._map_chunks(html_token_lists,
+                                                  count_df=prune,
+                                                  encode=False):
+            X.extend(chunk_X)
+            if prune:
+                df.update(chunk_df)
+        if prune:
+            self.kept_features_ = kept = self._kept_features(df, low)
+            del df
+            for doc in X:
+                _prune_document(doc, kept)
+        if encoder is not None:
+            encoder.fit(X)
+            for index, doc in enumerate(X):
+                X[index] = encoder.transform_single(doc)
+        return X
 
     def transform(self, html_token_lists):
-        return [self.transform_single(html_tokens) for html_tokens in html_token_lists]
+        return list(self.iter_transform(html_token_lists))
+
+    def iter_transform(self, html_token_lists):
+        """
+        Return a generator of feature dict lists (or encoded documents
+        if ``feature_encoder`` is used), one for each document.
+        Features pruned by :meth:`fit` are removed. Unlike :meth:`transform`,
+        it doesn't keep all documents' features in memory.
+        """
+        for chunk_X, _ in self._map_chunks(html_token_lists):
+            for doc in chunk_X:
+                yield doc
 
     def transform_single(self, html_tokens):
-        feature_func = _CombinedFeatures(*self.token_features)
-        token_data = list(zip(html_tokens, map(feature_func, html_tokens)))
-
-        for feat in self.global_features:
-            feat(token_data)
-
-        return [featdict for tok, featdict in token_data]
-
-    def _pruned(self, X, low=None):
-        if low is None or low <= 1:
-            return X
-        cnt = self._document_frequency(X)
-        keep = {k for (k, v) in cnt.items() if v >= low}
-        del cnt
-        return [
-            [{k: v for k, v in fd.items() if (k, v) in keep} for fd in doc]
-            for doc in X
+        """
+        Return a list of feature dicts for a single document.
+        Features are not pruned or encoded, but features not used
+        by a model are removed (see :meth:`set_used_features`).
+        """
+        return self._transform_single(html_tokens, self._feature_plan())
+
+    def _feature_plan(self):
+        # the plan is reused while token features are the same,
+        # so that the token cache is kept between calls
+        cache_size = getattr(self, 'token_cache_size', 0)
+        profiler = self._get_profiler()
+        used_filter = getattr(self, '_used_filter', None)
+        token_features, global_features = self._active_features(used_filter)
+        plan = getattr(self, '_plan', None)
+        if plan is None or not plan.is_for(token_features, cache_size,
+                                           profiler):
+            plan = self._plan = _FeaturePlan(token_features, cache_size,
+                                             profiler)
+
+        # global features may change between calls; adjacent Pattern
+        # features are computed together unless they are profiled
+        if profiler is None:
+            global_features = combine_patterns(global_features)
+        plan.global_features = global_features
+        plan.used_filter = used_filter
+        return plan
+
+    def _active_features(self, used_filter):
+        """
+        Return ``(token_features, global_features)`` lists with feature
+        functions which may produce features kept by ``used_filter``.
+        Global features are checked in reverse order, because features
+        they read (``required_keys``) are needed as well; a global feature
+        which doesn't declare them may read any feature.
+        """
+        if used_filter is None:
+            return self.token_features, self.global_features
+
+        needed = set(used_filter.keys)
+        global_features = []
+        for feat in reversed(self.global_features):
+            keys = get_feature_keys(feat)
+            if needed is not None and keys is not None and needed.isdisjoint(keys):
+                continue
+            global_features.append(feat)
+            required = getattr(feat, 'required_keys', None)
+            if required is None:
+                needed = None
+            elif needed is not None:
+                needed.update(required)
+        global_features.reverse()
+
+        if needed is None:
+            return self.token_features, global_features
+        token_features = [
+            f for f in self.token_features
+            if get_feature_keys(f) is None or
+            not needed.isdisjoint(get_feature_keys(f))
         ]
+        return token_features, global_features
+
+    def _get_profiler(self):
+        if not getattr(self, 'profile', False):
+            return None
+        profiler = getattr(self, '_profiler', None)
+        if profiler is None:
+            profiler = self._profiler = _Profiler()
+        return profiler
+
+    def __getstate__(self):
+        state = super(HtmlFeatureExtractor, self).__getstate__()
+        state.pop('_plan', None)
+        state.pop('_profiler', None)
+        return state
+
+    def _map_chunks(self, html_token_lists, count_df=False, keep_X=True,
+                    encode=True):
+        """
+        Process documents in chunks (in worker processes if ``n_jobs``
+        is not 1) and return an iterator of ``(X, df)`` tuples for
+        the chunks, in order. ``X`` is a list of documents' feature dicts
+        or encoded documents if ``encode`` is True and ``feature_encoder``
+        is set (None if ``keep_X`` is False), ``df`` is a Counter with
+        document frequencies of ``(key, value)`` features in the chunk
+        (None if ``count_df`` is False).
+        """
+        worker = _ChunkTransformer(self, count_df, keep_X, encode)
+        n_jobs = effective_n_jobs(getattr(self, 'n_jobs', 1))
+        if n_jobs != 1:
+            html_token_lists = map(_picklable_document, html_token_lists)
+        chunks = _chunks(html_token_lists, self._parallel_chunksize)
+        profiler = self._get_profiler()
+        for X, df, profile in map_parallel(worker, chunks, n_jobs):
+            if profile is not None:
+                # workers return statistics collected for the chunk
+                profiler.merge(profile)
+            yield X, df
+
+    # number of documents in a chunk
+    _parallel_chunksize = 16
+
+    def _transform_single(self, html_tokens, plan):
+        if isinstance(html_tokens, HtmlTokenBatch):
+            if plan.profiler is None:
+                return self._transform_batch(html_tokens, plan)
+            html_tokens = html_tokens.html_tokens()
+        if plan.profiler is not None:
+            return self._profiled_transform_single(html_tokens, plan)
+        token_data = list(zip(html_tokens, plan.document_features(html_tokens)))
+        normalized = {}
+        for feat in plan.global_features:
+            _apply_global_feature(feat, token_data, normalized)
+
+        feature_dicts = [featdict for tok, featdict in token_data]
+        if plan.used_filter is not None:
+            plan.used_filter.filter_document(feature_dicts)
+        return feature_dicts
+
+    def _transform_batch(self, batch, plan):
+        html_tokens = batch.lazy_html_tokens()
+        feature_dicts = plan.batch_features(html_tokens)
+        if plan.global_features:
+            if html_tokens.n_created < len(html_tokens):
+                # creating all tokens at once is faster
+                html_tokens = batch.html_tokens()
+            token_data = list(zip(html_tokens, feature_dicts))
+            normalized = {}
+            for feat in plan.global_features:
+                _apply_global_feature(feat, token_data, normalized)
+        if plan.used_filter is not None:
+            plan.used_filter.filter_document(feature_dicts)
+        return feature_dicts
+
+    def _profiled_transform_single(self, html_tokens, plan):
+        profiler = plan.profiler
+        token_data = list(zip(html_tokens, plan.document_features(html_tokens)))
+        feature_dicts = [featdict for tok, featdict in token_data]
+
+        # global features are timed one by one, without combining Patterns
+        n_features = sum(len(featdict) for featdict in feature_dicts)
+        normalized = {}
+        for index, feat in enumerate(plan.global_features):
+            stats = profiler.get_stats(GLOBAL_FEATURE, index, feat)
+            start = default_timer()
+            _apply_global_feature(feat, token_data, normalized)
+            stats.time += default_timer() - start
+            stats.calls += 1
+            new_n_features = sum(len(featdict) for featdict in feature_dicts)
+            stats.emitted += new_n_features - n_features
+            n_features = new_n_features
+
+        profiler.documents += 1
+        profiler.tokens += len(feature_dicts)
+        profiler.features += n_features
+        if plan.used_filter is not None:
+            plan.used_filter.filter_document(feature_dicts)
+        return feature_dicts
+
+    def _new_df_counter(self):
+        width = getattr(self, 'df_sketch_width', None)
+        if width:
+            return CountMinSketch(width)
+        return _OrderedCounter()
+
+    def _kept_features(self, df, low):
+        if isinstance(df, CountMinSketch):
+            return _SketchFilter(df, low)
+        return frozenset(k for (k, v) in df.items() if v >= low)
+
+
+class _ChunkTransformer(object):
+    """
+    Picklable function which extracts features from a list of documents,
+    removes features not kept by the extractor's ``min_df`` pruning,
+    encodes them and optionally counts document frequencies of features.
+    """
+    def __init__(self, extractor, count_df=False, keep_X=True, encode=True):
+        self.extractor = extractor
+        self.count_df = count_df
+        self.keep_X = keep_X
+        self.encode = encode
+
+    def __call__(self, html_token_lists):
+        extractor = self.extractor
+        plan = extractor._feature_plan()
+        kept = getattr(extractor, 'kept_features_', None)
+        encoder = getattr(extractor, 'feature_encoder', None)
+        if not (self.encode and self.keep_X):
+            encoder = None
+        X = [] if self.keep_X else None
+        df = _OrderedCounter() if self.count_df else None
+        for html_tokens in html_token_lists:
+            doc = extractor._transform_single(html_tokens, plan)
+            if df is not None:
+                df.update(_document_features(doc))
+            if kept is not None:
+                _prune_document(doc, kept)
+            if encoder is not None:
+                doc = encoder.transform_single(doc)
+            if X is not None:
+                X.append(doc)
+        profiler = plan.profiler
+        return X, df, profiler.pop() if profiler is not None else None
+
+
+class _OrderedCounter(Counter, OrderedDict):
+    """ Counter which remembers the order keys are first seen in """
+
+
+def _document_features(doc):
+    """
+    Return a list of unique ``(key, value)`` features of a document,
+    in order they are first seen
+    """
+    return list(OrderedDict.fromkeys(chain.from_iterable(fd.items() for fd in doc)))
+
+
+def _prune_document(doc, kept):
+    """ Remove features which are not in ``kept`` from feature dicts """
+    dropped = {item for item in chain.from_iterable(fd.items() for fd in doc)
+               if item not in kept}
+    if not dropped:
+        return
+    for featdict in doc:
+        for key in [k for k, v in featdict.items() if (k, v) in dropped]:
+            del featdict[key]
+
+
+class _SketchFilter(object):
+    """
+    A set-like object which contains features with
+    approximate document frequency of at least ``low``.
+    """
+    def __init__(self, sketch, low):
+        self.sketch = sketch
+        self.low = low
+
+    def __contains__(self, item):
+        return self.sketch[item] >= self.low
+
+
+class _UsedFeatureFilter(object):
+    """
+    Removes features not used by a model from feature dicts::
+
+        >>> used_filter = _UsedFeatureFilter({'lower:foo', 'upper'})
+        >>> doc = [{'lower': 'foo', 'upper': False}, {'lower': 'bar', 'title': True}]
+        >>> used_filter.filter_document(doc)
+        >>> doc
+        [{'lower': 'foo', 'upper': False}, {}]
+
+    ``keys`` is a set of feature keys which may be used:
+    attribute names and their prefixes before each ``":"``.
+
+    Attribute names are built the same way python-crfsuite builds them:
+    ``key:value`` for string values, ``key`` for numbers and booleans,
+    ``key:item`` for list items and ``key:subkey`` (+ ``:value``)
+    for dict values. A list or a dict is kept if any of its
+    items is used; values of other types are always kept::
+
+        >>> used_filter = _UsedFeatureFilter({'a:x', 'b:c', 'n'})
+        >>> used_filter.keeps('a', ['y', 'x']), used_filter.keeps('a', ['y'])
+        (True, False)
+        >>> used_filter.keeps('b', {'c': 1.5}), used_filter.keeps('b', {'d': 1})
+        (True, False)
+        >>> used_filter.keeps('n', 2), used_filter.keeps('m', 2)
+        (True, False)
+        >>> used_filter.keeps('m', None)
+        True
+    """
+    def __init__(self, used_features):
+        self.used = frozenset(used_features)
+        self.keys = set()
+        for name in self.used:
+            self.keys.add(name)
+            index = name.find(':')
+            while index != -1:
+                self.keys.add(name[:index])
+                index = name.find(':', index + 1)
+
+    def keeps(self, key, value):
+        if key in self.used:
+            return True
+        if isinstance(value, six.string_types):
+            return key in self.keys and u'%s:%s' % (key, value) in self.used
+        if isinstance(value, _NESTED_TYPES):
+            return key in self.keys and self._keeps_nested(key, value)
+        # numbers are used as "key"; values of unknown types are kept
+        return not isinstance(value, numbers.Number)
+
+    def _keeps_nested(self, key, value):
+        if isinstance(value, dict):
+            return any(self.keeps(u'%s:%s' % (key, subkey), subvalue)
+                       for subkey, subvalue in six.iteritems(value))
+        return any(self.keeps(key, item) for item in value)
+
+    def filter_document(self, doc):
+        keeps = self.keeps
+        for featdict in doc:
+            for key in [k for k, v in featdict.items() if not keeps(k, v)]:
+                del featdict[key]
 
-    def _document_frequency(self, X):
-        cnt = Counter()
-        for doc in X:
-            seen_features = set(chain.from_iterable(fd.items() for fd in doc))
-            cnt.update(seen_features)
-        return cnt
+
+def _picklable_document(html_tokens):
+    if isinstance(html_tokens, HtmlTokenBatch):
+        return html_tokens
+    return HtmlTokenBatch.from_html_tokens(html_tokens)
+
+
+def _chunks(iterable, size):
+    """
+    Split an iterable into lists of ``size`` items::
+
+        >>> list(_chunks(range(5), 2))
+        [[0, 1], [2, 3], [4]]
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
 
 class _CombinedFeatures(object):
@@ -181,3 +681,412 @@ class _CombinedFeatures(object):
     def __call__(self, *args, **kwargs):
         features = [f(*args, **kwargs) for f in self.feature_funcs]
         return merge_dicts(*features)
+
+
+class _FeaturePlan(object):
+    """
+    Fused token feature function. It returns the same dicts as
+    :class:`_CombinedFeatures`, but features are written to a single
+    dict using ``fill`` methods of feature functions
+    (see :mod:`webstruct.features.utils`), so intermediate dicts
+    are not created::
+
+        >>> from webstruct import HtmlToken
+        >>> from webstruct.features import token_identity, token_lower
+        >>> def f(tok): return {'lower': '?', 'len': len(tok.token)}
+        >>> plan = _FeaturePlan([token_identity, f, token_lower])
+        >>> plan(HtmlToken(0, ['Foo'], None, False, 0, 3))
+        {'token': 'Foo', 'lower': 'foo', 'len': 3}
+
+    If ``token_cache_size`` is non-zero, results of each group of adjacent
+    token-pure feature functions are cached per token text.
+    Results of each group of adjacent element-scoped feature functions
+    are computed once per text block in a document
+    (use :meth:`document_features` to process a document), and results
+    of constant feature functions are computed only once.
+    """
+    def __init__(self, feature_funcs, token_cache_size=0, profiler=None):
+        self.feature_funcs = list(feature_funcs)
+        self.token_cache_size = token_cache_size
+        self.token_cache = _LRUCache(token_cache_size) if token_cache_size else None
+        self.profiler = profiler
+        self.global_features = []
+        self.used_filter = None
+        self.fills = []
+        self.element_runs = []
+        funcs = self.feature_funcs
+        if profiler is None:
+            all_fills = [get_fill(f) for f in funcs]
+        else:
+            # the instrumented code path is chosen once, when the plan is built
+            all_fills = [
+                _ProfiledFill(get_fill(f),
+                              profiler.get_stats(TOKEN_FEATURE, index, f))
+                for index, f in enumerate(funcs)
+            ]
+        scopes = [get_feature_scope(f) for f in funcs]
+        self.batch_fills = []
+        for scope, group in groupby(zip(scopes, all_fills, funcs), itemgetter(0)):
+            group = list(group)
+            fills = [fill for _, fill, _ in group]
+            if scope == TOKEN_SCOPE and self.token_cache is not None:
+                run_id = len(self.fills)
+                run = _CachedTokenRun(fills, self.token_cache, run_id)
+                self.fills.append(run)
+                self.batch_fills.append(run.fill_batch)
+            elif scope == ELEMENT_SCOPE:
+                run = _CachedElementRun(fills)
+                self.element_runs.append(run)
+                self.fills.append(run)
+                self.batch_fills.append(run.fill_batch)
+            elif scope == CONSTANT_SCOPE:
+                run = _ConstantRun(fills)
+                self.fills.append(run)
+                self.batch_fills.append(run.fill_batch)
+            else:
+                self.fills.extend(fills)
+                self.batch_fills.extend(_batch_fill(fill, func)
+                                        for _, fill, func in group)
+
+    def __call__(self, html_token):
+        features = {}
+        for fill in self.fills:
+            fill(html_token, features)
+        return features
+
+    def document_features(self, html_tokens):
+        """ Return a list of feature dicts for a document """
+        try:
+            return [self(html_token) for html_token in html_tokens]
+        finally:
+            for run in self.element_runs:
+                run.clear()
+
+    def batch_features(self, html_tokens):
+        """
+        Return a list of feature dicts for a document given as
+        :class:`~.LazyHtmlTokens`. Cached token-pure and element-scoped
+        feature functions read token texts and block ids from the batch
+        columns; :class:`~.HtmlToken` instances are only created
+        for tokens which other feature functions (or cache misses) need.
+        """
+        batch_fills = self.batch_fills
+        try:
+            res = []
+            for index in range(len(html_tokens)):
+                features = {}
+                for fill in batch_fills:
+                    fill(html_tokens, index, features)
+                res.append(features)
+            return res
+        finally:
+            for run in self.element_runs:
+                run.clear()
+
+    def is_for(self, feature_funcs, token_cache_size, profiler=None):
+        """
+        Return True if the plan is created for these feature functions,
+        cache size and profiler.
+        """
+        return (
+            token_cache_size == self.token_cache_size and
+            profiler is self.profiler and
+            len(feature_funcs) == len(self.feature_funcs) and
+            all(f1 is f2 for f1, f2 in zip(feature_funcs, self.feature_funcs))
+        )
+
+
+class _CachedTokenRun(object):
+    """
+    ``fill`` function for a group of token-pure feature functions;
+    their merged features are cached per token text.
+    """
+    def __init__(self, fills, cache, run_id):
+        self.fills = fills
+        self.cache = cache
+        self.run_id = run_id
+
+    def __call__(self, html_token, features):
+        key = (self.run_id, html_token.token)
+        run_features = self.cache.get(key)
+        if run_features is None:
+            run_features = {}
+            for fill in self.fills:
+                fill(html_token, run_features)
+            self.cache.set(key, run_features)
+        features.update(run_features)
+
+    def fill_batch(self, html_tokens, index, features):
+        key = (self.run_id, html_tokens.batch.tokens[index])
+        run_features = self.cache.get(key)
+        if run_features is None:
+            run_features = {}
+            html_token = html_tokens[index]
+            for fill in self.fills:
+                fill(html_token, run_features)
+            self.cache.set(key, run_features)
+        features.update(run_features)
+
+
+class _CachedElementRun(object):
+    """
+    ``fill`` function for a group of element-scoped feature functions;
+    their merged features are computed once per ``(elem, is_tail)``
+    until :meth:`clear` is called.
+    """
+    def __init__(self, fills):
+        self.fills = fills
+        self.memo = {}
+
+    def __call__(self, html_token, features):
+        key = html_token.elem, html_token.is_tail
+        run_features = self.memo.get(key)
+        if run_features is None:
+            run_features = self.memo[key] = {}
+            for fill in self.fills:
+                fill(html_token, run_features)
+        features.update(run_features)
+
+    def fill_batch(self, html_tokens, index, features):
+        # a text block is the text or the tail of a single element
+        key = html_tokens.batch.block_ids[index]
+        run_features = self.memo.get(key)
+        if run_features is None:
+            run_features = self.memo[key] = {}
+            html_token = html_tokens[index]
+            for fill in self.fills:
+                fill(html_token, run_features)
+        features.update(run_features)
+
+    def clear(self):
+        self.memo.clear()
+
+
+class _ConstantRun(object):
+    """
+    ``fill`` function for a group of constant feature functions;
+    their merged features are computed for the first token only.
+    """
+    def __init__(self, fills):
+        self.fills = fills
+        self.run_features = None
+
+    def __call__(self, html_token, features):
+        if self.run_features is None:
+            run_features = {}
+            for fill in self.fills:
+                fill(html_token, run_features)
+            self.run_features = run_features
+        features.update(self.run_features)
+
+    def fill_batch(self, html_tokens, index, features):
+        if self.run_features is None:
+            self(html_tokens[index], features)
+        else:
+            features.update(self.run_features)
+
+
+def _batch_fill(fill, feature_func):
+    """
+    Return a function which fills features of a token of
+    :class:`~.LazyHtmlTokens`: ``fill_batch`` method of the feature function
+    if it is available, or a function which calls ``fill`` with
+    :class:`~.HtmlToken`.
+    """
+    batch_fill = getattr(feature_func, 'fill_batch', None)
+    if batch_fill is not None:
+        def fill_batch(html_tokens, index, features):
+            batch_fill(html_tokens.batch, index, features)
+    else:
+        def fill_batch(html_tokens, index, features):
+            fill(html_tokens[index], features)
+    return fill_batch
+
+
+TokenCacheInfo = namedtuple('TokenCacheInfo', 'hits misses maxsize currsize')
+
+
+TOKEN_FEATURE = 'token'
+GLOBAL_FEATURE = 'global'
+
+
+FeatureStats = namedtuple('FeatureStats', 'kind name calls time emitted')
+
+
+class ProfileReport(namedtuple('ProfileReport',
+                               'feature_stats documents tokens features')):
+    """
+    Profiling results of :class:`HtmlFeatureExtractor`:
+
+    * ``feature_stats`` - a list of ``FeatureStats(kind, name, calls,
+      time, emitted)`` named tuples, one for each token feature function
+      (``kind == 'token'``) and each global feature (``kind == 'global'``)
+      in order they are applied. ``time`` is cumulative wall time
+      in seconds; ``emitted`` is the number of features the function
+      returned (for global features - the number of features added).
+      Token feature functions which depend only on token text are not called
+      for tokens found in the token cache.
+    * ``documents``, ``tokens`` - number of processed documents and tokens;
+    * ``features`` - total number of features in feature dicts
+      (before ``min_df`` pruning).
+    """
+
+    @property
+    def features_per_token(self):
+        """ Average number of features per token """
+        return self.features / float(self.tokens) if self.tokens else 0.0
+
+    def __str__(self):
+        lines = ["%-40s %10s %10s %12s" % ('feature', 'calls', 'time, s', 'emitted')]
+        for stats in self.feature_stats:
+            name = '%s: %s' % (stats.kind, stats.name)
+            lines.append("%-40s %10d %10.3f %12d" % (
+                name[:40], stats.calls, stats.time, stats.emitted))
+        lines.append("%d documents, %d tokens, %.1f features per token" % (
+            self.documents, self.tokens, self.features_per_token))
+        return "\n".join(lines)
+
+
+class _Profiler(object):
+    """ Statistics collected by a profiled :class:`_FeaturePlan` """
+    def __init__(self):
+        self.stats = OrderedDict()
+        self.documents = self.tokens = self.features = 0
+
+    def get_stats(self, kind, index, func):
+        key = kind, index, _describe_feature(func)
+        if key not in self.stats:
+            self.stats[key] = _FeatureStatsCounter()
+        return self.stats[key]
+
+    def pop(self):
+        """ Return collected statistics as a picklable dict and reset them """
+        state = {
+            'stats': [(key, (st.calls, st.time, st.emitted))
+                      for key, st in self.stats.items()],
+            'documents': self.documents,
+            'tokens': self.tokens,
+            'features': self.features,
+        }
+        for st in self.stats.values():
+            st.calls = st.emitted = 0
+            st.time = 0.0
+        self.documents = self.tokens = self.features = 0
+        return state
+
+    def merge(self, state):
+        """ Add statistics returned by :meth:`pop` """
+        for key, (calls, time, emitted) in state['stats']:
+            if key not in self.stats:
+                self.stats[key] = _FeatureStatsCounter()
+            st = self.stats[key]
+            st.calls += calls
+            st.time += time
+            st.emitted += emitted
+        self.documents += state['documents']
+        self.tokens += state['tokens']
+        self.features += state['features']
+
+    def report(self):
+        # token features first, then global features
+        keys = sorted(self.stats, key=lambda key: (key[0] != TOKEN_FEATURE, key[1]))
+        feature_stats = [
+            FeatureStats(kind, name, self.stats[kind, index, name].calls,
+                         self.stats[kind, index, name].time,
+                         self.stats[kind, index, name].emitted)
+            for kind, index, name in keys
+        ]
+        return ProfileReport(feature_stats, self.documents, self.tokens,
+                             self.features)
+
+
+class _FeatureStatsCounter(object):
+    __slots__ = ['calls', 'time', 'emitted']
+
+    def __init__(self):
+        self.calls = self.emitted = 0
+        self.time = 0.0
+
+
+class _ProfiledFill(object):
+    """ ``fill`` function which records time and emitted features """
+    def __init__(self, fill, stats):
+        self.fill = fill
+        self.stats = stats
+
+    def __call__(self, html_token, features):
+        emitted = {}
+        start = default_timer()
+        self.fill(html_token, emitted)
+        stats = self.stats
+        stats.time += default_timer() - start
+        stats.calls += 1
+        stats.emitted += len(emitted)
+        features.update(emitted)
+
+
+def _apply_global_feature(func, token_data, normalized):
+    """
+    Apply a global feature function to a document; ``normalized`` is
+    a dict with normalized tokens of this document shared by
+    gazetteer features.
+    """
+    if getattr(func, 'shares_normalized_tokens', False):
+        func(token_data, normalized=normalized)
+    else:
+        func(token_data)
+
+
+def _describe_feature(func):
+    name = getattr(func, '__name__', None)
+    if name is not None:
+        return name
+    cls_name = type(func).__name__
+    featname = getattr(func, 'featname', None)
+    if featname:
+        return '%s(%s)' % (cls_name, featname)
+    keys = getattr(func, 'feature_keys', None)
+    if keys:
+        return '%s(%s)' % (cls_name, ', '.join(keys))
+    return cls_name
+
+
+class _LRUCache(object):
+    """
+    A mapping with at most ``maxsize`` items; least recently used
+    items are removed first::
+
+        >>> cache = _LRUCache(2)
+        >>> cache.set('a', 1); cache.set('b', 2)
+        >>> cache.get('a'), cache.get('c')
+        (1, None)
+        >>> cache.set('c', 3)
+        >>> cache.get('b'), cache.get('c')
+        (None, 3)
+        >>> cache.info()
+        TokenCacheInfo(hits=2, misses=2, maxsize=2, currsize=2)
+
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.data[key] = value
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.data[key] = value
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def info(self):
+        return TokenCacheInfo(self.hits, self.misses, self.maxsize,
+                              len(self.data))
@@ -4,10 +4,16 @@ from __future__ import absolute_import
 from .block_features import *
 from .token_features import *
 from .data_features import *
+from .lexical_features import *
 from .global_features import (
     Pattern,
+    MultiPattern,
     LongestMatchGlobalFeature,
+    MultiLongestMatchGlobalFeature,
     DAWGGlobalFeature,
+    TokenNormalizer,
+    lowercase,
+    strip_accents_lowercase,
 )
 
 
@@ -26,16 +32,11 @@ EXAMPLE_TOKEN_FEATURES = [
 
     token_identity,
     token_lower,
-
-    token_shape,
-    token_endswith_colon,
-    token_endswith_dot,
-    token_has_copyright,
-    number_pattern,
     prefixes_and_suffixes,
 
-    looks_like_year,
-    looks_like_month,
-    looks_like_email,
-    looks_like_street_part,
+    # token_shape, token_endswith_colon, token_endswith_dot,
+    # token_has_copyright, number_pattern, looks_like_year,
+    # looks_like_month, looks_like_email and looks_like_street_part
+    # computed in a single pass
+    lexical_features,
 ]
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
+from .utils import token_feature, element_scoped, ELEMENT_SCOPE
 
 __all__ = ['parent_tag', 'InsideTag', 'borders', 'block_length']
 
@@ -24,27 +25,52 @@ def _inside_tag(elem, tagname):
     return any(e is not None for e in elem.iterancestors(tagname))
 
 
-def parent_tag(html_token):
-    return {'parent_tag': html_token.parent.tag}
+@element_scoped
+@token_feature('parent_tag')
+def parent_tag(html_token, features):
+    features['parent_tag'] = html_token.parent.tag
 
 
 class InsideTag(object):
+    feature_scope = ELEMENT_SCOPE
+
     def __init__(self, tagname):
         self.tagname = tagname
         self.key = 'inside_tag_' + tagname
+        self.feature_keys = (self.key,)
 
     def __call__(self, html_token):
-        return {self.key: _inside_tag(html_token.elem, self.tagname)}
+        features = {}
+        self.fill(html_token, features)
+        return features
+
+    def fill(self, html_token, features):
+        elem = html_token.elem
+        # detached elements provide precomputed ancestor tags
+        ancestor_tags = getattr(elem, 'ancestor_tags', None)
+        if ancestor_tags is not None:
+            features[self.key] = self.tagname in ancestor_tags
+        else:
+            features[self.key] = _inside_tag(elem, self.tagname)
+
+
+@token_feature('border_at_left', 'border_at_right')
+def borders(html_token, features):
+    features['border_at_left'] = html_token.index == 0
+    features['border_at_right'] = html_token.index == len(html_token.tokens)-1
+
 
+def _borders_batch(batch, index, features):
+    block_id = batch.block_ids[index]
+    features['border_at_left'] = index == batch.block_offsets[block_id]
+    features['border_at_right'] = index == batch.block_offsets[block_id + 1] - 1
 
-def borders(html_token):
-    return {
-        'border_at_left': html_token.index == 0,
-        'border_at_right': html_token.index == len(html_token.tokens)-1,
-    }
+borders.fill_batch = _borders_batch
 
 
-def block_length(html_token):
+@element_scoped
+@token_feature('block_length')
+def block_length(html_token, features):
     block_len = len(html_token.tokens)
     if block_len == 1:
         bl = '1'
@@ -54,4 +80,4 @@ def block_length(html_token):
         bl = 'medium'
     else:
         bl = 'large'
-    return {'block_length': bl}
+    features['block_length'] = bl
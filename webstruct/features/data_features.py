@@ -2,6 +2,7 @@
 from __future__ import absolute_import
 import re
 from webstruct.utils import flatten
+from .utils import token_feature, token_pure
 from .datetime_format import WEEKDAYS, MONTHS
 
 __all__ = ['looks_like_year', 'looks_like_month', 'looks_like_time', 'looks_like_weekday',
@@ -51,51 +52,51 @@ TIME_RE = re.compile('\d{1,2}[\.:]\d{2}')
 RANGES = set('''t/m - van tot from to'''.lower().split())
 
 
-def looks_like_email(html_token):
-    return {
-        'looks_like_email': EMAIL_RE.search(html_token.token) is not None,
-    }
+@token_pure
+@token_feature('looks_like_email')
+def looks_like_email(html_token, features):
+    features['looks_like_email'] = EMAIL_RE.search(html_token.token) is not None
 
 
-def looks_like_street_part(html_token):
+@token_pure
+@token_feature('common_street_part', 'common_address_part', 'direction')
+def looks_like_street_part(html_token, features):
     token = html_token.token.lower()
-    return {
-        'common_street_part': token in STREET_PART_TOKENS,
-        'common_address_part': token in COMMON_ADDRESS_PARTS,
-        'direction': token in DIRECTIONS,
-    }
+    features['common_street_part'] = token in STREET_PART_TOKENS
+    features['common_address_part'] = token in COMMON_ADDRESS_PARTS
+    features['direction'] = token in DIRECTIONS
 
 
-def looks_like_year(html_token):
+@token_pure
+@token_feature('looks_like_year')
+def looks_like_year(html_token, features):
     token = html_token.token
-    return {
-        'looks_like_year': token.isdigit() and len(token) == 4 and token[:2] in ['19', '20'],
-    }
+    features['looks_like_year'] = token.isdigit() and len(token) == 4 and token[:2] in ['19', '20']
 
 
-def looks_like_month(html_token):
+@token_pure
+@token_feature('looks_like_month')
+def looks_like_month(html_token, features):
     token = html_token.token
-    return {
-        'looks_like_month': MONTHS_RE.match(token) is not None
-    }
+    features['looks_like_month'] = MONTHS_RE.match(token) is not None
 
 
-def looks_like_time(html_token):
+@token_pure
+@token_feature('looks_like_time')
+def looks_like_time(html_token, features):
     token = html_token.token
-    return {
-        'looks_like_time': TIME_RE.match(token) is not None
-    }
+    features['looks_like_time'] = TIME_RE.match(token) is not None
 
 
-def looks_like_weekday(html_token):
+@token_pure
+@token_feature('looks_like_weekday')
+def looks_like_weekday(html_token, features):
     token = html_token.token
-    return {
-        'looks_like_weekday': WEEKDAYS_RE.match(token) is not None
-    }
+    features['looks_like_weekday'] = WEEKDAYS_RE.match(token) is not None
 
 
-def looks_like_range(html_token):
+@token_pure
+@token_feature('looks_like_range')
+def looks_like_range(html_token, features):
     token = html_token.token.lower()
-    return {
-        'looks_like_range': token in RANGES
-    }
+    features['looks_like_range'] = token in RANGES
@@ -1,11 +1,113 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
+import abc
+import unicodedata
 
-from webstruct.utils import LongestMatch
+import six
+
+from webstruct.utils import LongestMatch, MultiLongestMatch
+
+
+def lowercase(text):
+    """ Token normalization function which lowercases text """
+    return text.lower()
+
+
+def strip_accents_lowercase(text):
+    """
+    Token normalization function which lowercases text
+    and removes diacritics::
+
+        >>> print(strip_accents_lowercase(u'Köln'))
+        koln
+    """
+    text = unicodedata.normalize('NFKD', text.lower())
+    return u''.join(ch for ch in text if not unicodedata.combining(ch))
+
+
+class TokenNormalizer(object):
+    """
+    Wrapper for a token normalization function (e.g. :func:`lowercase`)
+    used by gazetteer features; normalized token strings are memoized
+    (up to ``cache_size`` of them)::
+
+        >>> normalize = TokenNormalizer(lowercase)
+        >>> print(normalize(u'Paris'))
+        paris
+    """
+    def __init__(self, func, cache_size=100000):
+        self.func = func
+        self.cache_size = cache_size
+        self._cache = {}
+
+    def __call__(self, text):
+        cache = self._cache
+        try:
+            return cache[text]
+        except KeyError:
+            if len(cache) >= self.cache_size:
+                cache.clear()
+            res = cache[text] = self.func(text)
+            return res
+
+    def __getstate__(self):
+        return {'func': self.func, 'cache_size': self.cache_size}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __repr__(self):
+        return "TokenNormalizer(%r)" % self.func
+
+
+def _get_normalizer(normalize):
+    if normalize is None or isinstance(normalize, TokenNormalizer):
+        return normalize
+    return TokenNormalizer(normalize)
+
+
+def normalized_tokens(doc, normalize, cache=None):
+    """
+    Return a list of token strings of a document ``doc`` (a list of
+    ``(html_token, features)`` tuples) normalized using ``normalize``
+    function (None means no normalization).
+
+    ``cache`` is a dict with normalized tokens of the same document:
+    :class:`~.HtmlFeatureExtractor` creates it for each document
+    and passes it to gazetteer features, so a document is normalized
+    once for all gazetteer features using the same function.
+    """
+    key = getattr(normalize, 'func', normalize)
+    if cache is not None and key in cache:
+        return cache[key]
+    if normalize is None:
+        tokens = [html_token.token for html_token, feat in doc]
+    else:
+        tokens = [normalize(html_token.token) for html_token, feat in doc]
+    if cache is not None:
+        cache[key] = tokens
+    return tokens
+
+
+_IN_MEMORY_LEXICONS = (dict, set, frozenset, list, tuple)
+
+
+def _normalize_lexicon(lookup_data, normalize):
+    """
+    Return an in-memory lexicon (a set, list, tuple or dict) with
+    strings normalized using ``normalize``; other lexicons (DAWGs,
+    marisa tries) are returned as-is.
+    """
+    if normalize is None or not isinstance(lookup_data, _IN_MEMORY_LEXICONS):
+        return lookup_data
+    if isinstance(lookup_data, dict):
+        return dict((normalize.func(key), value)
+                    for key, value in six.iteritems(lookup_data))
+    return set(normalize.func(key) for key in lookup_data)
 
 
 class LongestMatchGlobalFeature(object):
-    def __init__(self, lookup_data, featname):
+    def __init__(self, lookup_data, featname, normalize=None):
         """
         Create a global feature function that adds 3 types of features:
 
@@ -16,17 +118,44 @@ class LongestMatchGlobalFeature(object):
         3) featname - if current token belongs to an entity from the
            ``lookup_data``.
 
+        ``normalize`` is a function (e.g. :func:`lowercase` or
+        :func:`strip_accents_lowercase`) or a :class:`TokenNormalizer`
+        which is applied to document tokens before matching.
+        In-memory ``lookup_data`` (a set, list, tuple or dict) is
+        normalized with the same function once, when the feature is created.
+        DAWGs and marisa tries are used as-is, so their strings must be
+        normalized in advance (e.g. build a gazetteer file with
+        ``--lower`` or ``--strip-accents`` option of
+        :mod:`webstruct.gazetteers.geonames`).
         """
+        self.normalize = _get_normalizer(normalize)
         if hasattr(lookup_data, 'find_ranges'):
             self.lm = lookup_data
         else:
-            self.lm = LongestMatch(lookup_data)
+            self.lm = LongestMatch(_normalize_lexicon(lookup_data, self.normalize))
         self.b_featname = 'B-' + featname
         self.i_featname = 'I-' + featname
         self.featname = featname
 
-    def __call__(self, doc):
-        token_strings = [tok.token for tok, feat in doc]
+    @property
+    def feature_keys(self):
+        """ Names of features this global feature may add """
+        return self.b_featname, self.i_featname, self.featname
+
+    # only token texts are used
+    required_keys = ()
+
+    # accepts ``normalized`` argument (see :func:`normalized_tokens`)
+    shares_normalized_tokens = True
+
+    def __call__(self, doc, normalized=None):
+        """
+        Add features to ``doc``. ``normalized`` is a cache dict
+        for :func:`normalized_tokens`.
+        """
+        # features pickled by older versions don't have ``normalize``
+        normalize = getattr(self, 'normalize', None)
+        token_strings = normalized_tokens(doc, normalize, normalized)
         for start, end, matched_text in self.lm.find_ranges(token_strings):
             self.process_range(doc, start, end, matched_text)
 
@@ -39,23 +168,135 @@ class LongestMatchGlobalFeature(object):
             doc[idx][1][self.featname] = True
 
 
-class DAWGGlobalFeature(LongestMatchGlobalFeature):
+class MultiLongestMatchGlobalFeature(object):
+    def __init__(self, lexicons, normalize=None):
+        """
+        Create a global feature function which matches several lexicons
+        in a single pass over a document. ``lexicons`` is a list of
+        ``(lookup_data, featname)`` tuples; features are the same as
+        features of :class:`LongestMatchGlobalFeature` created for each
+        of them, but in-memory lexicons (sets, lists, dicts) are matched
+        in a single pass; DAWGs and marisa tries are matched one by one
+        without copying them to memory
+        (see :class:`~webstruct.utils.MultiLongestMatch`).
+        ``normalize`` is applied to document tokens and in-memory
+        lexicons, like in :class:`LongestMatchGlobalFeature`.
+        """
+        self.normalize = _get_normalizer(normalize)
+        self.lexicons = [
+            (_normalize_lexicon(data, self.normalize), featname)
+            for data, featname in lexicons
+        ]
+        self.lm = MultiLongestMatch([data for data, featname in self.lexicons])
+        self.featnames = [
+            ('B-' + featname, 'I-' + featname, featname)
+            for data, featname in self.lexicons
+        ]
+
+    @property
+    def feature_keys(self):
+        return tuple(key for names in self.featnames for key in names)
+
+    required_keys = ()
+    shares_normalized_tokens = True
+
+    def __call__(self, doc, normalized=None):
+        token_strings = normalized_tokens(doc, self.normalize, normalized)
+        all_ranges = self.lm.find_ranges(token_strings)
+        for (b_featname, i_featname, featname), ranges in zip(self.featnames, all_ranges):
+            for start, end, matched_text in ranges:
+                doc[start][1][b_featname] = True
+                doc[start][1][featname] = True
+
+                for idx in range(start+1, end):
+                    doc[idx][1][i_featname] = True
+                    doc[idx][1][featname] = True
+
+
+@six.add_metaclass(abc.ABCMeta)
+class _FileLongestMatchGlobalFeature(LongestMatchGlobalFeature):
+    """
+    Base class for global features which match a lexicon loaded
+    from a file. They are pickled by file reference: the lexicon
+    is loaded from ``filename`` again when unpickled (e.g. in joblib or
+    multiprocessing workers), and the matcher state computed from its keys
+    is pickled, so that it doesn't have to be recomputed.
+    Subclasses must implement :meth:`load_data`.
+
+    The matcher scans all lexicon keys on the first lookup (see
+    :class:`~webstruct.utils.BestMatch`), not when the feature is created
+    or unpickled; if it was done before pickling, its results are pickled.
+    """
+    # defaults for features pickled by older versions
+    format = None
+    mmap = False
+
+    def __init__(self, filename, featname, format=None, mmap=False,
+                 normalize=None):
+        self.filename = filename
+        self.format = format
+        self.mmap = mmap
+        self.data = self.load_data()
+        super(_FileLongestMatchGlobalFeature, self).__init__(
+            self.data, featname, normalize)
+
+    @abc.abstractmethod
+    def load_data(self):
+        """
+        Load the lexicon from ``self.filename`` (using ``self.format``
+        and ``self.mmap`` options) and return it.
+        """
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['data']
+        lm_state = self.lm.__getstate__()
+        del lm_state['known']
+        state['lm'] = lm_state
+        return state
+
+    def __setstate__(self, state):
+        state = dict(state)
+        lm_state = state.pop('lm')
+        self.__dict__.update(state)
+        if isinstance(lm_state, LongestMatch):
+            # pickled by an older version, together with the lexicon
+            self.lm = lm_state
+            return
+        self.data = self.load_data()
+        lm_state['known'] = self.data
+        self.lm = LongestMatch.__new__(LongestMatch)
+        self.lm.__setstate__(lm_state)
+
+
+class DAWGGlobalFeature(_FileLongestMatchGlobalFeature):
     """
     Global feature that matches longest entities from a lexicon
     stored either in a ``dawg.CompletionDAWG`` (if ``format`` is None)
     or in a ``dawg.RecordDAWG`` (if ``format`` is not None).
+
+    DAWGs can't be memory-mapped, so ``mmap=True`` raises ValueError;
+    the file is read to memory in each process. Like
+    :class:`~webstruct.gazetteers.features.MarisaGeonamesGlobalFeature`,
+    the feature is pickled by file reference.
     """
-    def __init__(self, filename, featname, format=None):
+    def __init__(self, filename, featname, format=None, normalize=None,
+                 mmap=False):
+        if mmap:
+            raise ValueError("DAWG files can't be memory-mapped; "
+                             "use MarisaGeonamesGlobalFeature with mmap=True")
+        super(DAWGGlobalFeature, self).__init__(
+            filename, featname, format, normalize=normalize)
+
+    def load_data(self):
         import dawg
 
-        if format is None:
-            self.data = dawg.CompletionDAWG()
+        if self.format is None:
+            data = dawg.CompletionDAWG()
         else:
-            self.data = dawg.RecordDAWG(format)
-        self.data.load(filename)
-
-        self.filename = filename
-        super(DAWGGlobalFeature, self).__init__(self.data, featname)
+            data = dawg.RecordDAWG(self.format)
+        data.load(self.filename)
+        return data
 
 
 class Pattern(object):
@@ -70,26 +311,192 @@ class Pattern(object):
         # TODO: add an option to use index values on HTML element level
 
     def __call__(self, doc):
-        _add_pattern_features(
-            feature_dicts = [feat for html_token, feat in doc],
-            pattern = self.lookups,
-            out_value = self.out_value,
-            missing_value = self.missing_value,
-            separator = self.separator
+        MultiPattern(self)(doc)
+
+    @property
+    def featname(self):
+        """ Name of the feature this pattern adds """
+        return self.separator.join(
+            _window_key(key, offset) for offset, key in self.lookups
         )
 
+    @property
+    def feature_keys(self):
+        return self.featname,
+
+    @property
+    def required_keys(self):
+        """ Names of local features this pattern combines """
+        return tuple(_lookup_keys(self))
+
+
+class MultiPattern(object):
+    """
+    Global feature which applies several :class:`Pattern` features
+    and produces the same result as applying them one by one::
+
+        >>> from webstruct import HtmlToken
+        >>> doc = [(HtmlToken(i, [], None, False, 0, 0), {'lower': lower})
+        ...        for i, lower in enumerate(['hello', 'world'])]
+        >>> MultiPattern(Pattern((-1, 'lower')), Pattern((1, 'lower')))(doc)
+        >>> sorted(doc[1][1].items())
+        [('lower', 'world'), ('lower[-1]', 'hello')]
+
+    Key names are computed once per document, each local feature
+    is gathered into a column once for all patterns, and window features
+    are filled using these columns. :class:`~.HtmlFeatureExtractor`
+    combines adjacent :class:`Pattern` global features automatically.
+    """
+    def __init__(self, *patterns):
+        self.patterns = list(patterns)
+
+    @property
+    def feature_keys(self):
+        return tuple(pattern.featname for pattern in self.patterns)
+
+    @property
+    def required_keys(self):
+        return tuple(set().union(*map(_lookup_keys, self.patterns)))
+
+    def __call__(self, doc):
+        feature_dicts = [feat for html_token, feat in doc]
+        for fused, patterns in _pattern_groups(self.patterns):
+            if fused:
+                _add_multi_pattern_features(feature_dicts, patterns)
+            else:
+                for pattern in patterns:
+                    _add_pattern_features(feature_dicts, *_pattern_args(pattern))
+
+
+def combine_patterns(global_features):
+    """
+    Return a list of global features where adjacent :class:`Pattern`
+    features are replaced with :class:`MultiPattern` features.
+    """
+    res = []
+    for feature in global_features:
+        if type(feature) is Pattern:
+            if res and isinstance(res[-1], list):
+                res[-1].append(feature)
+                continue
+            feature = [feature]
+        res.append(feature)
+    return [MultiPattern(*f) if isinstance(f, list) else f for f in res]
+
+
+def _window_key(key, offset):
+    if offset == 0:
+        return key
+    elif offset < 0:
+        return '%s[%s]' % (key, offset)
+    else:
+        return '%s[+%s]' % (key, offset)
+
+
+def _lookup_keys(pattern):
+    return {key for offset, key in pattern.lookups}
+
+
+def _pattern_args(pattern):
+    return (pattern.lookups, pattern.out_value, pattern.missing_value,
+            pattern.separator)
+
+
+def _pattern_groups(patterns):
+    """
+    Split patterns into ``(fused, patterns)`` groups. Patterns of a fused
+    group can be computed from the same feature values: a pattern
+    starts a new group if it reads a feature written by a pattern of
+    the current group. A pattern which reads its own output feature
+    is applied separately (``fused`` is False).
+    """
+    groups = []
+    written = None  # features written by the current fused group
+    for pattern in patterns:
+        keys = _lookup_keys(pattern)
+        featname = pattern.featname
+        if featname in keys:
+            groups.append((False, [pattern]))
+            written = None
+            continue
+        if written is None or keys & written:
+            groups.append((True, []))
+            written = set()
+        groups[-1][1].append(pattern)
+        written.add(featname)
+    return groups
+
+
+def _add_multi_pattern_features(feature_dicts, patterns):
+    size = len(feature_dicts)
+    raw_columns = {}
+    columns = {}
+    for pattern in patterns:
+        out_value = pattern.out_value
+        missing_value = pattern.missing_value
+        out_norm = _norm_value(out_value)
+        out_is_out = out_value == out_value
+
+        windows = []
+        for offset, key in pattern.lookups:
+            column_key = key, missing_value, out_value
+            if column_key not in columns:
+                raw_key = key, missing_value
+                if raw_key not in raw_columns:
+                    raw_columns[raw_key] = [fd.get(key, missing_value)
+                                            for fd in feature_dicts]
+                raw = raw_columns[raw_key]
+                columns[column_key] = (
+                    [_norm_value(v) for v in raw],
+                    [v == out_value for v in raw],
+                )
+            values, is_out = columns[column_key]
+            windows.append((
+                _shifted(values, offset, size, out_norm),
+                _shifted(is_out, offset, size, out_is_out),
+            ))
+
+        featname = pattern.featname
+        join = pattern.separator.join
+        if len(windows) == 1:
+            (values, is_out), = windows
+            for featdict, value, out in zip(feature_dicts, values, is_out):
+                if not out:
+                    featdict[featname] = join((value,))
+        else:
+            window_values = zip(*[values for values, is_out in windows])
+            window_is_out = zip(*[is_out for values, is_out in windows])
+            for featdict, values, is_out in zip(feature_dicts, window_values,
+                                                window_is_out):
+                if not all(is_out):
+                    featdict[featname] = join(values)
+
+
+def _norm_value(value):
+    return str(value) if type(value) == bool else value
+
+
+def _shifted(column, offset, size, fill):
+    """
+    Return a list with ``column[i + offset]`` values
+    (or ``fill`` if the index is out of range)::
+
+        >>> _shifted([1, 2, 3], -1, 3, 0), _shifted([1, 2, 3], 2, 3, 0)
+        ([0, 1, 2], [3, 0, 0])
+    """
+    if offset >= 0:
+        offset = min(offset, size)
+        return column[offset:] + [fill] * offset
+    offset = min(-offset, size)
+    return [fill] * offset + column[:size - offset]
+
 
 def _add_pattern_features(feature_dicts, pattern, out_value, missing_value, separator):
     for pos, featdict in enumerate(feature_dicts):
         keys = []
         values = []
         for offset, key in pattern:
-            if offset == 0:
-                keys.append(key)
-            elif offset < 0:
-                keys.append('%s[%s]' % (key, offset))
-            else:
-                keys.append('%s[+%s]' % (key, offset))
+            keys.append(_window_key(key, offset))
 
             index = pos + offset
             if 0 <= index < len(feature_dicts):
@@ -97,7 +504,6 @@ def _add_pattern_features(feature_dicts, pattern, out_value, missing_value, sepa
             else:
                 values.append(out_value)
 
-        # FIXME: there should be a cleaner/faster way
         if not all(v == out_value for v in values):
             values = [str(v) if type(v) == bool else v for v in values]
             featdict[separator.join(keys)] = separator.join(values)
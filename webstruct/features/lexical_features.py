@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Fused kernel for lexical token features.
+
+Lexical feature functions (token shape, number patterns, ``looks_like_*``
+checks) are cheap one by one, but each of them is a separate call
+which repeats some work for every token. :class:`LexicalFeatures`
+computes features of several such functions in a single call:
+the lowercased token is computed once, case-insensitive regexes
+are replaced with set lookups for printable ASCII tokens, and
+checks whose result is known in advance (e.g. the digit count of
+an alphabetic token, an email regex for a token without "@") are
+skipped. Each feature still uses its own regex or scan of the token
+where it needs one; the output is identical to the output of the
+original functions.
+"""
+from __future__ import absolute_import, division
+import re
+
+from .utils import TOKEN_SCOPE
+from .token_features import (
+    token_shape,
+    token_endswith_dot,
+    token_endswith_colon,
+    token_has_copyright,
+    number_pattern,
+    _SHAPE_RE,
+    _DIGIT_RE,
+    _NOT_X_WORD_RE,
+)
+from .data_features import (
+    looks_like_year,
+    looks_like_month,
+    looks_like_time,
+    looks_like_weekday,
+    looks_like_email,
+    looks_like_street_part,
+    looks_like_range,
+    EMAIL_RE,
+    MONTHS_RE,
+    WEEKDAYS_RE,
+    MONTHS_SRE,
+    WEEKDAYS_SRE,
+    TIME_RE,
+    STREET_PART_TOKENS,
+    COMMON_ADDRESS_PARTS,
+    DIRECTIONS,
+    RANGES,
+)
+
+__all__ = ['LexicalFeatures', 'lexical_features']
+
+
+# Tokens which can be checked with set lookups instead of case-insensitive
+# regexes: printable ASCII (case folding rules of ``re`` and ``str.lower``
+# are the same for them, and "$" can't match before a newline).
+_SIMPLE_TOKEN_RE = re.compile(r'[\x20-\x7e]*\Z')
+
+_MONTHS = frozenset(m.replace('\\.', '.').lower() for m in MONTHS_SRE.split('|'))
+_WEEKDAYS = frozenset(w.replace('\\.', '.').lower() for w in WEEKDAYS_SRE.split('|'))
+
+
+class LexicalFeatures(object):
+    """
+    Token feature function which computes features of several lexical
+    feature functions in a single call::
+
+        >>> from webstruct import HtmlToken
+        >>> features = LexicalFeatures(token_shape, looks_like_year)
+        >>> sorted(features(HtmlToken(0, ['2014'], None, False, 0, 4)).items())
+        [('first_upper', False), ('looks_like_year', True), ('shape', 'number')]
+
+    Supported functions are :func:`token_shape`, :func:`token_endswith_dot`,
+    :func:`token_endswith_colon`, :func:`token_has_copyright`,
+    :func:`number_pattern` and all ``looks_like_*`` functions;
+    :data:`lexical_features` is an instance for lexical members
+    of ``EXAMPLE_TOKEN_FEATURES``.
+    """
+    feature_scope = TOKEN_SCOPE
+
+    def __init__(self, *feature_funcs):
+        unknown = [f for f in feature_funcs if f not in _SUPPORTED_FUNCS]
+        if unknown:
+            raise ValueError("unsupported feature functions: %r" % unknown)
+        self.feature_funcs = feature_funcs
+        self.feature_keys = tuple(
+            key for f in feature_funcs for key in f.feature_keys
+        )
+        funcs = set(feature_funcs)
+        self._shape = token_shape in funcs
+        self._endswith_dot = token_endswith_dot in funcs
+        self._endswith_colon = token_endswith_colon in funcs
+        self._has_copyright = token_has_copyright in funcs
+        self._number_pattern = number_pattern in funcs
+        self._year = looks_like_year in funcs
+        self._month = looks_like_month in funcs
+        self._time = looks_like_time in funcs
+        self._weekday = looks_like_weekday in funcs
+        self._email = looks_like_email in funcs
+        self._street_part = looks_like_street_part in funcs
+        self._range = looks_like_range in funcs
+
+    def __call__(self, html_token):
+        features = {}
+        self.fill(html_token, features)
+        return features
+
+    def __repr__(self):
+        return "LexicalFeatures(%s)" % ", ".join(
+            f.__name__ for f in self.feature_funcs)
+
+    def fill(self, html_token, features):
+        token = html_token.token
+        lower = token.lower()
+        simple = _SIMPLE_TOKEN_RE.match(token) is not None
+
+        if self._shape:
+            m = _SHAPE_RE.match(token)
+            features['shape'] = m.lastgroup if m is not None else 'other'
+            features['first_upper'] = token[0].isupper()
+
+        if self._endswith_colon:
+            features['endswith_colon'] = token.endswith(':') and token != ':'
+        if self._endswith_dot:
+            features['endswith_dot'] = token.endswith('.') and token != '.'
+        if self._has_copyright:
+            features['has_copyright'] = u'©' in token
+
+        # letters are never digits
+        if self._number_pattern and not token.isalpha():
+            n_digits = sum(1 for ch in token if ch.isdigit())
+            if n_digits / len(token) >= 0.3:
+                num_pattern = _DIGIT_RE.sub('X', token)
+                features['num_pattern'] = num_pattern
+                features['num_pattern2'] = _NOT_X_WORD_RE.sub('C', num_pattern)
+
+        if self._year:
+            features['looks_like_year'] = (
+                len(token) == 4 and token.isdigit() and token[:2] in ['19', '20']
+            )
+        if self._month:
+            if simple:
+                features['looks_like_month'] = lower in _MONTHS
+            else:
+                features['looks_like_month'] = MONTHS_RE.match(token) is not None
+        if self._email:
+            # the regex requires "@"
+            features['looks_like_email'] = (
+                u'@' in token and EMAIL_RE.search(token) is not None
+            )
+        if self._street_part:
+            features['common_street_part'] = lower in STREET_PART_TOKENS
+            features['common_address_part'] = lower in COMMON_ADDRESS_PARTS
+            features['direction'] = lower in DIRECTIONS
+        if self._time:
+            features['looks_like_time'] = TIME_RE.match(token) is not None
+        if self._weekday:
+            if simple:
+                features['looks_like_weekday'] = lower in _WEEKDAYS
+            else:
+                features['looks_like_weekday'] = WEEKDAYS_RE.match(token) is not None
+        if self._range:
+            features['looks_like_range'] = lower in RANGES
+
+    def __reduce__(self):
+        return LexicalFeatures, tuple(self.feature_funcs)
+
+
+_SUPPORTED_FUNCS = frozenset([
+    token_shape,
+    token_endswith_dot,
+    token_endswith_colon,
+    token_has_copyright,
+    number_pattern,
+    looks_like_year,
+    looks_like_month,
+    looks_like_time,
+    looks_like_weekday,
+    looks_like_email,
+    looks_like_street_part,
+    looks_like_range,
+])
+
+
+lexical_features = LexicalFeatures(
+    token_shape,
+    token_endswith_colon,
+    token_endswith_dot,
+    token_has_copyright,
+    number_pattern,
+    looks_like_year,
+    looks_like_month,
+    looks_like_email,
+    looks_like_street_part,
+)
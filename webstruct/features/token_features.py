@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division
 import re
+from .utils import token_feature, token_pure, constant, TOKEN_SCOPE
 
 __all__ = [
     'bias',
@@ -17,105 +18,139 @@ __all__ = [
 ]
 
 
-def bias(html_token):
-    return {'bias': 1}
+@constant
+@token_feature('bias')
+def bias(html_token, features):
+    features['bias'] = 1
 
 
-def token_identity(html_token):
-    return {'token': html_token.token}
+@token_pure
+@token_feature('token')
+def token_identity(html_token, features):
+    features['token'] = html_token.token
 
 
-def token_lower(html_token):
-    return {'lower': html_token.token.lower()}
+@token_pure
+@token_feature('lower')
+def token_lower(html_token, features):
+    features['lower'] = html_token.token.lower()
 
 
-def token_shape(html_token):
+@token_pure
+@token_feature('shape', 'first_upper')
+def token_shape(html_token, features):
     token = html_token.token
-    return {
-        'shape': _shape(token),
-        'first_upper': token[0].isupper(),
-    }
+    features['shape'] = _shape(token)
+    features['first_upper'] = token[0].isupper()
 
 
-def token_endswith_dot(html_token):
+@token_pure
+@token_feature('endswith_dot')
+def token_endswith_dot(html_token, features):
     token = html_token.token
-    return {'endswith_dot': token.endswith('.') and token != '.'}
+    features['endswith_dot'] = token.endswith('.') and token != '.'
 
 
-def token_endswith_colon(html_token):
+@token_pure
+@token_feature('endswith_colon')
+def token_endswith_colon(html_token, features):
     token = html_token.token
-    return {'endswith_colon': token.endswith(':') and token != ':'}
+    features['endswith_colon'] = token.endswith(':') and token != ':'
 
 
-def token_has_copyright(html_token):
-    return {'has_copyright': u'©' in html_token.token}
+@token_pure
+@token_feature('has_copyright')
+def token_has_copyright(html_token, features):
+    features['has_copyright'] = u'©' in html_token.token
 
 
-def number_pattern(html_token):
+@token_pure
+@token_feature('num_pattern', 'num_pattern2')
+def number_pattern(html_token, features):
     token = html_token.token
     digit_ratio = sum(1 for ch in token if ch.isdigit()) / len(token)
 
     if digit_ratio >= 0.3:
-        num_pattern = re.sub('\d', 'X', token)
-        num_pattern2 = re.sub('[^X\W]', 'C', num_pattern)
-        return {
-            'num_pattern': num_pattern,
-            'num_pattern2': num_pattern2,
-        }
-    else:
-        return {}
+        num_pattern = _DIGIT_RE.sub('X', token)
+        num_pattern2 = _NOT_X_WORD_RE.sub('C', num_pattern)
+        features['num_pattern'] = num_pattern
+        features['num_pattern2'] = num_pattern2
 
 
 class PrefixFeatures(object):
+    feature_scope = TOKEN_SCOPE
+
     def __init__(self, lenghts=(2,3,4), featname="prefix", lower=True):
         self.lower = lower
         self.featname = featname
         self.sizes = dict(
             zip(["%s%s" % (featname, i) for i in lenghts], lenghts)
         )
+        self.feature_keys = tuple(self.sizes)
 
     def __call__(self, html_token):
         token = html_token.token if not self.lower else html_token.token.lower()
         return {key: token[:size] for key, size in self.sizes.items()}
 
+    def fill(self, html_token, features):
+        token = html_token.token if not self.lower else html_token.token.lower()
+        for key, size in self.sizes.items():
+            features[key] = token[:size]
+
 
 class SuffixFeatures(object):
+    feature_scope = TOKEN_SCOPE
+
     def __init__(self, lenghts=(2,3,4), featname="suffix", lower=True):
         self.lower = lower
         self.sizes = dict(
             zip(["%s%s" % (featname, i) for i in lenghts], lenghts)
         )
+        self.feature_keys = tuple(self.sizes)
 
     def __call__(self, html_token):
         token = html_token.token if not self.lower else html_token.token.lower()
         return {key: token[-size:] for key, size in self.sizes.items()}
 
+    def fill(self, html_token, features):
+        token = html_token.token if not self.lower else html_token.token.lower()
+        for key, size in self.sizes.items():
+            features[key] = token[-size:]
+
 
-def prefixes_and_suffixes(html_token):
+@token_pure
+@token_feature('prefix2', 'suffix2', 'prefix3', 'suffix3', 'prefix4', 'suffix4')
+def prefixes_and_suffixes(html_token, features):
     token = html_token.token.lower()
-    return {
-        'prefix2': token[:2],
-        'suffix2': token[-2:],
-        'prefix3': token[:3],
-        'suffix3': token[-3:],
-        'prefix4': token[:4],
-        'suffix4': token[-4:],
-    }
+    features['prefix2'] = token[:2]
+    features['suffix2'] = token[-2:]
+    features['prefix3'] = token[:3]
+    features['suffix3'] = token[-3:]
+    features['prefix4'] = token[:4]
+    features['suffix4'] = token[-4:]
+
+
+_DIGIT_RE = re.compile(r'\d')
+_NOT_X_WORD_RE = re.compile(r'[^X\W]')
+
+
+# stolen from NLTK source (nltk.tag.sequential.ClassifierBasedPOSTagger);
+# alternatives are tried in order, like separate re.match calls.
+# Note that "$" only applies to the second "number" alternative.
+_SHAPE_RE = re.compile(
+    r"(?P<number>[-+]?[0-9]+(?:\.[0-9]*)?|[0-9]*\.[0-9]+$)|"
+    r"(?P<punct>\W+$)|"
+    r"(?P<upcase>[A-Z][a-z'`]+$)|"
+    r"(?P<caps>[A-Z][A-Z'`]+$)|"
+    r"(?P<downcase>[a-z]+$)|"
+    r"(?P<mixedcase>\w+$)"
+)
 
 
-# stolen from NLTK source (nltk.tag.sequential.ClassifierBasedPOSTagger)
 def _shape(token):
-    if re.match('[-+]?[0-9]+(\.[0-9]*)?|[0-9]*\.[0-9]+$', token):
-        return 'number'
-    elif re.match('\W+$', token):
-        return 'punct'
-    elif re.match("[A-Z][a-z'`]+$", token):
-        return 'upcase'
-    elif re.match("[A-Z][A-Z'`]+$", token):
-        return 'caps'
-    elif re.match("[a-z]+$", token):
-        return 'downcase'
-    elif re.match('\w+$', token):
-        return 'mixedcase'
-    else:
-        return 'other'
+    """
+    >>> [_shape(token) for token in ['12abc', 'Foo', 'FOO', 'foo', 'fOo', '...', 'a-b']]
+    ['number', 'upcase', 'caps', 'downcase', 'mixedcase', 'punct', 'other']
+    """
+    m = _SHAPE_RE.match(token)
+    return m.lastgroup if m is not None else 'other'
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Utilities for writing fast token feature functions.
+
+A token feature function accepts an :class:`~.HtmlToken` and returns
+a dict with features. :class:`~.HtmlFeatureExtractor` merges dicts returned
+by all token feature functions into a single dict per token;
+creating these intermediate dicts is a large part of feature extraction
+time. To avoid it, a feature function may also provide
+
+* ``fill(html_token, features)`` method which writes the features
+  to ``features`` dict instead of returning a new dict;
+* ``feature_keys`` attribute - a tuple with names of all features
+  the function may emit (or None if they are not known in advance).
+
+:class:`~.HtmlFeatureExtractor` calls ``fill`` when it is available.
+For documents passed as :class:`~.HtmlTokenBatch` it calls
+``fill_batch(batch, index, features)`` method instead if a feature
+function has it; such method should compute features of ``index``-th
+token from batch columns, without creating :class:`~.HtmlToken`.
+:func:`token_feature` decorator creates such feature functions from
+``fill`` functions; all functions in :mod:`webstruct.features` are
+defined this way::
+
+    >>> @token_feature('length')
+    ... def token_length(html_token, features):
+    ...     features['length'] = len(html_token.token)
+    >>> token_length.feature_keys
+    ('length',)
+
+The result can be used as a regular feature function::
+
+    >>> from webstruct import HtmlToken
+    >>> token_length(HtmlToken(0, ['foo'], None, False, 0, 3))
+    {'length': 3}
+
+Many feature functions depend only on token text. Mark them with
+:func:`token_pure` decorator (or set ``feature_scope`` attribute to
+``TOKEN_SCOPE``), and :class:`~.HtmlFeatureExtractor` will cache
+their results per token text (see its ``token_cache_size`` parameter)::
+
+    >>> token_length = token_pure(token_length)
+    >>> get_feature_scope(token_length) == TOKEN_SCOPE
+    True
+
+Feature functions which depend only on the text block a token belongs to
+(``html_token.elem``, ``html_token.is_tail`` and ``html_token.tokens``)
+can be marked with :func:`element_scoped` decorator (or
+``feature_scope = ELEMENT_SCOPE`` attribute); they are computed once
+per block in each document.
+
+Feature functions which don't depend on a token at all (e.g.
+:func:`~.bias`) can be marked with :func:`constant` decorator
+(or ``feature_scope = CONSTANT_SCOPE`` attribute); they are
+computed only once.
+
+Values of features emitted by such functions are shared between tokens,
+so they shouldn't be mutable.
+"""
+from __future__ import absolute_import
+import functools
+
+
+# Feature function depends only on html_token.token
+TOKEN_SCOPE = 'token'
+
+# Feature function depends only on html_token.elem, html_token.is_tail
+# and html_token.tokens
+ELEMENT_SCOPE = 'element'
+
+# Feature function returns the same features for all tokens
+CONSTANT_SCOPE = 'constant'
+
+
+def token_feature(*keys):
+    """
+    Decorator which turns ``fill(html_token, features)`` function
+    into a :class:`FeatureFunction`. ``keys`` are names of features
+    the function may emit; don't pass them if they are not known
+    in advance.
+    """
+    def decorator(fill):
+        return FeatureFunction(fill, keys or None)
+    return decorator
+
+
+class FeatureFunction(object):
+    """
+    Token feature function defined by a ``fill(html_token, features)``
+    function. Calling it returns a new dict with features.
+    Use :func:`token_feature` decorator to create it.
+
+    FeatureFunction instances are pickled by reference, so they should
+    be defined at module level.
+    """
+    def __init__(self, fill, feature_keys=None):
+        self.fill = fill
+        self.feature_keys = tuple(feature_keys) if feature_keys else None
+        functools.update_wrapper(self, fill)
+
+    def __call__(self, html_token):
+        features = {}
+        self.fill(html_token, features)
+        return features
+
+    def __reduce__(self):
+        return self.__name__
+
+    def __repr__(self):
+        return "<feature function %s.%s>" % (self.__module__, self.__name__)
+
+
+def get_fill(feature_func):
+    """
+    Return ``fill(html_token, features)`` function for a token feature
+    function: its ``fill`` attribute if available, or a function which
+    updates ``features`` with the result of ``feature_func``.
+    """
+    fill = getattr(feature_func, 'fill', None)
+    if fill is not None:
+        return fill
+
+    def fill(html_token, features):
+        features.update(feature_func(html_token))
+    return fill
+
+
+def get_feature_keys(feature_func):
+    """
+    Return a tuple with names of features ``feature_func`` may emit,
+    or None if they are not known.
+    """
+    return getattr(feature_func, 'feature_keys', None)
+
+
+def token_pure(feature_func):
+    """
+    Decorator which marks a token feature function as depending
+    only on token text (``html_token.token``).
+    """
+    feature_func.feature_scope = TOKEN_SCOPE
+    return feature_func
+
+
+def element_scoped(feature_func):
+    """
+    Decorator which marks a token feature function as depending
+    only on the text block of a token: ``html_token.elem``,
+    ``html_token.is_tail`` and ``html_token.tokens``.
+    """
+    feature_func.feature_scope = ELEMENT_SCOPE
+    return feature_func
+
+
+def constant(feature_func):
+    """
+    Decorator which marks a token feature function as returning
+    the same features for all tokens.
+    """
+    feature_func.feature_scope = CONSTANT_SCOPE
+    return feature_func
+
+
+def get_feature_scope(feature_func):
+    """
+    Return what a token feature function depends on: ``TOKEN_SCOPE``,
+    ``ELEMENT_SCOPE``, ``CONSTANT_SCOPE`` (nothing) or None
+    (if it can use any information about a token).
+    """
+    return getattr(feature_func, 'feature_scope', None)
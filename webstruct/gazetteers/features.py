@@ -1,22 +1,33 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 from webstruct.gazetteers.geonames import GAZETTEER_FORMAT
-from webstruct.features.global_features import LongestMatchGlobalFeature
+from webstruct.features.global_features import _FileLongestMatchGlobalFeature
 
 
-class MarisaGeonamesGlobalFeature(LongestMatchGlobalFeature):
+class MarisaGeonamesGlobalFeature(_FileLongestMatchGlobalFeature):
     """
     Global feature that matches longest entities from a lexicon
     extracted from geonames.org and stored in a MARISA Trie.
+
+    If ``mmap`` is True, the trie file is memory-mapped instead of
+    being loaded to memory, so processes which use the same file share
+    its pages, and loading is almost instant. The feature is pickled
+    by file reference, so the file must be available at the same path
+    when it is unpickled (e.g. in joblib or multiprocessing workers).
+    See :class:`~.LongestMatchGlobalFeature` for ``normalize`` argument.
     """
-    def __init__(self, filename, featname, format=None):
-        import marisa_trie
+    def __init__(self, filename, featname, format=None, mmap=False,
+                 normalize=None):
+        super(MarisaGeonamesGlobalFeature, self).__init__(
+            filename, featname, format, mmap, normalize)
 
-        self.filename = filename
-        self.data = marisa_trie.RecordTrie(format or GAZETTEER_FORMAT)
-        self.data.load(filename)
+    def load_data(self):
+        import marisa_trie
 
-        super(MarisaGeonamesGlobalFeature, self).__init__(self.data, featname)
+        data = marisa_trie.RecordTrie(self.format or GAZETTEER_FORMAT)
+        if self.mmap:
+            return data.mmap(self.filename)
+        return data.load(self.filename)
 
 
 # TODO: add features that'd allow to check entities for compatibility.
@@ -1,10 +1,26 @@
 # -*- coding: utf-8 -*-
-from __future__ import absolute_import
+"""
+Utilities for building gazetteers from GeoNames_ data.
+
+Large dumps (like allCountries.zip) can be processed in chunks
+using :func:`iter_geonames_chunks` and :func:`build_gazetteer`,
+or from the command line::
+
+    python -m webstruct.gazetteers.geonames allCountries.zip geonames.marisa
+
+Run it with ``--help`` to see the options.
+
+.. _GeoNames: http://www.geonames.org/
+"""
+from __future__ import absolute_import, division
 import os
+import sys
 import csv
-import six
 import zipfile
-import numpy as np
+import contextlib
+
+import six
+from six.moves import zip
 
 GAZETTEER_FORMAT = "2s 1s 5s 2s 3s"
 GAZETTEER_COLUMNS = ['country_code', 'feature_class', 'feature_code',
@@ -64,75 +80,211 @@ def to_dawg(df, columns=None, format=None):
     return dawg.RecordDAWG(format, _iter_geonames_items(df, columns))
 
 
-def read_geonames(filename):
+def read_geonames(filename, chunksize=None):
     """
     Parse geonames file to a pandas.DataFrame. File may be downloaded
     from http://download.geonames.org/export/dump/; it should be unzipped
     and in a "geonames table" format.
+
+    If ``chunksize`` is not None, an iterator over DataFrames
+    with ``chunksize`` rows is returned instead.
     """
     import pandas as pd
-    return pd.read_csv(filename, **_GEONAMES_PANDAS_PARAMS)
+    return pd.read_csv(filename, chunksize=chunksize, **_GEONAMES_PANDAS_PARAMS)
+
+
+def read_geonames_zipped(zip_filename, geonames_filename=None, chunksize=None):
+    """
+    Parse zipped geonames file. If ``chunksize`` is not None,
+    an iterator over DataFrames with ``chunksize`` rows is returned.
+    """
+    if chunksize is not None:
+        return _read_geonames_zipped_chunks(zip_filename, geonames_filename,
+                                            chunksize)
+    with _open_zipped(zip_filename, geonames_filename) as fp:
+        return read_geonames(fp)
+
+
+def iter_geonames_chunks(filename, chunksize=100000):
+    """
+    Iterate over DataFrames with ``chunksize`` rows of a geonames file;
+    the file may be zipped (its name should end with ".zip" then).
+    Use it to process large files like allCountries.zip
+    without loading them to memory.
+    """
+    if filename.endswith('.zip'):
+        return read_geonames_zipped(filename, chunksize=chunksize)
+    return read_geonames(filename, chunksize=chunksize)
+
+
+def build_gazetteer(chunks, kind='marisa', filter_func=None, lowercase=False,
+                    columns=GAZETTEER_COLUMNS, format=GAZETTEER_FORMAT,
+                    progress=None, normalize=None):
+    """
+    Build a gazetteer from an iterable of DataFrames with GeoNames data
+    (e.g. returned by :func:`iter_geonames_chunks`).
 
+    Names of each chunk are split and encoded to compact
+    ``(name, values)`` items which are deduplicated, so
+    only the unique items are kept in memory, not the DataFrames.
+    ``kind`` is either 'marisa' (a ``marisa_trie.RecordTrie`` with
+    ``columns`` encoded using ``format`` is returned, like
+    :func:`to_marisa` does) or 'dawg' (a ``dawg.CompletionDAWG``
+    with names is returned, like :func:`to_dawg` does).
 
-def read_geonames_zipped(zip_filename, geonames_filename=None):
-    """ Parse zipped geonames file. """
+    ``filter_func`` is a function which receives a chunk and returns
+    a filtered chunk. If ``lowercase`` is True, names are lowercased.
+    ``normalize`` is a function applied to each name (e.g.
+    :func:`~webstruct.features.global_features.strip_accents_lowercase`);
+    use the same function as ``normalize`` argument of
+    a gazetteer feature, so that a normalized gazetteer file
+    can be memory-mapped as-is.
+    ``progress`` is a function which is called after each chunk
+    with the number of rows processed and the number of unique items
+    found so far.
+    """
+    if kind not in ('marisa', 'dawg'):
+        raise ValueError("unknown gazetteer kind: %r" % kind)
+    items = set()
+    n_rows = 0
+    for df in chunks:
+        n_rows += len(df)
+        if filter_func is not None:
+            df = filter_func(df)
+        df = _split_names_into_rows(df)
+        if lowercase:
+            df['name'] = df['name'].str.lower()
+        if normalize is not None:
+            df['name'] = df['name'].map(normalize)
+        if kind == 'dawg':
+            items.update(df['name'])
+        else:
+            items.update(_geonames_items(df, columns))
+        if progress is not None:
+            progress(n_rows, len(items))
+
+    if kind == 'dawg':
+        import dawg
+        return dawg.CompletionDAWG(sorted(items), input_is_sorted=True)
+    import marisa_trie
+    return marisa_trie.RecordTrie(format, sorted(items))
+
+
+def _read_geonames_zipped_chunks(zip_filename, geonames_filename, chunksize):
+    with _open_zipped(zip_filename, geonames_filename) as fp:
+        for df in read_geonames(fp, chunksize=chunksize):
+            yield df
+
+
+@contextlib.contextmanager
+def _open_zipped(zip_filename, geonames_filename=None):
     if geonames_filename is None:
         root, filename = os.path.split(zip_filename)
         geonames_filename = filename.replace('.zip', '.txt')
 
     with zipfile.ZipFile(zip_filename, 'r') as zf:
-        fp = zf.open(geonames_filename)
-        return read_geonames(fp)
+        yield zf.open(geonames_filename)
 
 
 def _iter_geonames_items(df, columns):
-    """ Iterate over (name, [column_values_as_utf8]) tuples """
-    df = _split_names_into_rows(df)
-    for idx, row in df.iterrows():
-        yield row['name'], _ensure_utf8([row[c] for c in columns])
+    """ Iterate over (name, (column_values_as_utf8)) tuples """
+    return _geonames_items(_split_names_into_rows(df), columns)
 
 
-def _joined_names_column(df):
+def _geonames_items(df, columns):
     """
-    Join data from all name columns into a single column.
+    Return an iterator over (name, (column_values_as_utf8)) tuples
+    for a DataFrame returned by :func:`_split_names_into_rows`.
     """
-    return df.apply(
-        lambda row: ','.join(set([
-            six.text_type(n)
-            for n in [row['main_name'], row['asciiname'], row['alternatenames']]
-            if n and n is not np.nan
-        ])),
-        axis=1
-    )
+    values = [_utf8_column(df[column]) for column in columns]
+    return zip(df['name'], zip(*values))
 
 
 def _split_names_into_rows(df):
     """
     Create a separate row for each alternate name (with other data duplicated).
     Delete 'main_name', 'asciiname' and 'alternatenames' columns and add
-    a single 'name' column instead.
+    a single 'name' column instead. All name columns are split on commas
+    (so "Washington, D.C." becomes "Washington" and " D.C.", like before);
+    empty and duplicate names of a row are dropped.
     """
     import pandas as pd
 
-    names = _joined_names_column(df).str.split(',')
-    name_lenghts = names.map(len)
-    idx = np.repeat(name_lenghts.index, name_lenghts.values)
+    df = df.reset_index()
+    names = pd.concat([
+        df[column].dropna().astype(six.text_type).str.split(',').explode()
+        for column in ['main_name', 'asciiname', 'alternatenames']
+    ])
+    names = names[names.notnull()].astype(six.text_type)
+    names = names[names != '']
+    rows = pd.DataFrame({'row': names.index, 'name': names.values})
+    rows = rows.drop_duplicates().sort_values('row', kind='mergesort')
 
-    names_split = np.concatenate(names.values)
-    names_s = pd.Series(names_split, index=idx)
-    names_s.name = 'name'
+    df = df.drop(columns=['main_name', 'asciiname', 'alternatenames'])
+    df = df.take(rows['row'].values)
+    df.insert(2, 'name', rows['name'].values)
+    return df.reset_index(drop=True)
 
-    df = df.join(names_s, )
-    del df['main_name']
-    del df['asciiname']
-    del df['alternatenames']
 
-    cols = df.columns.tolist()
-    cols = cols[0:1] + cols[-1:] + cols[1:-1]
-    df = df[cols]
-    return df.reset_index()
+def _utf8_column(column):
+    # missing values (e.g. admin codes) become b''
+    return [six.text_type(v).encode('utf8') for v in column.fillna('')]
+
+
+def main():
+    import argparse
+    import time
+
+    p = argparse.ArgumentParser(
+        description="Build a gazetteer from a GeoNames dump "
+                    "(e.g. allCountries.zip from "
+                    "http://download.geonames.org/export/dump/)")
+    p.add_argument('input', help="geonames .txt or .zip file")
+    p.add_argument('output', help="output gazetteer file")
+    p.add_argument('--kind', choices=['marisa', 'dawg'], default='marisa',
+                   help="marisa_trie.RecordTrie with GeoNames data "
+                        "or dawg.CompletionDAWG with names (default: marisa)")
+    p.add_argument('--feature-code', action='append', dest='feature_codes',
+                   help="only use places with this feature code "
+                        "(e.g. ADM1); may be passed several times")
+    p.add_argument('--lower', action='store_true', help="lowercase names")
+    p.add_argument('--strip-accents', action='store_true',
+                   help="lowercase names and remove accents (use with "
+                        "normalize=strip_accents_lowercase gazetteer features)")
+    p.add_argument('--chunksize', type=int, default=100000,
+                   help="number of rows to process at once (default: 100000)")
+    args = p.parse_args()
+
+    filter_func = None
+    if args.feature_codes:
+        def filter_func(df):
+            return df[df.feature_code.isin(args.feature_codes)]
+
+    normalize = None
+    if args.strip_accents:
+        from webstruct.features.global_features import strip_accents_lowercase
+        normalize = strip_accents_lowercase
+
+    start = time.time()
+
+    def progress(n_rows, n_items):
+        elapsed = time.time() - start
+        sys.stderr.write("\r%d rows, %d unique entries, %.0f rows/s" % (
+            n_rows, n_items, n_rows / max(elapsed, 1e-9)))
+        sys.stderr.flush()
+
+    gazetteer = build_gazetteer(
+        iter_geonames_chunks(args.input, args.chunksize),
+        kind=args.kind,
+        filter_func=filter_func,
+        lowercase=args.lower,
+        progress=progress,
+        normalize=normalize,
+    )
+    sys.stderr.write("\nsaving %s\n" % args.output)
+    gazetteer.save(args.output)
+    sys.stderr.write("done in %.1fs\n" % (time.time() - start))
 
 
-def _ensure_utf8(lst):
-    return [v.encode('utf8') if not isinstance(v, float) else str(v)
-            for v in lst]
+if __name__ == "__main__":
+    main()
@@ -10,10 +10,12 @@ them from regular text/tokens.
 
 from __future__ import absolute_import, print_function
 import re
-import copy
+from array import array
+from copy import deepcopy
 from itertools import groupby
 from collections import namedtuple
-from six.moves import zip
+import six
+from six.moves import zip, range
 
 from lxml.etree import iterwalk
 
@@ -22,6 +24,7 @@ from webstruct.text_tokenizers import tokenize, TextToken
 from webstruct.utils import (
     replace_html_tags,
     kill_html_tags,
+    map_parallel,
 )
 
 
@@ -53,6 +56,11 @@ class HtmlToken(_HtmlToken):
     * :attr:`parent` is token's parent HTML element (as lxml's Element);
     * :attr:`root` is an ElementTree this token belongs to.
 
+    Tokens returned by :meth:`HtmlTokenizer.load_and_tokenize` and
+    :func:`detach_html_tokens` are "detached": their :attr:`elem` is
+    a :class:`DetachedElement` instead of lxml's Element. Such tokens can be
+    pickled, but :attr:`root` is not available for them.
+
     """
     @property
     def token(self):
@@ -76,6 +84,339 @@ class HtmlToken(_HtmlToken):
         )
 
 
+class DetachedElement(object):
+    """
+    A lightweight picklable stand-in for lxml's Element which is used
+    by detached :class:`HtmlToken` instances. It keeps only element tag
+    and a link to the parent element, and supports the parts of lxml
+    Element API which are commonly used by feature functions:
+    :attr:`tag`, :meth:`getparent` and :meth:`iterancestors`.
+
+    Additionally, :attr:`ancestor_tags` provides a set of tags
+    of the element and all its ancestors; it is computed once per element.
+    """
+    __slots__ = ['tag', '_parent', '_ancestor_tags']
+
+    def __init__(self, tag, parent=None):
+        self.tag = tag
+        self._parent = parent
+        self._ancestor_tags = None
+
+    @property
+    def ancestor_tags(self):
+        """ A frozenset with tags of the element and all its ancestors """
+        if self._ancestor_tags is None:
+            chain = []
+            elem = self
+            while elem is not None and elem._ancestor_tags is None:
+                chain.append(elem)
+                elem = elem._parent
+            tags = elem._ancestor_tags if elem is not None else frozenset()
+            for elem in reversed(chain):
+                if elem.tag not in tags:
+                    tags = tags | {elem.tag}
+                elem._ancestor_tags = tags
+        return self._ancestor_tags
+
+    def getparent(self):
+        return self._parent
+
+    def iterancestors(self, tag=None, *tags):
+        if tag is not None:
+            tags = (tag,) + tags
+        elem = self._parent
+        while elem is not None:
+            if not tags or elem.tag in tags:
+                yield elem
+            elem = elem._parent
+
+    def getroottree(self):
+        raise ValueError("detached elements don't belong to a tree")
+
+    def __getstate__(self):
+        return self.tag, self._parent
+
+    def __setstate__(self, state):
+        self.tag, self._parent = state
+        self._ancestor_tags = None
+
+    def __repr__(self):
+        return "<DetachedElement %s at 0x%x>" % (self.tag, id(self))
+
+
+def detach_html_tokens(html_tokens):
+    """
+    Return a list of :class:`HtmlToken` instances which don't reference
+    lxml tree: elements are replaced with :class:`DetachedElement`
+    instances (with all ancestors). Detached tokens are picklable;
+    tokens from the same element share :class:`DetachedElement` instances.
+    """
+    detached = {}
+
+    def detach(elem):
+        chain = []
+        while elem is not None and elem not in detached:
+            chain.append(elem)
+            elem = elem.getparent()
+        parent = detached.get(elem)
+        for elem in reversed(chain):
+            parent = detached[elem] = DetachedElement(elem.tag, parent)
+        return parent
+
+    return [
+        HtmlToken(tok.index, tok.tokens, detach(tok.elem), tok.is_tail,
+                  tok.position, tok.length)
+        for tok in html_tokens
+    ]
+
+
+class HtmlTokenBatch(object):
+    """
+    Columnar representation of a tokenized document: instead of a list
+    of :class:`HtmlToken` instances it stores parallel arrays.
+    It doesn't reference lxml tree, so it is compact and picklable.
+    Use :meth:`HtmlTokenizer.tokenize_single_batch` or
+    :meth:`from_html_tokens` to create it. :class:`~.HtmlFeatureExtractor`
+    accepts :class:`HtmlTokenBatch` instances as documents.
+
+    Token columns (one item per token):
+
+    * :attr:`tokens` - a list of token texts;
+    * :attr:`block_ids` - indices of text blocks (element text or tail)
+      tokens belong to;
+    * :attr:`elem_ids` - indices of elements tokens belong to;
+    * :attr:`is_tail` - 1 if the token belongs to element tail, 0 otherwise;
+    * :attr:`positions` and :attr:`lengths` - token positions and lengths
+      in element text or tail.
+
+    Block table: :attr:`block_offsets` is an array with an index of
+    the first token of each block (and the number of tokens as the last item).
+
+    Element tables (one item per element): :attr:`elem_tags` is a list of
+    element tags, :attr:`elem_parents` is an array of parent element
+    indices (-1 if there is no parent; parent index is always less than
+    the element index), :attr:`elem_ancestor_tags` is a list of frozensets
+    with tags of the element and all its ancestors.
+    """
+    def __init__(self, tokens, block_ids, elem_ids, is_tail, positions,
+                 lengths, block_offsets, elem_tags, elem_parents,
+                 elem_ancestor_tags=None):
+        self.tokens = tokens
+        self.block_ids = block_ids
+        self.elem_ids = elem_ids
+        self.is_tail = is_tail
+        self.positions = positions
+        self.lengths = lengths
+        self.block_offsets = block_offsets
+        self.elem_tags = elem_tags
+        self.elem_parents = elem_parents
+        if elem_ancestor_tags is None:
+            elem_ancestor_tags = _ancestor_tags(elem_tags, elem_parents)
+        self.elem_ancestor_tags = elem_ancestor_tags
+
+    @classmethod
+    def from_html_tokens(cls, html_tokens):
+        """
+        Create :class:`HtmlTokenBatch` from a list of :class:`HtmlToken`
+        instances (regular or detached).
+        """
+        builder = _HtmlTokenBatchBuilder()
+        block_tokens = []
+        for tok in html_tokens:
+            if block_tokens and tok.tokens is not block_tokens[0].tokens:
+                builder.add_html_tokens(block_tokens)
+                block_tokens = []
+            block_tokens.append(tok)
+        if block_tokens:
+            builder.add_html_tokens(block_tokens)
+        return builder.build()
+
+    def html_tokens(self):
+        """
+        Return a list of detached :class:`HtmlToken` instances
+        for this document.
+        """
+        elems = self.detached_elements()
+        res = []
+        offsets = self.block_offsets
+        for block_id in range(len(offsets) - 1):
+            start, end = offsets[block_id], offsets[block_id + 1]
+            block_tokens = self.tokens[start:end]
+            elem = elems[self.elem_ids[start]]
+            is_tail = bool(self.is_tail[start])
+            for index in range(end - start):
+                res.append(HtmlToken(index, block_tokens, elem, is_tail,
+                                     self.positions[start + index],
+                                     self.lengths[start + index]))
+        return res
+
+    def lazy_html_tokens(self):
+        """
+        Return a :class:`LazyHtmlTokens` sequence which creates detached
+        :class:`HtmlToken` instances only for tokens which are accessed.
+        """
+        return LazyHtmlTokens(self)
+
+    def detached_elements(self):
+        """
+        Return a list of :class:`DetachedElement` instances,
+        one for each element.
+        """
+        elems = []
+        for tag, parent_id, ancestor_tags in zip(self.elem_tags,
+                                                 self.elem_parents,
+                                                 self.elem_ancestor_tags):
+            parent = elems[parent_id] if parent_id >= 0 else None
+            elem = DetachedElement(tag, parent)
+            elem._ancestor_tags = ancestor_tags
+            elems.append(elem)
+        return elems
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __repr__(self):
+        return "HtmlTokenBatch(tokens=%d, blocks=%d, elements=%d)" % (
+            len(self.tokens), len(self.block_offsets) - 1, len(self.elem_tags)
+        )
+
+
+class LazyHtmlTokens(object):
+    """
+    A sequence of detached :class:`HtmlToken` instances for
+    an :class:`HtmlTokenBatch`; tokens (and their elements) are created
+    when they are accessed for the first time. Token columns of
+    the batch are available as :attr:`batch`; :attr:`n_created` is
+    the number of tokens created so far.
+    """
+    def __init__(self, batch):
+        self.batch = batch
+        self._html_tokens = [None] * len(batch)
+        self._elems = None
+        self._block_tokens = {}
+        self.n_created = 0
+
+    def __len__(self):
+        return len(self._html_tokens)
+
+    def __getitem__(self, index):
+        html_token = self._html_tokens[index]
+        if html_token is None:
+            html_token = self._html_tokens[index] = self._create(index)
+            self.n_created += 1
+        return html_token
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def _create(self, index):
+        batch = self.batch
+        if self._elems is None:
+            self._elems = batch.detached_elements()
+        block_id = batch.block_ids[index]
+        block_tokens = self._block_tokens.get(block_id)
+        if block_tokens is None:
+            offsets = batch.block_offsets
+            block_tokens = batch.tokens[offsets[block_id]:offsets[block_id + 1]]
+            self._block_tokens[block_id] = block_tokens
+        return HtmlToken(index - batch.block_offsets[block_id], block_tokens,
+                         self._elems[batch.elem_ids[index]],
+                         bool(batch.is_tail[index]),
+                         batch.positions[index], batch.lengths[index])
+
+
+class _HtmlTokenBatchBuilder(object):
+    """ Helper for creating :class:`HtmlTokenBatch` block by block """
+    def __init__(self):
+        self.tokens = []
+        self.block_ids = array('i')
+        self.elem_ids = array('i')
+        self.is_tail = array('b')
+        self.positions = array('i')
+        self.lengths = array('i')
+        self.block_offsets = array('i', [0])
+        self.elem_tags = []
+        self.elem_parents = array('i')
+        self._elem_index = {}
+
+    def add_block(self, elem, is_tail, tokens, positions, lengths):
+        """ Add a block of tokens (text or tail of ``elem``) """
+        n_tokens = len(tokens)
+        if not n_tokens:
+            return
+        block_id = len(self.block_offsets) - 1
+        elem_id = self._elem_id(elem)
+        self.tokens.extend(tokens)
+        self.block_ids.extend([block_id] * n_tokens)
+        self.elem_ids.extend([elem_id] * n_tokens)
+        self.is_tail.extend([int(is_tail)] * n_tokens)
+        self.positions.extend(positions)
+        self.lengths.extend(lengths)
+        self.block_offsets.append(len(self.tokens))
+
+    def add_text_tokens(self, elem, is_tail, text_tokens):
+        self.add_block(elem, is_tail,
+                       [t.chars for t in text_tokens],
+                       [t.position for t in text_tokens],
+                       [t.length for t in text_tokens])
+
+    def add_html_tokens(self, html_tokens):
+        first = html_tokens[0]
+        self.add_block(first.elem, first.is_tail,
+                       [t.token for t in html_tokens],
+                       [t.position for t in html_tokens],
+                       [t.length for t in html_tokens])
+
+    def build(self):
+        return HtmlTokenBatch(
+            tokens=self.tokens,
+            block_ids=self.block_ids,
+            elem_ids=self.elem_ids,
+            is_tail=self.is_tail,
+            positions=self.positions,
+            lengths=self.lengths,
+            block_offsets=self.block_offsets,
+            elem_tags=self.elem_tags,
+            elem_parents=self.elem_parents,
+        )
+
+    def _elem_id(self, elem):
+        if elem in self._elem_index:
+            return self._elem_index[elem]
+
+        # register all unknown ancestors first, so that parent indices
+        # are always less than element indices
+        chain = []
+        while elem is not None and elem not in self._elem_index:
+            chain.append(elem)
+            elem = elem.getparent()
+        parent_id = self._elem_index[elem] if elem is not None else -1
+        for elem in reversed(chain):
+            elem_id = len(self.elem_tags)
+            self._elem_index[elem] = elem_id
+            self.elem_tags.append(elem.tag)
+            self.elem_parents.append(parent_id)
+            parent_id = elem_id
+        return parent_id
+
+
+def _ancestor_tags(elem_tags, elem_parents):
+    """
+    Return a list of frozensets with tags of each element and
+    all its ancestors. Equal sets are shared.
+    """
+    interned = {}
+    res = []
+    for tag, parent_id in zip(elem_tags, elem_parents):
+        tags = {tag}
+        if parent_id >= 0:
+            tags |= res[parent_id]
+        tags = frozenset(tags)
+        res.append(interned.setdefault(tags, tags))
+    return res
+
+
 class HtmlTokenizer(object):
     """
     Class for converting HTML trees (returned by one of the
@@ -132,7 +473,7 @@ class HtmlTokenizer(object):
         tag_pattern = self.sequence_encoder.token_processor.tag_re.pattern
         self._tag_re = re.compile(r"(^|\s)%s(\s|$)" % tag_pattern.strip())
 
-    def tokenize_single(self, tree):
+    def tokenize_single(self, tree, copy=True):
         """
         Return two lists:
 
@@ -141,6 +482,13 @@ class HtmlTokenizer(object):
 
         For unannotated HTML all tags will be "O" - they may be ignored.
 
+        By default the tree is copied before tokenization, so the original
+        tree is never changed. Pass ``copy=False`` if the caller owns
+        the tree and doesn't need it after tokenization: no copy is made,
+        the tree is modified inplace if ``kill_html_tags`` or
+        ``replace_html_tags`` are set, and returned tokens point to
+        elements of this tree (so :meth:`detokenize_single` annotates it).
+
         Example:
 
             >>> from webstruct import GateLoader, HtmlTokenizer
@@ -166,7 +514,8 @@ class HtmlTokenizer(object):
             ([], [])
 
         """
-        tree = copy.deepcopy(tree)
+        if copy:
+            tree = deepcopy(tree)
         self.sequence_encoder.reset()
         self._prepare_tree(tree)
         res = list(zip(*self._process_tree(tree)))
@@ -174,10 +523,88 @@ class HtmlTokenizer(object):
             return [], []
         return list(res[0]), list(res[1])
 
-    def tokenize(self, trees):
+    def tokenize_single_unannotated(self, tree, copy=True):
+        """
+        Return a list of HtmlToken tokens for a tree without annotations
+        (e.g. at prediction time). See :meth:`tokenize_single` for
+        the meaning of ``copy`` argument.
+
+        It is faster than :meth:`tokenize_single` because all annotation
+        processing is skipped: ``__START_TAG__`` / ``__END_TAG__``
+        tokens are not recognized and no tags are produced.
+
+            >>> from webstruct import HtmlLoader, HtmlTokenizer
+            >>> tree = HtmlLoader().loadbytes(b"<p>hello, <b>John Doe</b></p>")
+            >>> html_tokens = HtmlTokenizer().tokenize_single_unannotated(tree)
+            >>> [(tok.token, tok.parent.tag) for tok in html_tokens]
+            [('hello', 'p'), ('John', 'b'), ('Doe', 'b')]
+
+        """
+        if copy:
+            tree = deepcopy(tree)
+        self._prepare_tree(tree)
+        html_tokens = []
+        for elem, is_tail in self._iter_text_nodes(tree):
+            text = elem.tail if is_tail else elem.text
+            if not text:
+                continue
+            text_tokens = self.text_tokenize_func(text)
+            char_tokens = [t.chars for t in text_tokens]
+            for index, token in enumerate(text_tokens):
+                html_tokens.append(HtmlToken(index,
+                                             char_tokens,
+                                             elem,
+                                             is_tail,
+                                             token.position,
+                                             token.length))
+        return html_tokens
+
+    def tokenize_single_batch(self, tree, copy=True):
+        """
+        Return :class:`HtmlTokenBatch` for a tree and a list of
+        associated tags.
+
+        :class:`HtmlTokenBatch` doesn't reference the tree, so the tree
+        is only copied if it needs to be modified (when ``kill_html_tags``
+        or ``replace_html_tags`` are set) and ``copy`` is True.
+        """
+        if copy and (self.kill_html_tags or self.replace_html_tags):
+            tree = deepcopy(tree)
+        self.sequence_encoder.reset()
+        self._prepare_tree(tree)
+        builder = _HtmlTokenBatchBuilder()
+        all_tags = []
+        for elem, is_tail, tokens, tags in self._iter_blocks(tree):
+            builder.add_text_tokens(elem, is_tail, tokens)
+            all_tags.extend(tags)
+        return builder.build(), all_tags
+
+    def tokenize(self, trees, copy=True):
         X, y = [], []
         for tree in trees:
-            html_tokens, tags = self.tokenize_single(tree)
+            html_tokens, tags = self.tokenize_single(tree, copy=copy)
+            X.append(html_tokens)
+            y.append(tags)
+        return X, y
+
+    def load_and_tokenize(self, sources, loader, n_jobs=1, chunksize=16):
+        """
+        Load documents using ``loader`` and tokenize them in ``n_jobs``
+        worker processes (-1 means "use all CPUs").
+        Return ``(X, y)`` tuple, like :meth:`tokenize`.
+
+        ``sources`` is an iterable of file names (text) and/or
+        raw HTML data (bytes). Results are in input order;
+        documents are sent to workers in chunks of ``chunksize`` items.
+
+        lxml trees can't be pickled, so trees are loaded and tokenized
+        in workers, and detached tokens are returned (see
+        :func:`detach_html_tokens`). Such tokens can be used for feature
+        extraction, but not for :meth:`detokenize_single`.
+        """
+        worker = _LoadAndTokenize(self, loader)
+        X, y = [], []
+        for html_tokens, tags in map_parallel(worker, sources, n_jobs, chunksize):
             X.append(html_tokens)
             y.append(tags)
         return X, y
@@ -267,35 +694,58 @@ class HtmlTokenizer(object):
             replace_html_tags(tree, self.replace_html_tags)
 
     def _process_tree(self, tree):
-        if not isinstance(tree.tag, str) or tree.tag in self.ignore_html_tags:
+        for elem, is_tail, tokens, tags in self._iter_blocks(tree):
+            char_tokens = [t.chars for t in tokens]
+            for index, (token, tag) in enumerate(zip(tokens, tags)):
+                yield HtmlToken(index,
+                                char_tokens,
+                                elem,
+                                is_tail,
+                                token.position,
+                                token.length), tag
+
+    def _iter_blocks(self, tree):
+        """
+        Yield ``(elem, is_tail, text_tokens, tags)`` tuples for all
+        text nodes of the tree, in document order.
+        """
+        for elem, is_tail in self._iter_text_nodes(tree):
+            text = elem.tail if is_tail else elem.text
+            tokens, tags = self._tokenize_and_split(text)
+            yield elem, is_tail, tokens, tags
+
+    def _iter_text_nodes(self, tree):
+        """
+        Yield ``(elem, is_tail)`` tuples for all text nodes of the tree
+        in document order: element text, then its children, then
+        element tail. Elements which are not tokenized are skipped
+        together with their children and tail.
+
+        An explicit stack is used instead of recursion, so every node
+        is yielded once regardless of its depth, and deeply nested
+        trees don't hit the recursion limit.
+        """
+        if self._is_ignored(tree):
             return
 
-        head_tokens, head_tags = self._tokenize_and_split(tree.text)
-        char_tokens = [t.chars for t in head_tokens]
-        for index, (token, tag) in enumerate(zip(head_tokens, head_tags)):
-            yield HtmlToken(index,
-                            char_tokens,
-                            tree,
-                            False,
-                            token.position,
-                            token.length), tag
-
-        for child in tree:  # where is my precious "yield from"?
-            for html_token, tag in self._process_tree(child):
-                yield html_token, tag
-
-        tail_tokens, tail_tags = self._tokenize_and_split(tree.tail)
-        char_tokens = [t.chars for t in tail_tokens]
-        for index, (token, tag) in enumerate(zip(tail_tokens, tail_tags)):
-            yield HtmlToken(index,
-                            char_tokens,
-                            tree,
-                            True,
-                            token.position,
-                            token.length), tag
+        yield tree, False
+        stack = [(tree, iter(tree))]
+        while stack:
+            elem, children = stack[-1]
+            for child in children:
+                if not self._is_ignored(child):
+                    yield child, False
+                    stack.append((child, iter(child)))
+                    break
+            else:
+                stack.pop()
+                yield elem, True
+
+    def _is_ignored(self, elem):
+        return not isinstance(elem.tag, str) or elem.tag in self.ignore_html_tags
 
     def cleanup_tree(self, tree):
-        cleaned = copy.deepcopy(tree)
+        cleaned = deepcopy(tree)
         for _, elem in iterwalk(cleaned):
             self._cleanup_elem(elem)
 
@@ -341,3 +791,18 @@ class HtmlTokenizer(object):
         if state['text_tokenize_func'] == 'DEFAULT':
             state['text_tokenize_func'] = tokenize
         self.__dict__.update(state)
+
+
+class _LoadAndTokenize(object):
+    """ Picklable function which loads and tokenizes a single document """
+    def __init__(self, html_tokenizer, loader):
+        self.html_tokenizer = html_tokenizer
+        self.loader = loader
+
+    def __call__(self, source):
+        if isinstance(source, six.binary_type):
+            tree = self.loader.loadbytes(source)
+        else:
+            tree = self.loader.load(source)
+        html_tokens, tags = self.html_tokenizer.tokenize_single(tree, copy=False)
+        return detach_html_tokens(html_tokens), tags
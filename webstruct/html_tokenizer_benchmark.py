@@ -1,8 +1,12 @@
+import sys
 import os.path
 import glob
 import timeit
 import functools
 
+import lxml.html
+from lxml.etree import SubElement
+
 import webstruct.webannotator
 import webstruct.html_tokenizer
 
@@ -10,6 +14,31 @@ def load_trees(tokenizer, trees):
     for tree in trees:
         tokenizer.tokenize_single(tree)
 
+def deep_tree(depth, text="foo bar baz"):
+    """
+    Create a synthetic tree of ``depth`` nested <div> elements;
+    each element has text and tail.
+    """
+    root = elem = lxml.html.Element('div')
+    root.text = text
+    for i in range(depth):
+        elem = SubElement(elem, 'div')
+        elem.text = text
+        elem.tail = text
+    return root
+
+def main_deep():
+    tokenizer = webstruct.html_tokenizer.HtmlTokenizer()
+    print("depth  tokens  seconds  us/token")
+    for depth in [250, 500, 1000, 2000, 4000, 8000]:
+        tree = deep_tree(depth)
+        n_tokens = len(tokenizer.tokenize_single(tree)[0])
+        seconds = timeit.timeit(functools.partial(load_trees, tokenizer, [tree]),
+                                setup='gc.enable()',
+                                number=3) / 3
+        print("%5d  %6d  %7.4f  %8.2f" % (depth, n_tokens, seconds,
+                                          seconds / n_tokens * 1e6))
+
 def main():
     path = os.path.join(os.path.dirname(__file__) ,
                         ".." ,
@@ -31,4 +60,8 @@ def main():
                         number=3))
 
 if __name__ == "__main__":
-    main()
+    # pass "deep" argument to benchmark deeply nested synthetic trees
+    if sys.argv[1:] == ['deep']:
+        main_deep()
+    else:
+        main()
@@ -23,22 +23,35 @@ Such trees can be processed with utilities from
 .. _GATE: http://gate.ac.uk/
 """
 from __future__ import absolute_import
+import os
 import re
 import glob
+import hashlib
+import tempfile
 from collections import defaultdict
 import six
+from six.moves import zip, range
 
 import lxml.html
 import lxml.html.clean
-from lxml.etree import ProcessingInstruction
-
-from webstruct.utils import human_sorted, html_document_fromstring
+from lxml import etree
+from lxml.etree import ProcessingInstruction, LXML_VERSION
+
+from webstruct.utils import (
+    human_sorted,
+    html_document_fromstring,
+    effective_n_jobs,
+    map_parallel,
+)
 from webstruct import webannotator
 
 
 class HtmlLoader(object):
     """
     Class for loading unannotated HTML files.
+
+    Loaded trees are cleaned using ``cleaner``; by default
+    :class:`HtmlCleaner` is used.
     """
     def __init__(self, encoding=None, cleaner=None):
         self.encoding = encoding
@@ -71,23 +84,76 @@ class WebAnnotatorLoader(HtmlLoader):
         # defer cleaning the tree to prevent custom cleaners from cleaning
         # WebAnnotator markup
         tree = html_document_fromstring(data, encoding=self.encoding)
-        webannotator.apply_wa_title(tree)
+        spans, wa_colors = self._find_wa_elements(tree)
         if self.known_entities:
-            self._prune_tags(tree)
-        entities = self._get_entities(tree)
+            spans = self._prune_tags(spans)
+        entities = self._get_entities(spans)
         self._process_entities(entities)
-        return self._cleanup_tree(tree)
+        for el in wa_colors:
+            el.drop_tree()
+        return self.cleaner.clean_html(tree)
 
-    def _prune_tags(self, tree):
+    def _find_wa_elements(self, tree):
+        """
+        Find WebAnnotator elements in a single pass over the tree and
+        apply ``<wa-title>`` (see :func:`webannotator.apply_wa_title`).
+        Return a list of ``<span>`` elements with WebAnnotator attributes,
+        in document order (as if they were found after ``<wa-title>``
+        is applied), and a list of ``<wa-color>`` elements.
+        """
+        spans, wa_colors = [], []
+        title = wa_title = None
+        title_start = wa_start = None
+        for el in tree.iter('span', 'title', 'wa-title', 'wa-color'):
+            tag = el.tag
+            if tag == 'span':
+                attrib = el.attrib
+                if 'wa-id' in attrib or 'wa-type' in attrib:
+                    spans.append(el)
+            elif tag == 'wa-color':
+                wa_colors.append(el)
+            elif tag == 'title':
+                if title is None:
+                    title, title_start = el, len(spans)
+            elif wa_title is None:
+                wa_title, wa_start = el, len(spans)
+
+        if wa_title is None:
+            return spans, wa_colors
+
+        wa_end = _descendants_end(wa_title, spans, wa_start)
+        if title is None:
+            wa_title.drop_tree()
+            return spans[:wa_start] + spans[wa_end:], wa_colors
+
+        # <wa-title> contents are moved to the place of <title>
+        title_end = _descendants_end(title, spans, title_start)
+        webannotator._replace_title(title, wa_title)
+        keys = {}
+        for i in range(len(spans)):
+            if wa_start <= i < wa_end:
+                keys[i] = (title_start, 0, i)
+            elif not title_start <= i < title_end:
+                keys[i] = (i, 1, i)
+        spans = [spans[i] for i in sorted(keys, key=keys.get)]
+        return spans, wa_colors
+
+    def _prune_tags(self, spans):
         """remove the element with wa-type not in ``known_entities``"""
-        for el in tree.xpath('//span[@wa-type]'):
-            if el.attrib['wa-type'] not in self.known_entities:
+        kept = []
+        for el in spans:
+            wa_type = el.get('wa-type')
+            if wa_type is not None and wa_type not in self.known_entities:
                 el.drop_tag()
+            else:
+                kept.append(el)
+        return kept
 
-    def _get_entities(self, tree):
+    def _get_entities(self, spans):
         entities = defaultdict(list)
-        for el in tree.xpath('//span[@wa-id]'):
-            entities[el.attrib['wa-id']].append(el)
+        for el in spans:
+            if 'wa-id' in el.attrib:
+                entities[el.attrib['wa-id']].append(el)
         return dict(entities)
 
     def _process_entities(self, entities):
@@ -98,10 +164,17 @@ class WebAnnotatorLoader(HtmlLoader):
             for el in elems:
                 el.drop_tag()
 
-    def _cleanup_tree(self, tree):
-        for el in tree.xpath('//wa-color'):
-            el.drop_tree()
-        return self.cleaner.clean_html(tree)
+
+def _descendants_end(elem, elems, start):
+    """
+    Return the index of the first element of ``elems[start:]`` which is not
+    a descendant of ``elem``; ``elems`` are in document order, and
+    descendants of ``elem`` start from ``elems[start]``.
+    """
+    for i in range(start, len(elems)):
+        if not any(a is elem for a in elems[i].iterancestors(elem.tag)):
+            return i
+    return len(elems)
 
 
 class GateLoader(HtmlLoader):
@@ -150,7 +223,8 @@ class GateLoader(HtmlLoader):
         return open_re, close_re
 
 
-def load_trees(pattern, loader, verbose=False):
+def load_trees(pattern, loader, verbose=False, n_jobs=1, cache_dir=None,
+               chunksize=16):
     """
     Load HTML data using loader ``loader`` from all files matched by
     ``pattern`` glob pattern.
@@ -159,14 +233,246 @@ def load_trees(pattern, loader, verbose=False):
 
     >>> trees = load_trees('path/*.html', HtmlLoader())  # doctest: +SKIP
 
+    Files can be loaded and cleaned in ``n_jobs`` worker processes
+    (-1 means "use all CPUs"); files are sent to workers in chunks
+    of ``chunksize`` files. lxml trees can't be passed between processes,
+    so workers return serialized trees which are parsed again in the
+    main process; this is still much cheaper than loading
+    and cleaning them.
+
+    If ``cache_dir`` is not None, serialized cleaned trees are stored
+    in this directory; they are keyed by file contents and loader
+    configuration (loader class, encoding, entities, cleaner options),
+    so repeated runs on the same data don't need to load and clean
+    the files again:
+
+    >>> trees = load_trees('path/*.html', HtmlLoader(),
+    ...                    n_jobs=-1, cache_dir='.trees-cache')  # doctest: +SKIP
+
+    Trees which can't be serialized and parsed back without changes
+    (this may happen with broken HTML) are never cached and are
+    loaded in the main process.
     """
-    for path in human_sorted(glob.glob(pattern)):
+    paths = human_sorted(glob.glob(pattern))
+    if effective_n_jobs(n_jobs) == 1 and cache_dir is None:
+        for path in paths:
+            if verbose:
+                print(path)
+            yield loader.load(path)
+        return
+
+    if cache_dir is not None and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    worker = _SerializedTreeLoader(loader, cache_dir)
+    for path, data in zip(paths, map_parallel(worker, paths, n_jobs, chunksize)):
         if verbose:
             print(path)
-        yield loader.load(path)
+        if data is None:
+            yield loader.load(path)
+        else:
+            yield _parse_serialized_tree(data)
+
+
+# Increment it when loaders start to produce different trees,
+# to invalidate load_trees caches.
+_TREE_CACHE_VERSION = 1
+
+
+class _SerializedTreeLoader(object):
+    """
+    Picklable function which loads a file using a loader and returns
+    the resulting tree serialized, or None if the tree can't be serialized.
+    Results are cached in ``cache_dir`` if it is not None.
+    """
+    def __init__(self, loader, cache_dir=None):
+        self.loader = loader
+        self.cache_dir = cache_dir
+        self.loader_key = _loader_cache_key(loader)
+
+    def __call__(self, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        cache_path = None
+        if self.cache_dir is not None:
+            key = hashlib.sha1(self.loader_key + data).hexdigest()
+            cache_path = os.path.join(self.cache_dir, key + '.html')
+            if os.path.exists(cache_path):
+                with open(cache_path, 'rb') as f:
+                    # empty file means the tree can't be serialized
+                    return f.read() or None
+
+        serialized = _serialize_tree(self.loader.loadbytes(data))
+        if cache_path is not None:
+            _write_file_atomic(cache_path, serialized or b'')
+        return serialized
+
+
+def _serialize_tree(tree):
+    """
+    Serialize a tree to bytes. Return None if the tree can't be parsed
+    back without changes.
+    """
+    data = lxml.html.tostring(tree, encoding='utf-8')
+    if lxml.html.tostring(_parse_serialized_tree(data), encoding='utf-8') != data:
+        return None
+    return data
+
+
+def _parse_serialized_tree(data):
+    return html_document_fromstring(data, encoding='utf-8')
+
+
+def _write_file_atomic(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # e.g. the file is already written by another process on Windows
+        os.unlink(tmp_path)
+
+
+def _loader_cache_key(loader):
+    """
+    Return a key (bytes) which identifies loader configuration;
+    loaders with the same key produce the same trees.
+    """
+    description = "%s|%s|%s" % (_TREE_CACHE_VERSION, LXML_VERSION,
+                                 _describe(loader))
+    return hashlib.sha1(description.encode('utf8')).hexdigest().encode('ascii')
+
+
+def _describe(value):
+    """
+    Return a stable text description of a loader or cleaner
+    configuration value (unlike repr, it doesn't contain object ids)::
+
+        >>> _describe({'b': [1, ProcessingInstruction], 'a': {'x'}})
+        "{'a': ['x'], 'b': [1, lxml.etree.ProcessingInstruction]}"
+    """
+    if isinstance(value, dict):
+        items = sorted((_describe(k), _describe(v)) for k, v in value.items())
+        return '{%s}' % ', '.join('%s: %s' % item for item in items)
+    if isinstance(value, (set, frozenset)):
+        return '[%s]' % ', '.join(sorted(_describe(v) for v in value))
+    if isinstance(value, (list, tuple)):
+        return '[%s]' % ', '.join(_describe(v) for v in value)
+    if hasattr(value, '__name__'):  # classes and functions
+        return '%s.%s' % (getattr(value, '__module__', None), value.__name__)
+    if hasattr(value, '__dict__'):
+        cls = type(value)
+        return '%s.%s(%s)' % (cls.__module__, cls.__name__,
+                              _describe(vars(value)))
+    return repr(value)
+
+
+class HtmlCleaner(object):
+    """
+    A fast cleaner which removes frames and embedded objects
+    from a tree, in place.
+
+    It produces the same trees as ``lxml.html.clean.Cleaner`` with
+    ``embedded=True``, ``frames=True`` and processing instructions killed,
+    all other options disabled (this is how webstruct loaders used
+    to clean trees), but it does all the work in a single pass and
+    doesn't copy the tree:
+
+    * frames (``<frameset>``, ``<frame>``, ``<noframes>``), ``<applet>``
+      elements, processing instructions and ``<param>`` elements outside
+      ``<applet>`` / ``<object>`` are removed with all their content;
+    * ``<iframe>``, ``<embed>``, ``<layer>``, ``<object>`` and remaining
+      ``<param>`` tags are removed, but their content is kept;
+    * comments which could be IE conditional comments are removed;
+    * ``<image>`` tags are renamed to ``<img>``.
+
+    >>> import lxml.html
+    >>> tree = lxml.html.fromstring(
+    ...     '<div><object><param name="x">foo</object>bar<applet>baz</applet></div>')
+    >>> lxml.html.tostring(HtmlCleaner().clean_html(tree)).decode()
+    '<div>foobar</div>'
+
+    Unlike ``lxml.html.clean.Cleaner``, ``clean_html`` modifies the tree
+    passed to it; doctype and comments outside the root element
+    are preserved.
+    """
+    kill_tags = frozenset(['applet', 'frameset', 'frame', 'noframes',
+                           ProcessingInstruction])
+    remove_tags = frozenset(['iframe', 'embed', 'layer', 'object'])
+
+    def clean_html(self, tree):
+        try:
+            root = tree.getroot()
+        except AttributeError:
+            root = tree  # Element instance, not ElementTree
+        kill, remove = [], []
+        tags = self.kill_tags | self.remove_tags | {
+            'param', 'image', etree.Comment, _XHTML_TAGS}
+        # Elements are only collected here; the tree is changed later.
+        # Elements inside killed subtrees are collected as well,
+        # removing them is harmless.
+        for el in root.iter(*tags):
+            tag = el.tag
+            if tag is etree.Comment:
+                if _is_conditional_comment(el.text):
+                    kill.append(el)
+            elif tag in self.kill_tags:
+                kill.append(el)
+            elif tag in self.remove_tags:
+                remove.append(el)
+            elif tag == 'param':
+                if _has_embedding_ancestor(el):
+                    remove.append(el)
+                else:
+                    kill.append(el)
+            elif tag == 'image':
+                el.tag = 'img'
+            else:
+                el.tag = tag[len(_XHTML_PREFIX):]
+
+        if remove and remove[0] is root:
+            # the root element can't be dropped
+            del remove[0]
+            root.tag = 'div'
+            root.attrib.clear()
+        elif kill and kill[0] is root:
+            del kill[0]
+            root.tag = 'div'
+            root.clear()
+
+        for el in kill:
+            el.drop_tree()
+        for el in reversed(remove):
+            el.drop_tag()
+        return tree
+
+
+_XHTML_PREFIX = '{http://www.w3.org/1999/xhtml}'
+_XHTML_TAGS = _XHTML_PREFIX + '*'
+
+
+# the same regex as in lxml.html.clean
+_is_conditional_comment = re.compile(
+    r'\[if[\s\n\r]+.*?][\s\n\r]*>', re.I | re.S).search
+
+
+def _has_embedding_ancestor(el):
+    for _ in el.iterancestors('applet', 'object'):
+        return True
+    return False
 
 
 def _get_default_cleaner():
+    return HtmlCleaner()
+
+
+def _get_lxml_cleaner():
+    """
+    Return ``lxml.html.clean.Cleaner`` which cleans trees the same way
+    as :class:`HtmlCleaner`.
+    """
     return lxml.html.clean.Cleaner(
         scripts=False,     # non-default: preserve scripts
         javascript=False,  # non-default: keep external stylesheets
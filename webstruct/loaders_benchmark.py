@@ -0,0 +1,44 @@
+import os.path
+import glob
+import timeit
+import functools
+
+import webstruct.loaders
+from webstruct.utils import html_document_fromstring
+
+class NoopCleaner(object):
+    def clean_html(self, tree):
+        return tree
+
+def clean_trees(cleaner, datas):
+    for data in datas:
+        cleaner.clean_html(html_document_fromstring(data))
+
+def main():
+    path = os.path.join(os.path.dirname(__file__) ,
+                        ".." ,
+                        "webstruct_data",
+                        "corpus/business_pages/wa/*.html")
+
+    paths = sorted(glob.glob(path))
+    datas = []
+    for p in paths:
+        with open(p, 'rb') as reader:
+            datas.append(reader.read())
+
+    parse_seconds = timeit.timeit(
+        functools.partial(clean_trees, NoopCleaner(), datas),
+        setup='gc.enable()',
+        number=3) / 3
+    print("parsing only:            %.3fs" % parse_seconds)
+
+    for name, cleaner in [("lxml.html.clean.Cleaner", webstruct.loaders._get_lxml_cleaner()),
+                          ("HtmlCleaner", webstruct.loaders.HtmlCleaner())]:
+        seconds = timeit.timeit(functools.partial(clean_trees, cleaner, datas),
+                                setup='gc.enable()',
+                                number=3) / 3
+        print("%-24s %.3fs (cleaning: %.3fs)" % (name + ":", seconds,
+                                                 seconds - parse_seconds))
+
+if __name__ == "__main__":
+    main()
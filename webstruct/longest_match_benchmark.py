@@ -0,0 +1,165 @@
+"""
+Benchmark for :class:`webstruct.utils.LongestMatch`.
+
+Usage::
+
+    python -m webstruct.longest_match_benchmark [gazetteer.marisa ...]
+
+Gazetteers should be ``marisa_trie.RecordTrie`` files created by
+:func:`webstruct.gazetteers.geonames.to_marisa`. Each gazetteer is
+benchmarked as a marisa trie and (if it is not too large) as a set
+of names; without arguments a synthetic lexicon is used.
+Documents are tokenized pages from webstruct_data corpus.
+The previous implementation (a lookup of every token range) is timed
+as well, and results are checked to be the same.
+
+:class:`~webstruct.utils.MultiLongestMatch` for all lexicons
+is compared with separate :class:`~webstruct.utils.LongestMatch`
+instances as well.
+"""
+from __future__ import print_function
+import sys
+import os.path
+import glob
+import random
+import timeit
+import functools
+
+import webstruct.webannotator
+from webstruct import HtmlTokenizer
+from webstruct.utils import LongestMatch, MultiLongestMatch
+from webstruct.gazetteers.geonames import GAZETTEER_FORMAT
+
+
+# sets are created only for gazetteers with fewer names
+MAX_SET_SIZE = 2000000
+
+
+class ReferenceLongestMatch(LongestMatch):
+    """ LongestMatch without a trie and with set-based overlap removal """
+
+    def _find_matches(self, tokens):
+        return self._find_joined_matches(tokens)
+
+    def _remove_overlapping(self, ranges, tokens):
+        res = []
+        filled_indices = set()
+        for begin, end, lookup in self.get_sorted_ranges(ranges, tokens):
+            indices = set(range(begin, end))
+            if not indices & filled_indices:
+                res.append((begin, end, lookup))
+                filled_indices |= indices
+        return res
+
+
+def find_all(matcher, docs):
+    return [matcher.find_ranges(tokens) for tokens in docs]
+
+
+def load_documents():
+    path = os.path.join(os.path.dirname(__file__),
+                        "..",
+                        "webstruct_data",
+                        "corpus/business_pages/wa/*.html")
+    paths = sorted(glob.glob(path))
+    with open(paths[0], 'rb') as sample_reader:
+        colors = webstruct.webannotator.EntityColors.from_htmlbytes(sample_reader.read())
+        entities = [typ for typ in colors]
+
+    loader = webstruct.WebAnnotatorLoader(known_entities=entities)
+    tokenizer = HtmlTokenizer()
+    docs = []
+    for p in paths:
+        html_tokens, tags = tokenizer.tokenize_single(loader.load(p))
+        docs.append([tok.token for tok in html_tokens])
+    return docs
+
+
+def synthetic_lexicon(docs, size=200000, max_length=8, seed=0):
+    """
+    Create a lexicon of random token sequences from documents;
+    some of them occur in documents.
+    """
+    rnd = random.Random(seed)
+    words = sorted(set(tok for tokens in docs for tok in tokens))
+    lexicon = set()
+    while len(lexicon) < size:
+        if rnd.random() < 0.1:
+            tokens = rnd.choice(docs)
+            start = rnd.randrange(len(tokens))
+            length = rnd.randint(1, max_length)
+            name = " ".join(tokens[start:start+length])
+        else:
+            length = rnd.randint(1, max_length)
+            name = " ".join(rnd.choice(words) for _ in range(length))
+        lexicon.add(name)
+    return lexicon
+
+
+def benchmark(name, known, docs):
+    matcher = LongestMatch(known)
+    reference = ReferenceLongestMatch(known)
+    if find_all(matcher, docs) != find_all(reference, docs):
+        raise AssertionError("%s: results are different" % name)
+
+    n_tokens = sum(len(tokens) for tokens in docs)
+    times = []
+    for m in [reference, matcher]:
+        seconds = min(timeit.repeat(functools.partial(find_all, m, docs),
+                                    setup='gc.enable()', number=1, repeat=3))
+        times.append(seconds)
+    print("%-40s %6d  %8.3f  %8.3f  %6.1fx" % (
+        name[-40:], matcher.max_length, times[0], times[1],
+        times[0] / times[1]))
+    print("%-40s %6s  %8.2f  %8.2f  us/token" % (
+        '', '', times[0] / n_tokens * 1e6, times[1] / n_tokens * 1e6))
+
+
+def find_all_separately(matchers, docs):
+    return [[m.find_ranges(tokens) for m in matchers] for tokens in docs]
+
+
+def benchmark_multi(lexicons, docs):
+    matchers = [LongestMatch(known) for known in lexicons]
+    multi_matcher = MultiLongestMatch(lexicons)
+    if find_all_separately(matchers, docs) != find_all(multi_matcher, docs):
+        raise AssertionError("MultiLongestMatch results are different")
+
+    separate = min(timeit.repeat(
+        functools.partial(find_all_separately, matchers, docs),
+        setup='gc.enable()', number=1, repeat=3))
+    multi = min(timeit.repeat(
+        functools.partial(find_all, multi_matcher, docs),
+        setup='gc.enable()', number=1, repeat=3))
+    print("%d lexicons: separately %.3fs, MultiLongestMatch %.3fs (%.1fx)" % (
+        len(lexicons), separate, multi, separate / multi))
+
+
+def main():
+    docs = load_documents()
+    print("%d documents, %d tokens" % (len(docs), sum(len(t) for t in docs)))
+    print("%-40s %6s  %8s  %8s  %7s" % ('lexicon', 'max_len', 'old, s',
+                                         'new, s', 'speedup'))
+
+    filenames = sys.argv[1:]
+    if not filenames:
+        benchmark('synthetic (set)', synthetic_lexicon(docs), docs)
+        benchmark_multi([synthetic_lexicon(docs, size=40000, seed=seed)
+                         for seed in range(5)], docs)
+        return
+
+    import marisa_trie
+    tries = []
+    for filename in filenames:
+        trie = marisa_trie.RecordTrie(GAZETTEER_FORMAT)
+        trie.load(filename)
+        tries.append(trie)
+        benchmark(filename + ' (marisa)', trie, docs)
+        if len(trie) <= MAX_SET_SIZE:
+            benchmark(filename + ' (set)', set(trie.iterkeys()), docs)
+    if len(tries) > 1:
+        benchmark_multi(tries, docs)
+
+
+if __name__ == "__main__":
+    main()
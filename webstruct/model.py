@@ -63,7 +63,10 @@ class NER(object):
         Return a list of ``(html_token, iob2_tag)`` tuples.
         """
         tree = self.loader.loadbytes(bytes_data)
-        html_tokens, _ = self.html_tokenizer.tokenize_single(tree)
+        # the tree is not used anywhere else, so there is no need to copy it;
+        # input HTML is not annotated, so annotation processing is skipped
+        html_tokens = self.html_tokenizer.tokenize_single_unannotated(
+            tree, copy=False)
         tags = self.model.predict([html_tokens])[0]
         return html_tokens, tags
 
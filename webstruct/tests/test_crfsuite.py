@@ -8,6 +8,7 @@ import tempfile
 import webstruct
 from webstruct.features import EXAMPLE_TOKEN_FEATURES
 from webstruct.crfsuite import create_crfsuite_pipeline
+from webstruct.feature_encoding import FeatureVocabulary, FeatureHasher
 from webstruct.metrics import bio_classification_report
 from webstruct.model import NER
 from webstruct.utils import train_test_split_noshuffle
@@ -68,6 +69,15 @@ class CRFsuiteTest(unittest.TestCase):
 
         self.assertRaises(ValueError, model.fit, X_train, y_train, X_dev=X_dev)
         self.assertRaises(ValueError, model.fit, X_train, y_train, y_dev=y_dev)
+        self.assertRaises(ValueError, model.fit, X_train, y_train,
+                          X_dev=X_dev, y_dev=y_dev, foo=1)
+
+    def test_devdata_fit_transform(self):
+        X_train, X_dev, y_train, y_dev = self._get_train_test(8, 4)
+        model = self.get_pipeline(feature_encoder=FeatureVocabulary(), min_df=2)
+        Xt = model.fit_transform(X_train, y_train, X_dev=X_dev, y_dev=y_dev)
+        self.assertEqual(len(Xt), len(X_train))
+        assert model.crf.training_log_.last_iteration['avg_f1'] > 0.3
 
     def test_pickle(self):
         X_train, X_test, y_train, y_test = self._get_train_test(8, 2)
@@ -170,3 +180,39 @@ class CRFsuiteTest(unittest.TestCase):
         groups = ner2.extract_groups(html, dont_penalize={'TEL', 'FAX'})
         self.assertIn(group1, groups)
         self.assertIn(group2, groups)
+
+    def test_feature_encoder(self):
+        X_train, X_test, y_train, y_test = self._get_train_test(8, 2)
+        model = self.get_pipeline()
+        model.fit(X_train, y_train)
+        y_pred = model.predict(X_test)
+
+        for encoder in [FeatureVocabulary(), FeatureHasher()]:
+            encoded_model = self.get_pipeline(feature_encoder=encoder)
+            self.assertEqual(len(encoded_model.steps), 3)
+            encoded_model.fit(X_train, y_train, X_dev=X_test, y_dev=y_test)
+            self.assertEqual(
+                [list(tags) for tags in encoded_model.predict(X_test)],
+                [list(tags) for tags in y_pred]
+            )
+
+    def test_skip_unused_features(self):
+        X_train, X_test, y_train, y_test = self._get_train_test(8, 2)
+        for encoder in [None, FeatureVocabulary()]:
+            model = self.get_pipeline(feature_encoder=encoder, c1=5)
+            model.fit(X_train, y_train)
+            y_pred = model.predict(X_test)
+            n_features = sum(len(fd) for fd in model.fe.transform_single(X_test[0]))
+
+            model.skip_unused_features()
+            self.assertTrue(model.fe.used_features_)
+            self.assertEqual([list(tags) for tags in model.predict(X_test)],
+                             [list(tags) for tags in y_pred])
+            self.assertLess(
+                sum(len(fd) for fd in model.fe.transform_single(X_test[0])),
+                n_features
+            )
+
+            # refitting removes the restriction
+            model.fit(X_train, y_train)
+            self.assertIsNone(model.fe.used_features_)
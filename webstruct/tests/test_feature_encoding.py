@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import pickle
+import unittest
+
+import pycrfsuite
+
+from webstruct import HtmlTokenizer, HtmlFeatureExtractor
+from webstruct.crfsuite import to_item_sequence
+from webstruct.feature_encoding import (
+    EncodedDocument,
+    FeatureVocabulary,
+    FeatureHasher,
+)
+from webstruct.features import EXAMPLE_TOKEN_FEATURES
+from webstruct.wapiti import WapitiObservationEncoder
+from .utils import get_trees
+
+
+def crfsuite_items(X, feature_names=None):
+    """ Feature dicts of documents in python-crfsuite format """
+    res = []
+    for doc in X:
+        seq = to_item_sequence(doc)
+        if not isinstance(seq, pycrfsuite.ItemSequence):
+            seq = pycrfsuite.ItemSequence(seq)
+        items = seq.items()
+        if feature_names is not None:
+            items = [{feature_names[int(k)]: v for k, v in item.items()}
+                     for item in items]
+        res.append(items)
+    return res
+
+
+class FeatureEncodingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.X, _ = HtmlTokenizer().tokenize(get_trees(5))
+
+    def test_vocabulary(self):
+        for min_df in [1, 3]:
+            fe = HtmlFeatureExtractor(EXAMPLE_TOKEN_FEATURES, min_df=min_df)
+            X_dicts = fe.fit_transform(self.X)
+            expected = crfsuite_items(X_dicts)
+
+            vocab = FeatureVocabulary()
+            fe = HtmlFeatureExtractor(EXAMPLE_TOKEN_FEATURES, min_df=min_df,
+                                      feature_encoder=vocab)
+            X = fe.fit_transform(self.X)
+            self.assertIsInstance(X[0], EncodedDocument)
+            self.assertEqual([len(doc) for doc in X], [len(doc) for doc in self.X])
+            self.assertEqual(crfsuite_items(X, vocab.feature_names_), expected)
+            self.assertEqual(fe.transform(self.X), X)
+
+            # streaming fit
+            names = vocab.feature_names_
+            fe.fit(iter(self.X))
+            self.assertEqual(sorted(vocab.feature_names_), sorted(names))
+            X = fe.transform(self.X)
+            self.assertEqual(crfsuite_items(X, vocab.feature_names_), expected)
+
+    def test_unknown_features(self):
+        fe = HtmlFeatureExtractor(EXAMPLE_TOKEN_FEATURES,
+                                  feature_encoder=FeatureVocabulary())
+        self.assertRaises(ValueError, fe.transform, self.X)
+        fe.fit(self.X[:1])
+        X_dicts = HtmlFeatureExtractor(EXAMPLE_TOKEN_FEATURES).transform(self.X[1:])
+        X = fe.transform(self.X[1:])
+        self.assertLess(len(X[0].ids), sum(len(fd) for fd in X_dicts[0]))
+
+    def test_hashing(self):
+        hasher = FeatureHasher(n_features=2 ** 24)
+        fe = HtmlFeatureExtractor(EXAMPLE_TOKEN_FEATURES, feature_encoder=hasher)
+        X = fe.fit_transform(self.X)
+        X_dicts = HtmlFeatureExtractor(EXAMPLE_TOKEN_FEATURES).transform(self.X)
+        self.assertEqual(sum(len(doc.ids) for doc in X),
+                         sum(len(fd) for doc in X_dicts for fd in doc))
+        self.assertEqual(pickle.loads(pickle.dumps(fe)).transform(self.X), X)
+
+        # ids are limited by n_features; collided values are summed
+        fe.set_params(feature_encoder=FeatureHasher(n_features=1))
+        items = crfsuite_items(fe.transform(self.X[:1]))[0]
+        self.assertEqual(set(items[0]), {'0'})
+
+    def test_nested_values(self):
+        X = [[{'a': ['x', 'y'], 'b': {'c': 2.0, 'd': 'z', 'e': {'f': 1}},
+               'g': True, 'h': 3}]]
+        expected = crfsuite_items(X)
+        vocab = FeatureVocabulary()
+        self.assertEqual(crfsuite_items(vocab.fit_transform(X), vocab.feature_names_),
+                         expected)
+        self.assertEqual(len(FeatureHasher().transform_single(X[0]).ids),
+                         len(expected[0][0]))
+
+        for value in [[1.0], None, object()]:
+            self.assertRaises(ValueError, vocab.transform_single, [{'a': value}])
+
+    def test_wapiti_observations(self):
+        vocab = FeatureVocabulary()
+        fe = HtmlFeatureExtractor(EXAMPLE_TOKEN_FEATURES, feature_encoder=vocab)
+        X = fe.fit_transform(self.X[:1])
+        lines = WapitiObservationEncoder().transform(X)[0]
+        self.assertEqual(len(lines), len(self.X[0]))
+        for line, (ids, values) in zip(lines, X[0]):
+            observations = line.split()
+            self.assertEqual(observations[0], '*')
+            self.assertEqual(len(observations), len(ids) + 1)
+
+        # float values are written with full precision
+        doc = vocab.transform_single([{'bias': 0.1234567}, {'bias': 0.1234568}])
+        lines = WapitiObservationEncoder().transform_single(doc)
+        self.assertEqual(len(set(lines)), 2)
+        self.assertTrue(lines[0].endswith('=0.1234567'))
+
+    def test_vocabulary_params(self):
+        vocab = FeatureVocabulary()
+        self.assertFalse(hasattr(vocab, 'vocabulary_'))
+        self.assertEqual(vocab.get_params(), {})
+        vocab.fit([[{'token': 'foo'}]])
+        self.assertEqual(vocab.feature_names_, ['token:foo'])
+        vocab.reset()
+        self.assertFalse(hasattr(vocab, 'feature_names_'))
+        self.assertRaises(ValueError, vocab.transform_single, [{'token': 'foo'}])
@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import pickle
+import unittest
+from collections import Counter
+from six.moves import range, zip
+
+from webstruct import HtmlToken, HtmlTokenizer, HtmlFeatureExtractor
+from webstruct.feature_extraction import _CombinedFeatures, _FeaturePlan, _ProfiledFill
+from webstruct.feature_encoding import FeatureVocabulary
+from webstruct.features import (
+    EXAMPLE_TOKEN_FEATURES,
+    PrefixFeatures,
+    SuffixFeatures,
+    looks_like_time,
+    looks_like_weekday,
+    looks_like_range,
+    token_identity,
+    bias,
+    InsideTag,
+    Pattern,
+)
+from webstruct.features.utils import (
+    token_feature,
+    constant,
+    get_feature_scope,
+    FeatureFunction,
+    CONSTANT_SCOPE,
+)
+from webstruct.features.lexical_features import LexicalFeatures, _SUPPORTED_FUNCS
+from .utils import get_trees
+
+
+def upper_token(html_token):
+    return {'token': html_token.token.upper(), 'is_upper': html_token.token.isupper()}
+
+
+TOKEN_FEATURES = EXAMPLE_TOKEN_FEATURES + [
+    PrefixFeatures(lenghts=(1, 5)),
+    SuffixFeatures(featname='suf', lower=False),
+    looks_like_time,
+    looks_like_weekday,
+    looks_like_range,
+    upper_token,  # regular function which overrides a feature
+    token_identity,
+]
+
+
+class FeaturePlanTest(unittest.TestCase):
+
+    def test_same_features(self):
+        html_tokens, _ = HtmlTokenizer().tokenize(get_trees(3))
+        combined = _CombinedFeatures(*TOKEN_FEATURES)
+        plan = _FeaturePlan(TOKEN_FEATURES)
+        for doc in html_tokens:
+            for tok in doc:
+                expected, features = combined(tok), plan(tok)
+                # key order must be the same as well
+                self.assertEqual(list(features.items()), list(expected.items()))
+
+    def test_feature_function(self):
+        for func in TOKEN_FEATURES:
+            if isinstance(func, FeatureFunction):
+                self.assertIs(pickle.loads(pickle.dumps(func)), func)
+            if func is not upper_token:
+                self.assertTrue(func.feature_keys)
+
+        self.assertEqual(InsideTag('a').feature_keys, ('inside_tag_a',))
+        self.assertEqual(token_identity.__name__, 'token_identity')
+
+    def test_extractor_pickle(self):
+        fe = HtmlFeatureExtractor(token_features=EXAMPLE_TOKEN_FEATURES)
+        X, _ = HtmlTokenizer().tokenize(get_trees(1))
+        fe2 = pickle.loads(pickle.dumps(fe))
+        self.assertEqual(fe2.fit_transform(X), fe.fit_transform(X))
+
+
+@token_feature()
+def _no_keys(html_token, features):
+    features['foo'] = 1
+
+
+def test_token_feature_without_keys():
+    assert _no_keys.feature_keys is None
+    assert _no_keys(None) == {'foo': 1}
+
+
+class ElementScopedFeaturesTest(unittest.TestCase):
+
+    def test_same_features(self):
+        trees = get_trees(3)
+        tokenizer = HtmlTokenizer()
+        X, _ = tokenizer.tokenize(trees)
+        batches = [tokenizer.tokenize_single_batch(tree)[0] for tree in trees]
+        combined = _CombinedFeatures(*TOKEN_FEATURES)
+        expected = [[list(combined(tok).items()) for tok in doc] for doc in X]
+
+        fe = HtmlFeatureExtractor(TOKEN_FEATURES)
+        for docs in [X, batches]:
+            features = [[list(fd.items()) for fd in doc]
+                        for doc in fe.transform(docs)]
+            self.assertEqual(features, expected)
+
+    def test_memo_is_cleared(self):
+        X, _ = HtmlTokenizer().tokenize(get_trees(1))
+        plan = _FeaturePlan(EXAMPLE_TOKEN_FEATURES)
+        self.assertEqual(len(plan.element_runs), 2)
+        plan.document_features(X[0])
+        self.assertEqual([run.memo for run in plan.element_runs], [{}, {}])
+
+
+@constant
+@token_feature('const')
+def _const(html_token, features):
+    _const.calls += 1
+    features['const'] = 1
+
+
+class ConstantFeaturesTest(unittest.TestCase):
+
+    def test_computed_once(self):
+        self.assertEqual(get_feature_scope(bias), CONSTANT_SCOPE)
+        _const.calls = 0
+        trees = get_trees(2)
+        tokenizer = HtmlTokenizer()
+        X, _ = tokenizer.tokenize(trees)
+        batches = [tokenizer.tokenize_single_batch(tree)[0] for tree in trees]
+        fe = HtmlFeatureExtractor([_const, token_identity])
+        for docs in [X, batches]:
+            for doc, html_tokens in zip(fe.transform(docs), X):
+                self.assertEqual(doc, [{'const': 1, 'token': tok.token}
+                                       for tok in html_tokens])
+        self.assertEqual(_const.calls, 1)
+
+
+class TokenCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.X, _ = HtmlTokenizer().tokenize(get_trees(3))
+
+    def test_same_features(self):
+        expected = HtmlFeatureExtractor(TOKEN_FEATURES, token_cache_size=0).transform(self.X)
+        for size in [1, 100, 10000]:
+            fe = HtmlFeatureExtractor(TOKEN_FEATURES, token_cache_size=size)
+            for i in range(2):
+                X = fe.transform(self.X)
+                self.assertEqual(
+                    [[list(fd.items()) for fd in doc] for doc in X],
+                    [[list(fd.items()) for fd in doc] for doc in expected]
+                )
+
+    def test_cache_info(self):
+        fe = HtmlFeatureExtractor(TOKEN_FEATURES, token_cache_size=100)
+        self.assertEqual(fe.token_cache_info(), (0, 0, 100, 0))
+        fe.transform(self.X)
+        info = fe.token_cache_info()
+        n_tokens = sum(len(doc) for doc in self.X)
+        # there are 2 groups of token-pure functions in TOKEN_FEATURES
+        self.assertEqual(info.hits + info.misses, n_tokens * 2)
+        self.assertGreater(info.hits, 0)
+        self.assertEqual(info.currsize, 100)
+
+        # cache is kept between calls
+        fe.transform(self.X[:1])
+        self.assertGreater(fe.token_cache_info().hits, info.hits)
+
+        # ... but not when features change
+        fe.set_params(token_features=EXAMPLE_TOKEN_FEATURES)
+        fe.transform(self.X[:1])
+        self.assertEqual(fe.token_cache_info().hits + fe.token_cache_info().misses,
+                         len(self.X[0]))
+
+        fe = pickle.loads(pickle.dumps(fe))
+        self.assertEqual(fe.token_cache_info(), (0, 0, 100, 0))
+
+        fe.set_params(token_cache_size=0)
+        fe.transform(self.X[:1])
+        self.assertEqual(fe.token_cache_info(), (0, 0, 0, 0))
+
+
+class ParallelTransformTest(unittest.TestCase):
+
+    def setUp(self):
+        self.X, _ = HtmlTokenizer().tokenize(get_trees(5))
+
+    def _extractor(self, **kwargs):
+        return HtmlFeatureExtractor(
+            token_features=TOKEN_FEATURES,
+            global_features=[Pattern((-1, 'token'), (0, 'token'))],
+            **kwargs
+        )
+
+    def test_same_features(self):
+        for min_df in [1, 2]:
+            expected = self._extractor(min_df=min_df).fit_transform(self.X)
+            fe = self._extractor(min_df=min_df, n_jobs=2)
+            fe._parallel_chunksize = 2
+            self.assertEqual(fe.fit_transform(self.X), expected)
+            self.assertEqual(fe.fit_transform(iter(self.X)), expected)
+
+        fe = self._extractor(n_jobs=2)
+        self.assertEqual(fe.transform(self.X[:1]), self._extractor().transform(self.X[:1]))
+        self.assertEqual(fe.transform([]), [])
+
+
+class MinDfTest(unittest.TestCase):
+
+    def setUp(self):
+        self.X, _ = HtmlTokenizer().tokenize(get_trees(5))
+
+    def _pruned(self, X, low):
+        df = Counter()
+        for doc in X:
+            df.update(set(item for fd in doc for item in fd.items()))
+        return [
+            [{k: v for k, v in fd.items() if df[k, v] >= low} for fd in doc]
+            for doc in X
+        ]
+
+    def test_fit_transform(self):
+        X = HtmlFeatureExtractor(TOKEN_FEATURES).transform(self.X)
+        expected = self._pruned(X, 3)
+        fe = HtmlFeatureExtractor(TOKEN_FEATURES, min_df=3)
+        self.assertEqual(fe.fit_transform(self.X), expected)
+        self.assertEqual(fe.transform(self.X), expected)
+        self.assertEqual(list(fe.iter_transform(iter(self.X))), expected)
+
+        fe = HtmlFeatureExtractor(TOKEN_FEATURES, min_df=3)
+        self.assertIs(fe.fit(iter(self.X)), fe)
+        self.assertEqual(fe.transform(self.X), expected)
+
+        fe.set_params(min_df=1)
+        self.assertEqual(fe.fit(self.X).transform(self.X), X)
+
+    def test_vocabulary_order(self):
+        for min_df in [1, 3]:
+            fe1 = HtmlFeatureExtractor(TOKEN_FEATURES, min_df=min_df,
+                                       feature_encoder=FeatureVocabulary())
+            fe2 = HtmlFeatureExtractor(TOKEN_FEATURES, min_df=min_df,
+                                       feature_encoder=FeatureVocabulary())
+            fe1.fit(self.X)
+            X = fe2.fit_transform(self.X)
+            self.assertEqual(fe1.feature_encoder.feature_names_,
+                             fe2.feature_encoder.feature_names_)
+            self.assertEqual(fe1.transform(self.X), X)
+
+    def test_sketch(self):
+        expected = HtmlFeatureExtractor(TOKEN_FEATURES, min_df=2).fit_transform(self.X)
+        fe = HtmlFeatureExtractor(TOKEN_FEATURES, min_df=2, df_sketch_width=2**20)
+        self.assertEqual(fe.fit_transform(self.X), expected)
+        self.assertEqual(fe.fit(self.X).transform(self.X), expected)
+
+        # frequent features are never removed
+        X = HtmlFeatureExtractor(TOKEN_FEATURES, min_df=2, df_sketch_width=10).fit_transform(self.X)
+        for doc, expected_doc in zip(X, expected):
+            for fd, expected_fd in zip(doc, expected_doc):
+                self.assertLessEqual(set(expected_fd.items()), set(fd.items()))
+
+
+class ProfileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.X, _ = HtmlTokenizer().tokenize(get_trees(3))
+
+    def _extractor(self, **kwargs):
+        return HtmlFeatureExtractor(
+            token_features=TOKEN_FEATURES,
+            global_features=[Pattern((-1, 'token')), Pattern((1, 'token'))],
+            **kwargs
+        )
+
+    def test_report(self):
+        fe = self._extractor(profile=True, token_cache_size=0)
+        X = fe.transform(self.X)
+        self.assertEqual(X, self._extractor().transform(self.X))
+
+        report = fe.profile_report()
+        n_tokens = sum(len(doc) for doc in self.X)
+        n_features = sum(len(fd) for doc in X for fd in doc)
+        self.assertEqual((report.documents, report.tokens, report.features),
+                         (len(self.X), n_tokens, n_features))
+        self.assertAlmostEqual(report.features_per_token, n_features / float(n_tokens))
+
+        stats = report.feature_stats
+        self.assertEqual([st.kind for st in stats],
+                         ['token'] * len(TOKEN_FEATURES) + ['global'] * 2)
+        self.assertEqual(stats[0].name, 'bias')
+        self.assertEqual(stats[-1].name, 'Pattern(token[+1])')
+        self.assertTrue(all(0 < st.calls <= n_tokens for st in stats[:-2]))
+        self.assertTrue(all(st.calls == len(self.X) for st in stats[-2:]))
+        identity_stats = stats[TOKEN_FEATURES.index(token_identity)]
+        self.assertEqual(identity_stats.name, 'token_identity')
+        self.assertEqual(identity_stats.calls, n_tokens)
+        self.assertEqual(identity_stats.emitted, n_tokens)
+        self.assertEqual(stats[-1].emitted,
+                         sum('token[+1]' in fd for doc in X for fd in doc))
+        self.assertIn('features per token', str(report))
+
+        # statistics are accumulated
+        fe.transform(self.X)
+        self.assertEqual(fe.profile_report().documents, 2 * len(self.X))
+
+    def test_parallel(self):
+        fe = self._extractor(profile=True, n_jobs=2)
+        fe.transform(self.X)
+        report = fe.profile_report()
+        self.assertEqual(report.documents, len(self.X))
+        self.assertEqual(report.feature_stats[-1].calls, len(self.X))
+
+    def test_disabled(self):
+        fe = self._extractor()
+        fe.transform(self.X)
+        self.assertIsNone(fe.profile_report())
+        self.assertIsNone(fe._plan.profiler)
+        self.assertNotIsInstance(fe._plan.fills[0], _ProfiledFill)
+
+
+class UsedFeaturesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.X, _ = HtmlTokenizer().tokenize(get_trees(3))
+
+    def _extractor(self):
+        return HtmlFeatureExtractor(
+            token_features=TOKEN_FEATURES,
+            global_features=[Pattern((-1, 'lower')), Pattern((1, 'shape'))],
+        )
+
+    def test_used_features(self):
+        fe = self._extractor()
+        X_full = fe.fit_transform(self.X)
+        used = {'lower[-1]', 'lower:hello', 'title', 'suf2:ly'}
+        fe.set_used_features(used)
+        X = fe.transform(self.X)
+
+        self.assertEqual(fe._plan.global_features[0].feature_keys, ('lower[-1]',))
+        self.assertLess(len(fe._plan.feature_funcs), len(TOKEN_FEATURES))
+        for doc, full_doc in zip(X, X_full):
+            for fd, full_fd in zip(doc, full_doc):
+                expected = {k: v for k, v in full_fd.items()
+                            if k in used or '%s:%s' % (k, v) in used}
+                self.assertEqual(fd, expected)
+        self.assertTrue(any('lower[-1]' in fd for doc in X for fd in doc))
+
+        fe.fit(self.X)
+        self.assertIsNone(fe.used_features_)
+        self.assertEqual(fe.transform(self.X), X_full)
+
+    def test_nested_values(self):
+        def nested(html_token):
+            return {
+                'words': [html_token.token.lower()],
+                'counts': {'len': len(html_token.token), 'tag': html_token.parent.tag},
+                'length': len(html_token.token),
+                'other': object,
+            }
+
+        fe = HtmlFeatureExtractor(token_features=[nested])
+        fe.set_used_features({'words:contact', 'counts:tag:p', 'length'})
+        X = fe.transform(self.X)
+        for doc, html_tokens in zip(X, self.X):
+            for fd, tok in zip(doc, html_tokens):
+                expected = {'length', 'other'}
+                if tok.token.lower() == 'contact':
+                    expected.add('words')
+                if tok.parent.tag == 'p':
+                    expected.add('counts')
+                self.assertEqual(set(fd), expected)
+        self.assertTrue(any('words' in fd for doc in X for fd in doc))
+        self.assertTrue(any('counts' in fd for doc in X for fd in doc))
+
+
+class LexicalFeaturesTest(unittest.TestCase):
+
+    def test_same_features(self):
+        funcs = sorted(_SUPPORTED_FUNCS, key=lambda f: f.__name__)
+        features = LexicalFeatures(*funcs)
+        expected_features = _CombinedFeatures(*funcs)
+        X, _ = HtmlTokenizer().tokenize(get_trees(5))
+        words = [u'Jan', u'OKT.', u'maandag', u'foo@example.com', u'12:30',
+                 u'1984', u'+12.5', u'Ave.', u'N.', u'©2014', u'Ünïcode', u'x2']
+        html_tokens = [tok for doc in X for tok in doc]
+        html_tokens += [HtmlToken(0, [word], None, False, 0, len(word))
+                        for word in words]
+        for tok in html_tokens:
+            self.assertEqual(features(tok), expected_features(tok))
+
+    def test_pickle(self):
+        features = LexicalFeatures(looks_like_time, looks_like_range)
+        restored = pickle.loads(pickle.dumps(features))
+        self.assertEqual(restored.feature_keys,
+                         ('looks_like_time', 'looks_like_range'))
+
+    def test_unsupported(self):
+        self.assertRaises(ValueError, LexicalFeatures, token_identity)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import io
+
+import pytest
+
+from webstruct.gazetteers.geonames import (
+    read_geonames,
+    build_gazetteer,
+    to_marisa,
+    _split_names_into_rows,
+)
+
+pd = pytest.importorskip("pandas")
+
+
+def _row(geonameid, name, asciiname, alternatenames, feature_code, country_code):
+    return u'\t'.join([
+        geonameid, name, asciiname, alternatenames, u'1.0', u'2.0', u'P',
+        feature_code, country_code, u'', u'NY', u'', u'', u'', u'0', u'',
+        u'0', u'America/New_York', u'2014-01-01',
+    ])
+
+
+GEONAMES = u'\n'.join([
+    _row(u'1', u'New York', u'New York', u'NYC,Nueva York,,New York', u'PPL', u'US'),
+    _row(u'2', u'Köln', u'Koln', u'Cologne', u'PPLA2', u'DE'),
+    _row(u'3', u'Albany', u'Albany', u'', u'PPLA', u'US'),
+    _row(u'4', u'New York', u'New York', u'', u'ADM1', u'US'),
+]) + u'\n'
+
+
+def _read(chunksize=None):
+    return read_geonames(io.StringIO(GEONAMES), chunksize=chunksize)
+
+
+def test_split_names_into_rows():
+    df = _split_names_into_rows(_read())
+    assert df.name.tolist() == [u'New York', u'NYC', u'Nueva York',
+                                u'Köln', u'Koln', u'Cologne',
+                                u'Albany', u'New York']
+    assert df.geonameid.tolist() == [1, 1, 1, 2, 2, 2, 3, 4]
+    assert 'alternatenames' not in df.columns
+
+
+def test_split_names_with_commas():
+    data = _row(u'5', u'Washington, D.C.', u'Washington, D.C.', u'DC',
+                u'PPLC', u'US') + u'\n'
+    df = _split_names_into_rows(read_geonames(io.StringIO(data)))
+    assert df.name.tolist() == [u'Washington', u' D.C.', u'DC']
+
+
+def test_build_gazetteer_marisa():
+    pytest.importorskip("marisa_trie")
+    trie = build_gazetteer(_read(chunksize=2))
+    assert sorted(trie.items()) == sorted(set(to_marisa(_read()).items()))
+    assert sorted(trie[u'New York']) == [
+        (b'US', b'P', b'ADM1\x00', b'NY', b'\x00\x00\x00'),
+        (b'US', b'P', b'PPL\x00\x00', b'NY', b'\x00\x00\x00'),
+    ]
+
+
+def test_build_gazetteer_dawg():
+    pytest.importorskip("dawg")
+    progress = []
+    gazetteer = build_gazetteer(
+        _read(chunksize=2),
+        kind='dawg',
+        filter_func=lambda df: df[df.country_code == 'US'],
+        lowercase=True,
+        progress=lambda n_rows, n_items: progress.append((n_rows, n_items)),
+    )
+    assert sorted(gazetteer.keys()) == [u'albany', u'new york', u'nueva york', u'nyc']
+    assert progress == [(2, 3), (4, 4)]
+
+
+def test_build_gazetteer_normalize():
+    pytest.importorskip("dawg")
+    from webstruct.features.global_features import strip_accents_lowercase
+    gazetteer = build_gazetteer([_read()], kind='dawg',
+                                normalize=strip_accents_lowercase)
+    assert u'koln' in gazetteer
+    assert u'Köln' not in gazetteer
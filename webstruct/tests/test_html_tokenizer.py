@@ -1,12 +1,25 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
+import os
+import glob
+import pickle
+import unittest
 from copy import deepcopy
 from lxml.html import tostring
-
-from webstruct.html_tokenizer import HtmlTokenizer
-from webstruct.loaders import GateLoader, HtmlLoader
+from lxml.etree import SubElement
+from six.moves import zip
+
+from webstruct.html_tokenizer import (
+    HtmlTokenizer,
+    HtmlTokenBatch,
+    DetachedElement,
+    detach_html_tokens,
+)
+from webstruct.feature_extraction import HtmlFeatureExtractor
+from webstruct.features import EXAMPLE_TOKEN_FEATURES, Pattern
+from webstruct.loaders import GateLoader, HtmlLoader, WebAnnotatorLoader
 from webstruct.utils import html_document_fromstring
-from .utils import HtmlTest
+from .utils import HtmlTest, DATA_PATH, get_trees
 
 
 GATE_HTML = b"""
@@ -102,6 +115,21 @@ class HtmlTokenizerTest(HtmlTest):
         self.assertHtmlTreeEqual(detokenized_tree, orig_src_tree)
         self.assertHtmlTreeEqual(detokenized_tree, src_tree)
 
+    def test_tokenize_deep_tree(self):
+        # deeper than the default recursion limit
+        depth = 3000
+        root = elem = html_document_fromstring(b'<div>a</div>').find('.//div')
+        for i in range(depth):
+            elem = SubElement(elem, 'div')
+            elem.text = 'b%s' % i
+            elem.tail = 'c%s' % i
+
+        html_tokens, tags = HtmlTokenizer().tokenize_single(root)
+        expected = (['a'] + ['b%s' % i for i in range(depth)] +
+                    ['c%s' % i for i in reversed(range(depth))])
+        self.assertEqual([t.token for t in html_tokens], expected)
+        self.assertEqual(set(tags), {'O'})
+
     def test_detokenize_single_empty(self):
         self.assertIs(HtmlTokenizer().detokenize_single([], []), None)
 
@@ -179,3 +207,172 @@ class HtmlTokenizerTest(HtmlTest):
         html_tokens, _ = tokenizer.tokenize_single(clean_tree)
         detokenized_tree = tokenizer.detokenize_single(html_tokens, tags)
         self.assertHtmlTreeEqual(annotated_tree, detokenized_tree)
+
+    def test_tokenize_single_nocopy(self):
+        tree = self._load()
+        tokenizer = HtmlTokenizer(replace_html_tags={'b': 'strong'})
+        html_tokens, tags = tokenizer.tokenize_single(tree, copy=False)
+
+        # tokens point to the original tree, and the tree is modified inplace
+        self.assertIs(html_tokens[0].root.getroot(), tree)
+        self.assertIn(b'<strong>', tostring(tree))
+
+        copied_tokens, copied_tags = tokenizer.tokenize_single(self._load())
+        self.assertEqual([t.token for t in html_tokens],
+                         [t.token for t in copied_tokens])
+        self.assertEqual(tags, copied_tags)
+
+    def test_detokenize_single_nocopy(self):
+        tokenizer = HtmlTokenizer()
+        html_tokens, tags = tokenizer.tokenize_single(self._load())
+        clean_tree = tokenizer.cleanup_tree(self._load())
+        clean_tokens, _ = tokenizer.tokenize_single(clean_tree, copy=False)
+        detokenized_tree = tokenizer.detokenize_single(clean_tokens, tags)
+
+        # the tree passed to tokenize_single is annotated
+        self.assertIs(detokenized_tree.getroot(), clean_tree)
+        self.assertHtmlTreeEqual(
+            detokenized_tree,
+            html_document_fromstring(ANNOTATED_HTML)
+        )
+
+
+def assert_same_tokens(detached, html_tokens):
+    assert len(detached) == len(html_tokens)
+    for tok, orig in zip(detached, html_tokens):
+        assert isinstance(tok.elem, DetachedElement)
+        assert ((tok.token, tok.index, tok.is_tail, tok.position, tok.length) ==
+                (orig.token, orig.index, orig.is_tail, orig.position, orig.length))
+        assert tok.tokens == orig.tokens
+        assert tok.parent.tag == orig.parent.tag
+        assert ([e.tag for e in tok.elem.iterancestors()] ==
+                [e.tag for e in orig.elem.iterancestors()])
+        assert (tok.elem.ancestor_tags ==
+                {orig.elem.tag} | {e.tag for e in orig.elem.iterancestors()})
+
+
+class LoadAndTokenizeTest(unittest.TestCase):
+
+    def _paths(self):
+        return sorted(glob.glob(os.path.join(DATA_PATH, '*.html')))[:6]
+
+    def assertSameTokens(self, detached, html_tokens):
+        assert_same_tokens(detached, html_tokens)
+
+    def test_load_and_tokenize(self):
+        paths = self._paths()
+        loader = WebAnnotatorLoader()
+        tokenizer = HtmlTokenizer()
+        X, y = tokenizer.tokenize(loader.load(path) for path in paths)
+
+        sources = [paths[0]]
+        with open(paths[1], 'rb') as f:
+            sources.append(f.read())
+        sources.extend(paths[2:])
+
+        for n_jobs in [1, 2]:
+            X_par, y_par = tokenizer.load_and_tokenize(
+                sources, loader, n_jobs=n_jobs, chunksize=2)
+            self.assertEqual(y_par, y)
+            for detached, html_tokens in zip(X_par, X):
+                self.assertSameTokens(detached, html_tokens)
+
+    def test_detached_tokens_pickle(self):
+        tree = HtmlLoader().load(self._paths()[0])
+        html_tokens, _ = HtmlTokenizer().tokenize_single(tree)
+        detached = pickle.loads(pickle.dumps(detach_html_tokens(html_tokens)))
+        self.assertSameTokens(detached, html_tokens)
+
+        # tokens from the same element share DetachedElement
+        self.assertIs(detached[0].elem, detached[1].elem)
+        self.assertRaises(ValueError, lambda: detached[0].root)
+
+
+class HtmlTokenBatchTest(unittest.TestCase):
+
+    def _tokenize(self, tokenizer):
+        trees = get_trees(3)
+        return ([tokenizer.tokenize_single(tree) for tree in trees],
+                [tokenizer.tokenize_single_batch(tree) for tree in trees])
+
+    def test_tokenize_single_batch(self):
+        tokenizer = HtmlTokenizer(replace_html_tags={'b': 'strong'})
+        for (html_tokens, tags), (batch, batch_tags) in zip(*self._tokenize(tokenizer)):
+            self.assertEqual(batch_tags, tags)
+            self.assertEqual(len(batch), len(html_tokens))
+            self.assertEqual(batch.tokens, [t.token for t in html_tokens])
+            self.assertEqual(list(batch.is_tail), [t.is_tail for t in html_tokens])
+            self.assertEqual([batch.elem_tags[i] for i in batch.elem_ids],
+                             [t.elem.tag for t in html_tokens])
+
+            from_tokens = HtmlTokenBatch.from_html_tokens(html_tokens)
+            for attr in ['tokens', 'block_ids', 'elem_ids', 'is_tail',
+                         'positions', 'lengths', 'block_offsets',
+                         'elem_tags', 'elem_parents', 'elem_ancestor_tags']:
+                self.assertEqual(getattr(batch, attr), getattr(from_tokens, attr))
+
+            for elem_id, tok in zip(batch.elem_ids, html_tokens):
+                ancestor_tags = {tok.elem.tag}
+                ancestor_tags.update(e.tag for e in tok.elem.iterancestors())
+                self.assertEqual(batch.elem_ancestor_tags[elem_id], ancestor_tags)
+
+            # batch tokens are detached, but they provide the same information
+            batch = pickle.loads(pickle.dumps(batch))
+            assert_same_tokens(batch.html_tokens(), html_tokens)
+
+    def test_feature_extraction(self):
+        extractors = [
+            HtmlFeatureExtractor(token_features=EXAMPLE_TOKEN_FEATURES),
+            HtmlFeatureExtractor(token_features=EXAMPLE_TOKEN_FEATURES,
+                                 global_features=[Pattern((-1, 'lower'))],
+                                 token_cache_size=0),
+        ]
+        for (html_tokens, _), (batch, _) in zip(*self._tokenize(HtmlTokenizer())):
+            for fe in extractors:
+                self.assertEqual(fe.transform_single(batch),
+                                 fe.transform_single(html_tokens))
+
+    def test_lazy_html_tokens(self):
+        for (html_tokens, _), (batch, _) in zip(*self._tokenize(HtmlTokenizer())):
+            lazy_tokens = batch.lazy_html_tokens()
+            self.assertEqual(len(lazy_tokens), len(batch))
+            self.assertEqual(lazy_tokens[5].token, batch.tokens[5])
+            self.assertIs(lazy_tokens[5], lazy_tokens[5])
+            self.assertEqual(lazy_tokens.n_created, 1)
+            assert_same_tokens(list(lazy_tokens), html_tokens)
+
+    def test_empty(self):
+        batch, tags = HtmlTokenizer().tokenize_single_batch(
+            HtmlLoader().loadbytes(b'<p></p>'))
+        self.assertEqual(len(batch), 0)
+        self.assertEqual(tags, [])
+        self.assertEqual(batch.html_tokens(), [])
+
+
+class TokenizeUnannotatedTest(unittest.TestCase):
+
+    def test_same_as_tokenize_single(self):
+        tokenizer = HtmlTokenizer(replace_html_tags={'b': 'strong'})
+        for tree in get_trees(5):
+            tree = tokenizer.cleanup_tree(tree)
+            html_tokens, tags = tokenizer.tokenize_single(tree)
+            self.assertEqual(set(tags) - {'O'}, set())
+            fast_tokens = tokenizer.tokenize_single_unannotated(tree)
+            self.assertEqual(len(fast_tokens), len(html_tokens))
+            for tok, orig in zip(fast_tokens, html_tokens):
+                self.assertEqual(
+                    (tok.token, tok.tokens, tok.index, tok.is_tail,
+                     tok.position, tok.length, tok.parent.tag),
+                    (orig.token, orig.tokens, orig.index, orig.is_tail,
+                     orig.position, orig.length, orig.parent.tag),
+                )
+
+    def test_detokenize(self):
+        tokenizer = HtmlTokenizer()
+        html_tokens, tags = tokenizer.tokenize_single(
+            GateLoader(known_entities={'ORG', 'CITY'}).loadbytes(GATE_HTML))
+        tree = HtmlLoader().loadbytes(UNANNOTATED_HTML)
+        fast_tokens = tokenizer.tokenize_single_unannotated(tree)
+        detokenized_tree = tokenizer.detokenize_single(fast_tokens, tags)
+        self.assertIn(b'__START_ORG__', tostring(detokenized_tree))
+        self.assertNotIn(b'__START_ORG__', tostring(tree))
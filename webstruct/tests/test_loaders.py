@@ -1,11 +1,19 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 import os
+import glob
+import shutil
+import tempfile
+import unittest
+from itertools import islice
 
 import lxml.html
 
-from webstruct import WebAnnotatorLoader
+from webstruct import WebAnnotatorLoader, load_trees
 from webstruct import HtmlTokenizer
+from webstruct.loaders import HtmlCleaner, _get_lxml_cleaner
+from webstruct.utils import html_document_fromstring
+from webstruct.tests.utils import DATA_PATH
 
 
 def test_wa_loader():
@@ -68,3 +76,86 @@ Website Designed by <a wa_temp_href="http://www.western-webs.com" target="_blank
 
     _assert_entities(fragment2, {'city', 'state', 'country', 'street'}, expected1)
     _assert_entities(fragment2, {'addr'}, expected2)
+
+
+class LoadTreesTest(unittest.TestCase):
+    pattern = os.path.join(DATA_PATH, '*.html')
+
+    def setUp(self):
+        self.loader = WebAnnotatorLoader(known_entities={'ORG', 'CITY'})
+        self.expected = self._load()
+
+    def _load(self, **kwargs):
+        trees = islice(load_trees(self.pattern, self.loader, **kwargs), 20)
+        return [lxml.html.tostring(tree) for tree in trees]
+
+    def test_parallel(self):
+        self.assertEqual(self._load(n_jobs=2, chunksize=4), self.expected)
+
+    def test_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            self.assertEqual(self._load(cache_dir=cache_dir), self.expected)
+            self.assertTrue(os.listdir(cache_dir))
+            self.assertEqual(self._load(cache_dir=cache_dir), self.expected)
+            self.assertEqual(self._load(cache_dir=cache_dir, n_jobs=2),
+                             self.expected)
+
+            # loaders with different options don't share cached trees
+            self.loader = WebAnnotatorLoader()
+            self.assertNotEqual(self._load(cache_dir=cache_dir),
+                                self.expected)
+        finally:
+            shutil.rmtree(cache_dir)
+
+
+class HtmlCleanerTest(unittest.TestCase):
+
+    def assertCleanedAsLxml(self, tree):
+        expected = _get_lxml_cleaner().clean_html(tree)
+        cleaned = HtmlCleaner().clean_html(tree)
+        self.assertEqual(lxml.html.tostring(cleaned),
+                         lxml.html.tostring(expected))
+
+    def test_clean_html(self):
+        html = b"""<html><body><div>
+        <object>o<param name="a">p<applet>a<param>p2</applet></object>
+        <param>t<image src="img.png"></image><p>x<iframe src="a">i</iframe>y</p>
+        <div><noframes>nf</noframes><!--[if IE 6]><p>ie</p><![endif]-->
+        <!--comment--></div>
+        </div></body></html>"""
+        tree = html_document_fromstring(html)
+        self.assertCleanedAsLxml(tree)
+
+        cleaned = HtmlCleaner().clean_html(tree)
+        self.assertIs(cleaned, tree)
+        self.assertEqual(lxml.html.tostring(cleaned), b"""<html><body><div>
+        op
+        t<img src="img.png"><p>xiy</p>
+        <div>
+        <!--comment--></div>
+        </div></body></html>""")
+
+    def test_corpus(self):
+        for path in glob.glob(os.path.join(DATA_PATH, '..', 'source', '*.html')):
+            with open(path, 'rb') as f:
+                self.assertCleanedAsLxml(html_document_fromstring(f.read()))
+
+
+def test_wa_loader_title():
+    html = b"""<html><head><title>Old <span wa-id="1" wa-type="ORG">title</span></title></head><body><p><span wa-id="2" wa-type="ORG">Scrapinghub</span> in <span wa-id="3" wa-type="CITY">Montevideo</span></p></body><wa-color id="WA-color-0" type="ORG"></wa-color><wa-title style="display:none"><span wa-id="4" wa-type="ORG">Scrapinghub</span> contacts</wa-title></html>"""
+
+    tree = WebAnnotatorLoader(known_entities={'ORG'}).loadbytes(html)
+    res = lxml.html.tostring(tree)
+    assert res == b'<html><head><title> __START_ORG__ Scrapinghub __END_ORG__  contacts</title></head><body><p> __START_ORG__ Scrapinghub __END_ORG__  in Montevideo</p></body></html>', res
+
+    # entity markers are placed as if <wa-title> was moved before
+    # looking for entities
+    tree = WebAnnotatorLoader().loadbytes(html.replace(b'wa-id="4"', b'wa-id="2"'))
+    res = lxml.html.tostring(tree)
+    assert res == b'<html><head><title> __START_ORG__ Scrapinghub contacts</title></head><body><p>Scrapinghub __END_ORG__  in  __START_CITY__ Montevideo __END_CITY__ </p></body></html>', res
+
+    # <wa-title> is dropped if there is no <title>
+    tree = WebAnnotatorLoader().loadbytes(html.replace(b'<title>', b'<p>').replace(b'</title>', b'</p>'))
+    res = lxml.html.tostring(tree)
+    assert res == b'<html><head></head><body><p>Old  __START_ORG__ title __END_ORG__ </p><p> __START_ORG__ Scrapinghub __END_ORG__  in  __START_CITY__ Montevideo __END_CITY__ </p></body></html>', res
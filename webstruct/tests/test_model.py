@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from webstruct.model import NER
+
+
+class _CityModel(object):
+    """ A fake model which tags all 'Montevideo' tokens as B-CITY """
+    def predict(self, X):
+        return [['B-CITY' if tok.token == 'Montevideo' else 'O' for tok in doc]
+                for doc in X]
+
+
+HTML = b"<html><body><p>Scrapinghub has an office in Montevideo</p></body></html>"
+
+
+def test_ner_extract():
+    ner = NER(_CityModel())
+    assert ner.extract(HTML) == [('Montevideo', 'CITY')]
+
+
+def test_ner_annotate():
+    ner = NER(_CityModel())
+    html = ner.annotate(HTML)
+    assert b'wa-type="CITY"' in html, html
+    assert b'>Montevideo</span>' in html, html
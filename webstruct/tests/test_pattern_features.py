@@ -1,8 +1,31 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
+import os
+import pickle
+import shutil
+import tempfile
 import unittest
-from webstruct import GateLoader, HtmlTokenizer, HtmlFeatureExtractor
-from webstruct.features import token_lower, token_identity, looks_like_year, Pattern
+
+import pytest
+from webstruct import GateLoader, HtmlTokenizer, HtmlFeatureExtractor, HtmlToken
+from webstruct.features import (
+    token_lower,
+    token_identity,
+    looks_like_year,
+    token_shape,
+    Pattern,
+    MultiPattern,
+    LongestMatchGlobalFeature,
+    MultiLongestMatchGlobalFeature,
+    DAWGGlobalFeature,
+    TokenNormalizer,
+    lowercase,
+    strip_accents_lowercase,
+    EXAMPLE_TOKEN_FEATURES,
+)
+from webstruct.features.global_features import _add_pattern_features
+from webstruct.utils import LongestMatch
+from .utils import get_trees
 
 
 class PatternTest(unittest.TestCase):
@@ -45,3 +68,323 @@ class PatternTest(unittest.TestCase):
             [feat['lower/token[+1]'] for feat in X],
             ['hello/John', 'john/Doe', 'doe/Mary', 'mary/said', 'said/OUT']
         )
+
+
+def apply_patterns_sequentially(token_data, patterns):
+    feature_dicts = [feat for html_token, feat in token_data]
+    for p in patterns:
+        _add_pattern_features(feature_dicts, p.lookups, p.out_value,
+                              p.missing_value, p.separator)
+
+
+class MultiPatternTest(unittest.TestCase):
+
+    PATTERNS = [
+        Pattern((-1, 'lower')),
+        Pattern((-2, 'lower')),
+        Pattern((-2, 'lower'), (-1, 'lower')),
+        Pattern((+1, 'lower')),
+        Pattern((-1, 'shape'), (-2, 'shape')),
+        Pattern((+1, 'shape'), out_value='xx', separator='|'),
+        Pattern((0, 'looks_like_year'), (1, 'missing'), missing_value='?'),
+        Pattern((-1, 'bias'), out_value=1),
+        Pattern((100, 'lower'), (-100, 'lower')),
+        # these patterns read features written by previous patterns
+        Pattern((-1, 'lower/lower[+1]')),
+        Pattern((0, 'lower'), (1, 'lower')),
+        Pattern((1, 'lower/lower[+1]')),
+        Pattern((1, 'lower[-1]')),
+        Pattern((0, 'lower'), (-1, 'lower/lower[-1]')),
+        # this pattern reads its own output
+        Pattern((-1, 'shape')),
+        Pattern((0, 'shape')),
+        Pattern((-1, 'shape')),
+    ]
+
+    def setUp(self):
+        X, _ = HtmlTokenizer().tokenize(get_trees(3))
+        fe = HtmlFeatureExtractor(EXAMPLE_TOKEN_FEATURES + [looks_like_year])
+        self.docs = [list(zip(html_tokens, feature_dicts)) for html_tokens, feature_dicts
+                     in zip(X, fe.transform(X))]
+
+    def test_same_features(self):
+        for patterns in [self.PATTERNS, self.PATTERNS[:1], self.PATTERNS[-4:]]:
+            for doc in self.docs + [[], self.docs[0][:1]]:
+                doc = [(tok, dict(feat)) for tok, feat in doc]
+                expected = [(tok, dict(feat)) for tok, feat in doc]
+                apply_patterns_sequentially(expected, patterns)
+                MultiPattern(*patterns)(doc)
+                self.assertEqual(doc, expected)
+
+    def test_extractor(self):
+        global_features = [Pattern((-1, 'token')), Pattern((1, 'token'))]
+        fe = HtmlFeatureExtractor([token_identity], global_features)
+        X, _ = HtmlTokenizer().tokenize(get_trees(1))
+        X_fe = fe.transform(X)
+        fe.set_params(global_features=[MultiPattern(*global_features)])
+        self.assertEqual(fe.transform(X), X_fe)
+        self.assertEqual(X_fe[0][1]['token[-1]'], X[0][0].token)
+
+
+class MultiLongestMatchTest(unittest.TestCase):
+
+    def _lexicons(self, X):
+        tokens = [tok.token for doc in X for tok in doc]
+        return [
+            ({' '.join(tokens[i:i + 3]) for i in range(0, 200, 7)}, 'A'),
+            ({' '.join(tokens[i:i + 2]) for i in range(0, 300, 5)}, 'B'),
+            ({tokens[i] for i in range(0, 300, 11)}, 'C'),
+        ]
+
+    def assertSameFeatures(self, X, lexicons):
+        separate = [LongestMatchGlobalFeature(data, name) for data, name in lexicons]
+        combined = MultiLongestMatchGlobalFeature(lexicons)
+        self.assertEqual(len(combined.feature_keys), 3 * len(lexicons))
+
+        for html_tokens in X:
+            doc1 = [(tok, {}) for tok in html_tokens]
+            doc2 = [(tok, {}) for tok in html_tokens]
+            for feature in separate:
+                feature(doc1)
+            combined(doc2)
+            self.assertEqual(doc1, doc2)
+        self.assertTrue(any(feat for tok, feat in doc2))
+        return combined
+
+    def test_same_features(self):
+        X, _ = HtmlTokenizer().tokenize(get_trees(3))
+        self.assertSameFeatures(X, self._lexicons(X))
+
+    def test_prefix_search_lexicons(self):
+        dawg = pytest.importorskip("dawg")
+        X, _ = HtmlTokenizer().tokenize(get_trees(3))
+        lexicons = self._lexicons(X)
+        lexicons[1] = dawg.CompletionDAWG(lexicons[1][0]), 'B'
+        combined = self.assertSameFeatures(X, lexicons)
+
+        # DAWG keys are not copied to the in-memory trie
+        self.assertEqual(set(combined.lm._matchers), {1})
+        self.assertEqual(set(combined.lm._trie),
+                         {key.split(' ')[0] for key in lexicons[0][0] | lexicons[2][0]})
+
+        restored = pickle.loads(pickle.dumps(combined))
+        self.assertEqual(restored.lm.max_lengths, combined.lm.max_lengths)
+        for html_tokens in X:
+            tokens = [tok.token for tok in html_tokens]
+            self.assertEqual(restored.lm.find_ranges(tokens),
+                             combined.lm.find_ranges(tokens))
+
+
+class NormalizedLongestMatchTest(unittest.TestCase):
+
+    def _doc(self, *tokens):
+        return [(HtmlToken(i, list(tokens), None, False, 0, 0), {})
+                for i in range(len(tokens))]
+
+    def test_normalize(self):
+        feature = LongestMatchGlobalFeature({u'koln', u'new york'}, 'CITY',
+                                            normalize=strip_accents_lowercase)
+        doc = self._doc(u'KÖLN', u'and', u'new', u'YORK')
+        feature(doc)
+        self.assertEqual([sorted(feat) for tok, feat in doc], [
+            ['B-CITY', 'CITY'], [], ['B-CITY', 'CITY'], ['CITY', 'I-CITY'],
+        ])
+
+    def test_lexicon_normalized(self):
+        features = [
+            LongestMatchGlobalFeature({u'New York'}, 'A', normalize=lowercase),
+            LongestMatchGlobalFeature({u'New York': 1}, 'B', normalize=lowercase),
+            MultiLongestMatchGlobalFeature([([u'New York'], 'C')],
+                                           normalize=lowercase),
+        ]
+        doc = self._doc(u'New', u'York')
+        for feature in features:
+            feature(doc)
+        self.assertEqual([sorted(feat) for tok, feat in doc], [
+            ['A', 'B', 'B-A', 'B-B', 'B-C', 'C'],
+            ['A', 'B', 'C', 'I-A', 'I-B', 'I-C'],
+        ])
+        self.assertEqual(features[1].lm.known, {u'new york': 1})
+
+    def test_legacy_pickle(self):
+        # features pickled by older versions don't have ``normalize``
+        feature = LongestMatchGlobalFeature({u'Paris'}, 'A')
+        del feature.normalize
+        restored = pickle.loads(pickle.dumps(feature))
+        X, _ = HtmlTokenizer().tokenize(get_trees(1))
+        fe = HtmlFeatureExtractor(token_features=[], global_features=[restored])
+        fe.fit_transform(X)
+        doc = self._doc(u'Paris')
+        restored(doc)
+        self.assertEqual(sorted(doc[0][1]), ['A', 'B-A'])
+
+    def test_normalized_once_per_document(self):
+        calls = []
+
+        def normalize(text):
+            calls.append(text)
+            return text.lower()
+
+        features = [
+            LongestMatchGlobalFeature({u'paris'}, 'A', normalize=normalize),
+            MultiLongestMatchGlobalFeature([({u'paris'}, 'B')],
+                                           normalize=normalize),
+        ]
+        self.assertIsInstance(features[0].normalize, TokenNormalizer)
+        features[0].normalize.cache_size = 0
+        features[1].normalize.cache_size = 0
+        del calls[:]  # lexicons are normalized as well
+
+        X, _ = HtmlTokenizer().tokenize(get_trees(1))
+        fe = HtmlFeatureExtractor(token_features=[], global_features=features)
+        X_feat = fe.fit_transform(X)
+        self.assertEqual(len(calls), len(X[0]))
+        self.assertEqual(calls, [tok.token for tok in X[0]])
+
+        # documents are not cached between calls
+        del calls[:]
+        X[0][0].tokens[X[0][0].index] = u'PARIS'
+        X_feat = fe.transform(X)
+        self.assertEqual(len(calls), len(X[0]))
+        self.assertTrue(X_feat[0][0]['A'] and X_feat[0][0]['B'])
+
+    def test_pickle(self):
+        features = [
+            LongestMatchGlobalFeature({u'paris'}, 'A', normalize=lowercase),
+            LongestMatchGlobalFeature({u'berlin'}, 'B', normalize=lowercase),
+        ]
+        restored = pickle.loads(pickle.dumps(features))
+        doc = self._doc(u'PARIS', u'Berlin')
+        for feature in restored:
+            feature(doc)
+        self.assertEqual([sorted(feat) for tok, feat in doc],
+                         [['A', 'B-A'], ['B', 'B-B']])
+
+    def test_same_as_without_normalize(self):
+        X, _ = HtmlTokenizer().tokenize(get_trees(2))
+        tokens = [tok.token for doc in X for tok in doc]
+        names = {' '.join(tokens[i:i + 2]).lower()
+                 for i in range(0, len(tokens) - 1, 5)}
+        plain = LongestMatchGlobalFeature(names, 'X')
+        normalized = LongestMatchGlobalFeature(names, 'X', normalize=lowercase)
+        for html_tokens in X:
+            doc1 = [(HtmlToken(tok.index, [t.lower() for t in tok.tokens],
+                               tok.elem, tok.is_tail, 0, 0), {})
+                    for tok in html_tokens]
+            doc2 = [(tok, {}) for tok in html_tokens]
+            plain(doc1)
+            normalized(doc2)
+            self.assertEqual([feat for tok, feat in doc1],
+                             [feat for tok, feat in doc2])
+
+
+class FileLookupFeatureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        X, _ = HtmlTokenizer().tokenize(get_trees(2))
+        self.X = X
+        tokens = [tok.token for doc in X for tok in doc]
+        self.names = {' '.join(tokens[i:i + 2]) for i in range(0, len(tokens) - 1, 5)}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def assertSameFeatures(self, feature, expected):
+        for html_tokens in self.X:
+            doc1 = [(tok, {}) for tok in html_tokens]
+            doc2 = [(tok, {}) for tok in html_tokens]
+            feature(doc1)
+            expected(doc2)
+            self.assertEqual(doc1, doc2)
+
+    def assertPickledByReference(self, feature):
+        data = pickle.dumps(feature, pickle.HIGHEST_PROTOCOL)
+        self.assertLess(len(data), os.path.getsize(feature.filename))
+        restored = pickle.loads(data)
+        self.assertEqual(restored.lm.max_length, feature.lm.max_length)
+        self.assertSameFeatures(restored, feature)
+        return restored
+
+    def test_marisa(self):
+        marisa_trie = pytest.importorskip("marisa_trie")
+        from webstruct.gazetteers.geonames import GAZETTEER_FORMAT
+        from webstruct.gazetteers.features import MarisaGeonamesGlobalFeature
+
+        filename = os.path.join(self.tmpdir, 'names.marisa')
+        records = [(name, (b'US', b'P', b'PPL', b'NY', b'061')) for name in sorted(self.names)]
+        trie = marisa_trie.RecordTrie(GAZETTEER_FORMAT, records * 100)
+        trie.save(filename)
+
+        expected = LongestMatchGlobalFeature(self.names, 'X')
+        for mmap in [False, True]:
+            feature = MarisaGeonamesGlobalFeature(filename, 'X', mmap=mmap)
+            self.assertSameFeatures(feature, expected)
+            restored = self.assertPickledByReference(feature)
+            self.assertEqual(restored.mmap, mmap)
+
+        # a normalized gazetteer is memory-mapped as-is
+        lower_filename = os.path.join(self.tmpdir, 'lower.marisa')
+        marisa_trie.RecordTrie(GAZETTEER_FORMAT, [
+            (name.lower(), values) for name, values in records * 100
+        ]).save(lower_filename)
+        feature = MarisaGeonamesGlobalFeature(lower_filename, 'X', mmap=True,
+                                              normalize=lowercase)
+        self.assertSameFeatures(feature, LongestMatchGlobalFeature(
+            {name.lower() for name in self.names}, 'X', normalize=lowercase))
+        self.assertPickledByReference(feature)
+
+    def test_dawg(self):
+        dawg = pytest.importorskip("dawg")
+        filename = os.path.join(self.tmpdir, 'names.dawg')
+        dawg.CompletionDAWG(self.names).save(filename)
+
+        feature = DAWGGlobalFeature(filename, 'X')
+        self.assertSameFeatures(feature, LongestMatchGlobalFeature(self.names, 'X'))
+        self.assertPickledByReference(feature)
+        self.assertRaises(ValueError, DAWGGlobalFeature, filename, 'X', mmap=True)
+
+    def test_lazy_index(self):
+        dawg = pytest.importorskip("dawg")
+        filename = os.path.join(self.tmpdir, 'names.dawg')
+        dawg.CompletionDAWG(self.names).save(filename)
+
+        feature = DAWGGlobalFeature(filename, 'X')
+        self.assertIsNone(feature.lm._max_length)
+        restored = pickle.loads(pickle.dumps(feature))
+        self.assertIsNone(restored.lm._max_length)
+        self.assertSameFeatures(restored, LongestMatchGlobalFeature(self.names, 'X'))
+        self.assertEqual(restored.lm._max_length, 2)
+
+    def _legacy_feature(self, cls, data):
+        # state of a feature pickled by an older version: the lexicon
+        # is pickled by value, ``format`` and ``mmap`` are not stored
+        lm = LongestMatch.__new__(LongestMatch)
+        lm.__setstate__({'known': data, 'max_length': 2})
+        feature = cls.__new__(cls)
+        feature.__setstate__({
+            'data': data, 'filename': os.path.join(self.tmpdir, 'missing'),
+            'lm': lm, 'b_featname': 'B-X', 'i_featname': 'I-X', 'featname': 'X',
+        })
+        return feature
+
+    def test_legacy_pickle(self):
+        dawg = pytest.importorskip("dawg")
+        marisa_trie = pytest.importorskip("marisa_trie")
+        from webstruct.gazetteers.geonames import GAZETTEER_FORMAT
+        from webstruct.gazetteers.features import MarisaGeonamesGlobalFeature
+
+        expected = LongestMatchGlobalFeature(self.names, 'X')
+        records = [(name, (b'US', b'P', b'PPL', b'NY', b'061')) for name in self.names]
+        for cls, data in [
+            (DAWGGlobalFeature, dawg.CompletionDAWG(self.names)),
+            (MarisaGeonamesGlobalFeature,
+             marisa_trie.RecordTrie(GAZETTEER_FORMAT, records)),
+        ]:
+            feature = self._legacy_feature(cls, data)
+            self.assertEqual((feature.format, feature.mmap), (None, False))
+            self.assertSameFeatures(feature, expected)
+
+    def test_abstract(self):
+        from webstruct.features.global_features import _FileLongestMatchGlobalFeature
+        self.assertRaises(TypeError, _FileLongestMatchGlobalFeature, 'x', 'X')
@@ -1,7 +1,16 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import random
 import unittest
 import pytest
 
-from webstruct.text_tokenizers import TextToken, WordTokenizer
+from webstruct.text_tokenizers import (
+    TextToken,
+    WordTokenizer,
+    ReferenceWordTokenizer,
+    tokenize,
+)
+from .utils import get_trees
 
 class TestTokenizerTest(unittest.TestCase):
     def do_tokenize(self, text, result):
@@ -46,3 +55,79 @@ class TestTokenizerTest(unittest.TestCase):
                  TextToken(chars='/', position=6, length=1),
                  TextToken(chars='1800', position=8, length=4)]
                 )
+
+
+class WordTokenizerEquivalenceTest(unittest.TestCase):
+    """ WordTokenizer must produce the same tokens as the reference one """
+
+    TEXTS = [
+        '',
+        ' ',
+        '"',
+        '" a',
+        '["a',
+        'Good muffins cost $3.88\nin New York. Email: muffins@gmail.com',
+        'population of 100,000, or 1,5 or 1, 2,',
+        '"We beat some pretty good teams to get here," Slocum said.',
+        u'“Quoted” text… and... more -- dashes --- and ``ticks``',
+        "it's 'quoted' '' text' \n",
+        u'Copyright © 2014 Foo Bar and Buzz Spam. All Rights Reserved.',
+        'Tel.: (555) 123-4567; Fax: [555] {123} <4567>!?',
+        'ends with a dot.\n',
+        'ends with a comma,',
+        u'£10 & 20% #1 | Hello|World',
+    ]
+
+    def assertSameTokens(self, text):
+        tokenizer = WordTokenizer()
+        reference = ReferenceWordTokenizer()
+        self.assertEqual(
+            list(tokenizer._segment_words(text)),
+            list(reference._segment_words(text)),
+        )
+        self.assertEqual(tokenizer.segment_words(text),
+                         reference.segment_words(text))
+
+    def test_examples(self):
+        for text in self.TEXTS:
+            self.assertSameTokens(text)
+
+    def test_random_texts(self):
+        rng = random.Random(0)
+        alphabet = u'ab1 \n\t.,;:"\'`-…“”$£(<[{'
+        for i in range(2000):
+            length = rng.randint(0, 30)
+            text = u''.join(rng.choice(alphabet) for _ in range(length))
+            self.assertSameTokens(text)
+
+    def test_corpus_texts(self):
+        for tree in get_trees(3):
+            for elem in tree.iter():
+                for text in [elem.text, elem.tail]:
+                    if text:
+                        self.assertSameTokens(text)
+
+    def test_default_tokenizer(self):
+        text = 'Hello, "world"; a, b ... c'
+        self.assertEqual(
+            tokenize(text),
+            [t for t in ReferenceWordTokenizer().segment_words(text)
+             if t.chars not in {',', ';'}]
+        )
+
+
+class _UpperTokenizer(WordTokenizer):
+    def _segment_words_nonquote(self, text):
+        for token in super(_UpperTokenizer, self)._segment_words_nonquote(text):
+            yield token._replace(chars=token.chars.upper())
+
+
+def test_segment_words_nonquote_override():
+    tokens = _UpperTokenizer().segment_words('say "hi" now')
+    assert tokens == [
+        TextToken(chars='SAY', position=0, length=3),
+        TextToken(chars='``', position=4, length=1),
+        TextToken(chars='HI', position=5, length=2),
+        TextToken(chars="''", position=7, length=1),
+        TextToken(chars='NOW', position=9, length=3),
+    ]
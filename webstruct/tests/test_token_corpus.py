@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import unittest
+from six.moves import zip
+
+from webstruct import HtmlTokenizer, HtmlFeatureExtractor
+from webstruct.features import EXAMPLE_TOKEN_FEATURES
+from webstruct.loaders import HtmlLoader
+from webstruct.token_corpus import (
+    TokenCorpus,
+    TokenCorpusWriter,
+    write_token_corpus,
+)
+from .test_html_tokenizer import assert_same_tokens
+from .utils import get_trees
+
+
+class TokenCorpusTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'corpus')
+        self.X, self.y = HtmlTokenizer().tokenize(get_trees(5))
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.path))
+
+    def test_roundtrip(self):
+        write_token_corpus(self.path, self.X, self.y)
+        for mmap in [True, False]:
+            corpus = TokenCorpus(self.path, mmap=mmap)
+            self.assertEqual(len(corpus), len(self.X))
+            self.assertEqual(len(corpus.tags), len(self.y))
+            self.assertEqual(list(corpus.tags), self.y)
+            for batch, html_tokens in zip(corpus, self.X):
+                assert_same_tokens(batch.html_tokens(), html_tokens)
+
+    def test_indexing(self):
+        write_token_corpus(self.path, self.X, self.y)
+        corpus = TokenCorpus(self.path)
+        self.assertEqual(corpus[-1].tokens, corpus[4].tokens)
+        self.assertEqual([b.tokens for b in corpus[1:3]],
+                         [[t.token for t in doc] for doc in self.X[1:3]])
+        self.assertEqual(corpus.tags[::2], self.y[::2])
+        self.assertRaises(IndexError, lambda: corpus[5])
+        self.assertRaises(IndexError, lambda: corpus.tags[-6])
+
+    def test_feature_extraction(self):
+        write_token_corpus(self.path, self.X)
+        corpus = TokenCorpus(self.path)
+        self.assertIsNone(corpus.tags)
+        fe = HtmlFeatureExtractor(token_features=EXAMPLE_TOKEN_FEATURES)
+        self.assertEqual(fe.fit_transform(corpus), fe.fit_transform(self.X))
+
+    def test_writer(self):
+        tokenizer = HtmlTokenizer()
+        tree = HtmlLoader().loadbytes(b'<p>hello <b>world</b></p>')
+        with TokenCorpusWriter(self.path) as writer:
+            writer.add(*tokenizer.tokenize_single_batch(tree))
+            writer.add([], [])
+            self.assertRaises(ValueError, writer.add, [])
+            self.assertRaises(ValueError, writer.add, self.X[0], [])
+
+        corpus = TokenCorpus(self.path)
+        self.assertEqual(repr(corpus),
+                         "TokenCorpus(%r, documents=2, tokens=2)" % self.path)
+        self.assertEqual(corpus[0].tokens, ['hello', 'world'])
+        self.assertEqual(corpus[0].elem_tags, ['html', 'body', 'p', 'b'])
+        self.assertEqual(corpus.tags[0], ['O', 'O'])
+        self.assertEqual(len(corpus[1]), 0)
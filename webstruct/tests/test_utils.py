@@ -1,8 +1,64 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
-from webstruct.utils import human_sorted
+import pickle
+import random
+
+import pytest
+
+from webstruct.utils import human_sorted, LongestMatch
 
 
 def test_human_sorted():
     assert human_sorted(['5', '10', '7', '100']) == ['5', '7', '10', '100']
     assert human_sorted(['foo1', 'foo10', 'foo2']) == ['foo1', 'foo2', 'foo10']
+
+
+def _reference_longest_ranges(known, tokens):
+    # lookup of every token range, longest ranges are kept first
+    max_length = max(len(key.split()) for key in known)
+    ranges = []
+    for i in range(len(tokens)):
+        for length in range(min(max_length, len(tokens) - i), 0, -1):
+            lookup = " ".join(tokens[i:i+length])
+            if lookup in known:
+                ranges.append((i, i + length, lookup))
+                break
+    res, filled = [], set()
+    for begin, end, lookup in sorted(ranges, key=lambda r: r[1] - r[0], reverse=True):
+        if not filled & set(range(begin, end)):
+            res.append((begin, end, lookup))
+            filled |= set(range(begin, end))
+    return sorted(res)
+
+
+@pytest.mark.parametrize('container', [set, list, 'dawg'])
+def test_longest_match_same_ranges(container):
+    if container == 'dawg':
+        dawg = pytest.importorskip('dawg')
+        container = dawg.CompletionDAWG
+    rnd = random.Random(0)
+    words = ['a', 'b', 'c', 'd', '']
+    for _ in range(300):
+        known = {' '.join(rnd.choice(words[:4]) for _ in range(rnd.randint(1, 4)))
+                 for _ in range(rnd.randint(1, 10))}
+        known.add('a  b')  # empty token inside
+        tokens = [rnd.choice(words + ['a b']) for _ in range(rnd.randint(0, 15))]
+        lm = LongestMatch(container(known))
+        assert lm.find_ranges(tokens) == _reference_longest_ranges(known, tokens)
+
+
+# LongestMatch({'New York', 'Paris'}) pickled before the token trie was added
+_LEGACY_LONGEST_MATCH = (
+    b'\x80\x02cwebstruct.utils\nLongestMatch\nq\x00)\x81q\x01}q\x02(X\x05\x00'
+    b'\x00\x00knownq\x03c__builtin__\nset\nq\x04]q\x05(X\x08\x00\x00\x00New Y'
+    b'orkq\x06X\x05\x00\x00\x00Parisq\x07e\x85q\x08Rq\tX\n\x00\x00\x00max_le'
+    b'ngthq\nK\x02ub.'
+)
+
+
+def test_longest_match_legacy_pickle():
+    lm = pickle.loads(_LEGACY_LONGEST_MATCH)
+    tokens = ['in', 'New', 'York', 'and', 'Paris']
+    assert lm.find_ranges(tokens) == [(1, 3, 'New York'), (4, 5, 'Paris')]
+    lm = pickle.loads(pickle.dumps(lm))
+    assert lm.find_ranges(tokens) == [(1, 3, 'New York'), (4, 5, 'Paris')]
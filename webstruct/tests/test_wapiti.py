@@ -1,7 +1,27 @@
-from webstruct.wapiti import WapitiCRF
+import os
+import shutil
+import tempfile
+
+from webstruct.wapiti import WapitiCRF, get_used_features
 from webstruct.utils import run_command
 
 def test_is_wapiti_binary_present():
     run_command(['which', WapitiCRF.WAPITI_CMD])
 
 
+def test_get_used_features():
+    tempdir = tempfile.mkdtemp()
+    try:
+        model_filename = os.path.join(tempdir, 'model.wapiti')
+        with open(model_filename, 'w') as f:
+            f.write("#mdl#2#3\n#rdr#0/0/0\n"
+                    "#qrk#2\n1:O,\n5:B-PER,\n"
+                    "#qrk#4\n1:*,\n14:ufeat:token=foo,\n12:ufeat:upper=1,\n"
+                    "12:ufeat:upper=0,\n"
+                    "1=0x1p+0\n9=0x1p+0\n")
+        crf = WapitiCRF(model_filename, feature_template="*:L=%x[-1,lower]\n")
+        crf.feature_encoder.fit([[{'token': 'foo', 'upper': True, 'lower': 'foo',
+                                   'title': False}]])
+        assert get_used_features(crf) == {'upper', 'lower'}
+    finally:
+        shutil.rmtree(tempdir)
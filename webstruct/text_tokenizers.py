@@ -3,13 +3,17 @@ from __future__ import absolute_import, unicode_literals
 import re
 import collections
 
+import six
+
 TextToken = collections.namedtuple('TextToken', 'chars, position, length')
 
 
 class WordTokenizer(object):
     r"""This tokenizer is copy-pasted version of TreebankWordTokenizer
     that doesn't split on @ and ':' symbols and doesn't split contractions.
-    It supports span_tokenize(in terms of nltk tokenizers) method - :meth:`segment_words`::
+    It supports span_tokenize(in terms of nltk tokenizers) method - :meth:`segment_words`.
+    All :attr:`rules` are combined into a single regex, so text is tokenized
+    in one linear scan::
 
     >>> s = '''Good muffins cost $3.88\nin New York. Email: muffins@gmail.com'''
     >>> WordTokenizer().segment_words(s)
@@ -142,25 +146,95 @@ class WordTokenizer(object):
 
     open_quotes = re.compile(r'(^|[\s(\[{<])"')
 
+    def __init__(self):
+        self._rules_re, self._rule_tokens = _combine_rules(self.rules)
+
     def _segment_words(self, text):
         # this one cannot be placed in the loop of internal function because it requires
         # position check (beginning of the string) or previous char value
+        if _overrides_nonquote(self):
+            segment_range = self._segment_range_nonquote
+        else:
+            segment_range = self._segment_range
         start = 0
         for quote in self.open_quotes.finditer(text):
             quote_pos = quote.end() - 1
-            for token in self._segment_words_nonquote(text[start:quote_pos]):
-                yield TextToken(chars=token.chars,
-                                position=token.position + start,
-                                length=token.length)
+            for token in segment_range(text, start, quote_pos):
+                yield token
             yield TextToken(chars='``', position=quote_pos, length=1)
             start = quote.end()
 
-        for token in self._segment_words_nonquote(text[start:]):
+        for token in segment_range(text, start, len(text)):
+            yield token
+
+    def _segment_words_nonquote(self, text):
+        """
+        Tokenize a text without opening quotes. Subclasses may override
+        it; then it is called for each part of a text between
+        opening quotes, instead of the single-scan tokenizer.
+        """
+        return self._segment_range(text, 0, len(text))
+
+    def _segment_range_nonquote(self, text, start, end):
+        # tokenize text[start:end] using _segment_words_nonquote
+        for token in self._segment_words_nonquote(text[start:end]):
             yield TextToken(chars=token.chars,
                             position=token.position + start,
                             length=token.length)
 
+    def _segment_range(self, text, start, end):
+        """
+        Tokenize ``text[start:end]`` in a single scan; token positions
+        are relative to ``text``. ``pos`` and ``endpos`` arguments of
+        ``finditer`` are used instead of slicing - none of the rules
+        look behind the match or use ``^``, so the result is the same.
+        """
+        token_start = start
+        for match in self._rules_re.finditer(text, start, end):
+            match_start, match_end = match.span()
+            yield TextToken(chars=text[token_start:match_start],
+                            position=token_start,
+                            length=match_start - token_start)
+            token = self._rule_tokens[match.lastindex]
+            yield TextToken(chars=match.group() if token is None else token,
+                            position=match_start,
+                            length=match_end - match_start)
+            token_start = match_end
+
+        yield TextToken(chars=text[token_start:end],
+                        position=token_start,
+                        length=end - token_start)
+
+    def segment_words(self, text):
+        return [t for t in self._segment_words(text) if t.chars]
 
+    def tokenize(self, text):
+        return [t.chars for t in self.segment_words(text)]
+
+
+class DefaultTokenizer(WordTokenizer):
+    def segment_words(self, text):
+        tokens = super(DefaultTokenizer, self).segment_words(text)
+        # remove standalone commas and semicolons
+        # as they broke tag sets,
+        # e.g. PERSON->FUNCTION in case "PERSON, FUNCTION"
+
+        # but it has negative consequences, e.g.
+        # etalon:    [PER-B, PER-I, FUNC-B]
+        # predicted: [PER-B, PER-I, PER-I ]
+        # because we removed punctuation
+
+        # FIXME: remove as token, but save as feature left/right_punct:","
+        return [t for t in tokens if t.chars not in {',', ';'}]
+
+
+class ReferenceWordTokenizer(WordTokenizer):
+    """
+    The original implementation of :class:`WordTokenizer` which
+    tries all :attr:`~WordTokenizer.rules` one by one at every character.
+    It is quadratic on long texts; it is kept as a reference
+    implementation for tests and benchmarks.
+    """
     def _segment_words_nonquote(self, text):
         i = 0
         token_start = 0
@@ -191,27 +265,33 @@ class WordTokenizer(object):
                     break
             i += shift
 
-    def segment_words(self, text):
-        return [t for t in self._segment_words(text) if t.chars]
 
-    def tokenize(self, text):
-        return [t.chars for t in self.segment_words(text)]
-
-
-class DefaultTokenizer(WordTokenizer):
-    def segment_words(self, text):
-        tokens = super(DefaultTokenizer, self).segment_words(text)
-        # remove standalone commas and semicolons
-        # as they broke tag sets,
-        # e.g. PERSON->FUNCTION in case "PERSON, FUNCTION"
+def _overrides_nonquote(tokenizer):
+    """
+    Return True if ``_segment_words_nonquote`` of a tokenizer
+    is overridden by a subclass of :class:`WordTokenizer`.
+    """
+    method = type(tokenizer)._segment_words_nonquote
+    return (six.get_unbound_function(method) is not
+            six.get_unbound_function(WordTokenizer._segment_words_nonquote))
 
-        # but it has negative consequences, e.g.
-        # etalon:    [PER-B, PER-I, FUNC-B]
-        # predicted: [PER-B, PER-I, PER-I ]
-        # because we removed punctuation
 
-        # FIXME: remove as token, but save as feature left/right_punct:","
-        return [t for t in tokens if t.chars not in {',', ';'}]
+def _combine_rules(rules):
+    """
+    Combine tokenization rules into a single regex. Alternatives are
+    tried in order, so at each position the first matching rule wins,
+    like in a rule-by-rule loop. Return the regex and a
+    ``{group_index: token}`` dict: each rule is wrapped in a group,
+    and ``match.lastindex`` is the index of the matched rule's group.
+    """
+    patterns = []
+    rule_tokens = {}
+    group_index = 1
+    for regex, token in rules:
+        patterns.append('(%s)' % regex.pattern)
+        rule_tokens[group_index] = token
+        group_index += regex.groups + 1
+    return re.compile('|'.join(patterns), re.UNICODE), rule_tokens
 
 
 tokenize = DefaultTokenizer().segment_words
@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+"""
+:mod:`webstruct.token_corpus` allows to store tokenized documents
+on disk in a compact binary format and to use them for training
+without loading HTML, tokenizing it and keeping lxml trees in memory.
+
+A corpus is a directory with numpy ``.npy`` arrays: token texts,
+element tags and annotation tags are stored in a single string table
+and referenced by integer ids; token positions, text blocks and element
+tables (tags and parents) are stored as integer columns. Arrays are
+memory-mapped when the corpus is opened, so only documents which are
+being processed are loaded into memory.
+
+Example::
+
+    >>> X, y = html_tokenizer.tokenize(trees)  # doctest: +SKIP
+    >>> write_token_corpus('train-corpus', X, y)  # doctest: +SKIP
+
+    >>> corpus = TokenCorpus('train-corpus')  # doctest: +SKIP
+    >>> model.fit(corpus, corpus.tags)  # doctest: +SKIP
+
+Documents of :class:`TokenCorpus` are :class:`~.HtmlTokenBatch` instances,
+they can be passed to :class:`~.HtmlFeatureExtractor` directly.
+"""
+from __future__ import absolute_import
+import os
+import json
+from array import array
+
+import six
+import numpy as np
+from six.moves import zip, range
+
+from webstruct.html_tokenizer import HtmlTokenBatch
+
+
+FORMAT_VERSION = 1
+
+_META_FILE = 'meta.json'
+
+# array name -> dtype
+_ARRAYS = {
+    # string table
+    'string_data': np.uint8,
+    'string_offsets': np.int64,
+
+    # document table: offsets of the first token, block and element
+    # of each document (and total counts as the last items)
+    'doc_token_offsets': np.int64,
+    'doc_block_offsets': np.int64,
+    'doc_elem_offsets': np.int64,
+
+    # token columns
+    'token_strings': np.int32,
+    'token_positions': np.int32,
+    'token_lengths': np.int32,
+
+    # block columns; token and element indices are document-local
+    'block_starts': np.int32,
+    'block_elems': np.int32,
+    'block_is_tail': np.int8,
+
+    # element columns; parent indices are document-local
+    'elem_tag_strings': np.int32,
+    'elem_parents': np.int32,
+}
+
+_TAG_ARRAYS = {
+    'token_tags': np.int32,
+}
+
+
+class TokenCorpusWriter(object):
+    """
+    Writer for :class:`TokenCorpus` format. Add documents one by one
+    using :meth:`add` and call :meth:`close` to write the corpus
+    to ``path`` directory::
+
+        >>> with TokenCorpusWriter('train-corpus') as writer:  # doctest: +SKIP
+        ...     for tree in trees:
+        ...         html_tokens, tags = html_tokenizer.tokenize_single(tree)
+        ...         writer.add(html_tokens, tags)
+
+    Data is kept in memory in compact arrays until the corpus is written.
+    Either all documents or none of them should have tags.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._strings = {}
+        self._has_tags = None
+        self._arrays = {
+            'doc_token_offsets': array('l', [0]),
+            'doc_block_offsets': array('l', [0]),
+            'doc_elem_offsets': array('l', [0]),
+            'token_strings': array('i'),
+            'token_tags': array('i'),
+            'token_positions': array('i'),
+            'token_lengths': array('i'),
+            'block_starts': array('i'),
+            'block_elems': array('i'),
+            'block_is_tail': array('b'),
+            'elem_tag_strings': array('i'),
+            'elem_parents': array('i'),
+        }
+
+    def add(self, html_tokens, tags=None):
+        """
+        Add a document: a list of :class:`~.HtmlToken` instances
+        or :class:`~.HtmlTokenBatch`, and optionally a list of its tags.
+        """
+        if not isinstance(html_tokens, HtmlTokenBatch):
+            html_tokens = HtmlTokenBatch.from_html_tokens(html_tokens)
+        batch = html_tokens
+        has_tags = tags is not None
+        if self._has_tags is None:
+            self._has_tags = has_tags
+        elif self._has_tags != has_tags:
+            raise ValueError("either all documents or none of them "
+                             "should have tags")
+        if has_tags and len(tags) != len(batch):
+            raise ValueError("number of tags (%d) doesn't match number "
+                             "of tokens (%d)" % (len(tags), len(batch)))
+
+        arrays = self._arrays
+        arrays['token_strings'].extend(self._string_ids(batch.tokens))
+        if has_tags:
+            arrays['token_tags'].extend(self._string_ids(tags))
+        arrays['token_positions'].extend(batch.positions)
+        arrays['token_lengths'].extend(batch.lengths)
+
+        offsets = batch.block_offsets
+        for block_id in range(len(offsets) - 1):
+            start = offsets[block_id]
+            arrays['block_starts'].append(start)
+            if start < offsets[block_id + 1]:
+                arrays['block_elems'].append(batch.elem_ids[start])
+                arrays['block_is_tail'].append(batch.is_tail[start])
+            else:
+                arrays['block_elems'].append(-1)
+                arrays['block_is_tail'].append(0)
+
+        arrays['elem_tag_strings'].extend(self._string_ids(batch.elem_tags))
+        arrays['elem_parents'].extend(batch.elem_parents)
+
+        arrays['doc_token_offsets'].append(len(arrays['token_strings']))
+        arrays['doc_block_offsets'].append(len(arrays['block_starts']))
+        arrays['doc_elem_offsets'].append(len(arrays['elem_tag_strings']))
+
+    def close(self):
+        """ Write the corpus to disk """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        strings = sorted(self._strings, key=self._strings.get)
+        encoded = [s.encode('utf8') for s in strings]
+        string_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(s) for s in encoded], out=string_offsets[1:])
+        string_data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        self._save('string_data', string_data)
+        self._save('string_offsets', string_offsets)
+
+        names = dict(_ARRAYS, **_TAG_ARRAYS) if self._has_tags else _ARRAYS
+        for name, dtype in names.items():
+            if name in self._arrays:
+                data = np.asarray(self._arrays[name], dtype=dtype)
+                self._save(name, data)
+
+        meta = {
+            'format_version': FORMAT_VERSION,
+            'n_documents': len(self._arrays['doc_token_offsets']) - 1,
+            'n_tokens': len(self._arrays['token_strings']),
+            'has_tags': bool(self._has_tags),
+        }
+        with open(os.path.join(self.path, _META_FILE), 'w') as f:
+            json.dump(meta, f, indent=2, sort_keys=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def _string_ids(self, strings):
+        index = self._strings
+        return [index.setdefault(s, len(index)) for s in strings]
+
+    def _save(self, name, data):
+        np.save(os.path.join(self.path, name + '.npy'), data)
+
+
+def write_token_corpus(path, X, y=None):
+    """
+    Write documents ``X`` (lists of :class:`~.HtmlToken` instances
+    or :class:`~.HtmlTokenBatch` instances) and their tags ``y``
+    (if available) to ``path`` directory. ``X`` and ``y`` are
+    in the same format as :meth:`~.HtmlTokenizer.tokenize` returns.
+    """
+    with TokenCorpusWriter(path) as writer:
+        if y is None:
+            for html_tokens in X:
+                writer.add(html_tokens)
+        else:
+            for html_tokens, tags in zip(X, y):
+                writer.add(html_tokens, tags)
+
+
+class TokenCorpus(object):
+    """
+    A corpus written by :func:`write_token_corpus` or
+    :class:`TokenCorpusWriter`. It is a sequence of
+    :class:`~.HtmlTokenBatch` documents; tags of the documents
+    (if the corpus has them) are available as :attr:`tags` sequence.
+
+    Arrays are memory-mapped if ``mmap`` is True (default),
+    otherwise they are loaded into memory.
+
+    Indexing with an integer returns a document; indexing with a slice
+    returns a list of documents, so the corpus can be used with
+    scikit-learn cross-validation utilities.
+    """
+    def __init__(self, path, mmap=True):
+        self.path = path
+        with open(os.path.join(path, _META_FILE)) as f:
+            self.meta = json.load(f)
+        if self.meta['format_version'] != FORMAT_VERSION:
+            raise ValueError("unsupported token corpus format version: %s" %
+                             self.meta['format_version'])
+
+        names = list(_ARRAYS)
+        if self.meta['has_tags']:
+            names.extend(_TAG_ARRAYS)
+        mmap_mode = 'r' if mmap else None
+        self._arrays = {
+            name: np.load(os.path.join(path, name + '.npy'),
+                          mmap_mode=mmap_mode)
+            for name in names
+        }
+        self._strings = None
+        self.tags = _TokenCorpusTags(self) if self.meta['has_tags'] else None
+
+    @property
+    def strings(self):
+        """ A list of all distinct strings (tokens and tags) in the corpus """
+        if self._strings is None:
+            data = self._arrays['string_data'].tobytes()
+            offsets = self._arrays['string_offsets'].tolist()
+            self._strings = [
+                data[start:end].decode('utf8')
+                for start, end in zip(offsets, offsets[1:])
+            ]
+        return self._strings
+
+    def __len__(self):
+        return self.meta['n_documents']
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return self.get_document(self._check_index(index))
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.get_document(index)
+
+    def __repr__(self):
+        return "TokenCorpus(%r, documents=%d, tokens=%d)" % (
+            self.path, len(self), self.meta['n_tokens'])
+
+    def get_document(self, index):
+        """ Return :class:`~.HtmlTokenBatch` for a document """
+        arrays = self._arrays
+        strings = self.strings
+        t0, t1 = self._range('doc_token_offsets', index)
+        b0, b1 = self._range('doc_block_offsets', index)
+        e0, e1 = self._range('doc_elem_offsets', index)
+
+        block_offsets = np.append(arrays['block_starts'][b0:b1], t1 - t0)
+        block_sizes = np.diff(block_offsets)
+        block_ids = np.repeat(np.arange(b1 - b0, dtype=np.int32), block_sizes)
+        elem_ids = np.repeat(arrays['block_elems'][b0:b1], block_sizes)
+        is_tail = np.repeat(arrays['block_is_tail'][b0:b1], block_sizes)
+
+        return HtmlTokenBatch(
+            tokens=[strings[i] for i in arrays['token_strings'][t0:t1].tolist()],
+            block_ids=_to_array('i', block_ids),
+            elem_ids=_to_array('i', elem_ids),
+            is_tail=_to_array('b', is_tail),
+            positions=_to_array('i', arrays['token_positions'][t0:t1]),
+            lengths=_to_array('i', arrays['token_lengths'][t0:t1]),
+            block_offsets=_to_array('i', block_offsets),
+            elem_tags=[strings[i] for i in arrays['elem_tag_strings'][e0:e1].tolist()],
+            elem_parents=_to_array('i', arrays['elem_parents'][e0:e1]),
+        )
+
+    def get_tags(self, index):
+        """ Return a list of tags for a document """
+        if not self.meta['has_tags']:
+            raise ValueError("corpus doesn't have tags")
+        strings = self.strings
+        t0, t1 = self._range('doc_token_offsets', index)
+        return [strings[i] for i in self._arrays['token_tags'][t0:t1].tolist()]
+
+    def _range(self, name, index):
+        offsets = self._arrays[name]
+        return int(offsets[index]), int(offsets[index + 1])
+
+    def _check_index(self, index):
+        size = len(self)
+        if index < 0:
+            index += size
+        if not 0 <= index < size:
+            raise IndexError("document index out of range")
+        return index
+
+
+class _TokenCorpusTags(object):
+    """ A sequence of tag lists of :class:`TokenCorpus` documents """
+    def __init__(self, corpus):
+        self.corpus = corpus
+
+    def __len__(self):
+        return len(self.corpus)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return self.corpus.get_tags(self.corpus._check_index(index))
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.corpus.get_tags(index)
+
+
+def _to_array(typecode, values):
+    """ Convert a numpy array to array.array without Python-level loops """
+    res = array(typecode)
+    data = np.ascontiguousarray(values, dtype=_DTYPES[typecode]).tobytes()
+    if six.PY2:
+        res.fromstring(data)
+    else:
+        res.frombytes(data)
+    return res
+
+
+_DTYPES = {
+    'i': np.dtype('i%d' % array('i').itemsize),
+    'b': np.int8,
+}
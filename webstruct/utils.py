@@ -2,9 +2,15 @@
 from __future__ import absolute_import, print_function
 import re
 import subprocess
+import zlib
+import multiprocessing
+from array import array
 from functools import partial
 from itertools import chain
+
+import six
 from six.moves import range
+from six.moves.collections_abc import Mapping
 
 import tldextract
 import lxml.html
@@ -143,6 +149,121 @@ def run_command(args, verbose=True):
         print(re.sub(r'[\n\r]+$', '\n', out.decode()).rstrip())
 
 
+def effective_n_jobs(n_jobs):
+    """
+    Return the number of worker processes to use for ``n_jobs`` argument.
+    ``None`` means 1; negative values are counted from the number
+    of CPUs, like in joblib and scikit-learn (-1 means "all CPUs")::
+
+        >>> effective_n_jobs(None), effective_n_jobs(3)
+        (1, 3)
+        >>> effective_n_jobs(-1) == multiprocessing.cpu_count()
+        True
+    """
+    if n_jobs is None:
+        return 1
+    if n_jobs == 0:
+        raise ValueError("n_jobs == 0 has no meaning")
+    if n_jobs < 0:
+        return max(multiprocessing.cpu_count() + 1 + n_jobs, 1)
+    return n_jobs
+
+
+def map_parallel(func, iterable, n_jobs=1, chunksize=1):
+    """
+    Ordered ``map`` which runs ``func`` in ``n_jobs`` worker processes.
+    ``func`` must be picklable; it is sent to each worker once,
+    not with every task. Items are sent to workers in chunks of
+    ``chunksize`` items. Results are yielded in input order.
+
+    If ``n_jobs`` is 1 then ``func`` is called in the current process::
+
+        >>> list(map_parallel(abs, [-1, 2, -3]))
+        [1, 2, 3]
+        >>> list(map_parallel(abs, [-1, 2, -3], n_jobs=2))
+        [1, 2, 3]
+    """
+    n_jobs = effective_n_jobs(n_jobs)
+    if n_jobs == 1:
+        for item in iterable:
+            yield func(item)
+        return
+
+    pool = multiprocessing.Pool(n_jobs, initializer=_init_worker,
+                                initargs=(func,))
+    try:
+        for result in pool.imap(_call_worker, iterable, chunksize):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+_worker_func = None
+
+
+def _init_worker(func):
+    global _worker_func
+    _worker_func = func
+
+
+def _call_worker(item):
+    return _worker_func(item)
+
+
+class CountMinSketch(object):
+    """
+    Approximate counter which uses a fixed amount of memory
+    (``width * depth`` integers) regardless of the number of distinct
+    items. Items must have a stable ``repr``. Counts are never
+    underestimated; they may be overestimated when items collide::
+
+        >>> sketch = CountMinSketch(width=1000)
+        >>> sketch.update(['foo', 'bar', 'foo'])
+        >>> sketch.update({'bar': 2})
+        >>> sketch['foo'], sketch['bar'], sketch['baz']
+        (2, 3, 0)
+
+    The interface is a subset of :class:`collections.Counter` one.
+    """
+    def __init__(self, width, depth=4):
+        if width < 1 or depth < 1:
+            raise ValueError("width and depth must be positive")
+        self.width = width
+        self.depth = depth
+        self.table = array('l', [0]) * (width * depth)
+
+    def update(self, items):
+        """
+        Count ``items``: an iterable of items (each counted once
+        per occurrence) or a mapping ``{item: count}``.
+        """
+        table = self.table
+        if isinstance(items, Mapping):
+            items = six.iteritems(items)
+        else:
+            items = ((item, 1) for item in items)
+        for item, count in items:
+            for idx in self._indices(item):
+                table[idx] += count
+
+    def __getitem__(self, item):
+        table = self.table
+        return min(table[idx] for idx in self._indices(item))
+
+    def _indices(self, item):
+        # double hashing: row i uses (h1 + i * h2) % width
+        data = repr(item)
+        if not isinstance(data, bytes):
+            data = data.encode('utf8')
+        h1 = zlib.crc32(data) & 0xffffffff
+        h2 = zlib.crc32(data, h1) & 0xffffffff
+        width = self.width
+        return [row * width + (h1 + row * h2) % width
+                for row in range(self.depth)]
+
+
 def alphanum_key(s):
     """ Key func for sorting strings according to numerical value. """
     return [int(c) if c.isdigit() else c for c in re.split('([0-9]+)', s)]
@@ -156,15 +277,54 @@ class BestMatch(object):
     """
     Class for finding best non-overlapping matches in a sequence of tokens.
     Override :meth:`get_sorted_ranges` method to define which results are best.
+
+    ``known`` is a collection of known strings (e.g. a set or dict keys);
+    a match is a range of tokens which are a known string when joined
+    with spaces. If ``known`` supports prefix search (``marisa_trie``
+    tries and ``dawg`` DAWGs have ``iterkeys(prefix)`` method), matches
+    are found by extending token ranges while some known strings start
+    with them. Otherwise a token-level trie is built from ``known``.
+
+    Both require a pass over all ``known`` strings (to find
+    :attr:`max_length` and first tokens of multi-token strings, or
+    to build the trie); it is done on the first lookup, not when
+    :class:`BestMatch` is created, so creating it for a large
+    memory-mapped lexicon is instant. Changes to ``known`` after
+    the first lookup are not seen.
     """
     def __init__(self, known):
 
         self.known = known
-        if hasattr(known, 'iterkeys'):
-            keys_iter = known.iterkeys()
+        self._keys_with_prefix = _prefix_search_func(known)
+        self._max_length = None
+
+    @property
+    def max_length(self):
+        """ Maximum number of tokens in a known string """
+        if self._max_length is None:
+            self._build_index()
+        return self._max_length
+
+    def _build_index(self):
+        known = self.known
+        if self._keys_with_prefix is None:
+            self._trie = {}
+            keys_iter = known.iterkeys() if hasattr(known, 'iterkeys') else known
         else:
-            keys_iter = known
-        self.max_length = max(len(key.split()) for key in keys_iter)
+            self._trie = None
+            keys_iter = known.iterkeys()
+
+        # first tokens of known strings with several tokens
+        # (only needed for prefix search)
+        self._first_tokens = set()
+        max_length = 0
+        for key in keys_iter:
+            max_length = max(max_length, len(key.split()))
+            if self._trie is not None:
+                _trie_add(self._trie, key)
+            elif ' ' in key:
+                self._first_tokens.add(key.split(' ', 1)[0])
+        self._max_length = max_length
 
     def find_ranges(self, tokens):
         ranges = self._find_matches(tokens)
@@ -175,30 +335,134 @@ class BestMatch(object):
         raise NotImplementedError()
 
     def _find_matches(self, tokens):
-        # find all matching ranges
+        # find the longest matching range for each start position
+        if self.max_length < 1:
+            return []
+        if self._keys_with_prefix is not None:
+            return self._find_prefix_matches(tokens)
+        if any(' ' in token for token in tokens):
+            # the token trie doesn't know how to split such tokens
+            return self._find_joined_matches(tokens)
+        return self._find_trie_matches(tokens)
+
+    def _find_trie_matches(self, tokens):
         res = []
-        i = 0
-        while i < len(tokens):
-            max_length = min(self.max_length, max(len(tokens)-i, 0))
-            for length in range(max_length, 0, -1):
-                lookup = " ".join(tokens[i:i+length])
-                if lookup in self.known:
-                    res.append((i, length+i, lookup))
+        trie = self._trie
+        max_length = self._max_length
+        n_tokens = len(tokens)
+        for start in range(n_tokens):
+            node = trie
+            match_end = None
+            for end in range(start, min(n_tokens, start + max_length)):
+                node = node.get(tokens[end])
+                if node is None:
                     break
-            i += 1
+                if _TRIE_END in node:
+                    match_end = end + 1
+            if match_end is not None:
+                res.append((start, match_end, " ".join(tokens[start:match_end])))
         return res
 
-    def _remove_overlapping(self, ranges, tokens):
-        # remove overlapping sequences, keeping the best
+    def _find_prefix_matches(self, tokens):
         res = []
-        filled_indices = set()
-        for begin, end, lookup in self.get_sorted_ranges(ranges, tokens):
-            indices = set(range(begin, end))
-            if not indices & filled_indices:
-                res.append((begin, end, lookup))
-                filled_indices |= indices
+        known = self.known
+        keys_with_prefix = self._keys_with_prefix
+        first_tokens = self._first_tokens
+        max_length = self._max_length
+        n_tokens = len(tokens)
+        for start in range(n_tokens):
+            lookup = tokens[start]
+            if lookup not in first_tokens and ' ' not in lookup:
+                # only a single-token match is possible
+                if lookup in known:
+                    res.append((start, start + 1, lookup))
+                continue
+            end = start + 1
+            limit = min(n_tokens, start + max_length)
+            match = None
+            while True:
+                if lookup in known:
+                    match = (start, end, lookup)
+                if end >= limit or next(keys_with_prefix(lookup + " "), None) is None:
+                    break
+                lookup = lookup + " " + tokens[end]
+                end += 1
+            if match is not None:
+                res.append(match)
         return res
 
+    def _find_joined_matches(self, tokens):
+        return _find_joined_matches(self.known, self.max_length, tokens)
+
+    def _remove_overlapping(self, ranges, tokens):
+        # remove overlapping sequences, keeping the best
+        return _remove_overlapping(self.get_sorted_ranges(ranges, tokens),
+                                   len(tokens))
+
+    def __getstate__(self):
+        # prefix search function is a bound method of ``known``
+        state = self.__dict__.copy()
+        del state['_keys_with_prefix']
+        return state
+
+    def __setstate__(self, state):
+        if '_max_length' not in state:
+            # pickled by an older version: only ``known`` and
+            # ``max_length`` are stored; the index is rebuilt on first lookup
+            state = {'known': state['known'], '_max_length': None}
+        self.__dict__.update(state)
+        self._keys_with_prefix = _prefix_search_func(self.known)
+
+
+def _find_joined_matches(known, max_length, tokens):
+    # look up all token ranges, longest first
+    res = []
+    i = 0
+    while i < len(tokens):
+        length_limit = min(max_length, max(len(tokens)-i, 0))
+        for length in range(length_limit, 0, -1):
+            lookup = " ".join(tokens[i:i+length])
+            if lookup in known:
+                res.append((i, length+i, lookup))
+                break
+        i += 1
+    return res
+
+
+def _remove_overlapping(sorted_ranges, n_tokens):
+    # filled[i] is 1 if i-th token belongs to a kept range
+    res = []
+    filled = bytearray(n_tokens)
+    for begin, end, lookup in sorted_ranges:
+        if filled.find(b'\x01', begin, end) == -1:
+            res.append((begin, end, lookup))
+            filled[begin:end] = b'\x01' * (end - begin)
+    return res
+
+
+# marks trie nodes which end a known string
+_TRIE_END = None
+
+
+def _trie_add(trie, key):
+    node = trie
+    for part in key.split(' '):
+        node = node.setdefault(part, {})
+    node[_TRIE_END] = True
+
+
+def _prefix_search_func(known):
+    """
+    Return a function which returns an iterator over strings starting
+    with a prefix in ``known`` or None if ``known`` doesn't support
+    prefix search.
+    """
+    if isinstance(known, (dict, set, frozenset, list, tuple)):
+        return None
+    if not hasattr(known, 'iterkeys') or not hasattr(known, 'has_keys_with_prefix'):
+        return None
+    return known.iterkeys
+
 
 class LongestMatch(BestMatch):
     """
@@ -230,6 +494,133 @@ class LongestMatch(BestMatch):
         return sorted(ranges, key=lambda k: k[1]-k[0], reverse=True)
 
 
+class MultiLongestMatch(object):
+    """
+    Class for finding longest non-overlapping matches of several lexicons
+    in a sequence of tokens in a single pass. :meth:`find_ranges` returns
+    a list with results of :meth:`LongestMatch.find_ranges` for each lexicon:
+
+    >>> mlm = MultiLongestMatch([{'Las Vegas', 'USA'}, {'North Las Vegas', 'North'}])
+    >>> tokens = ["North", "Las", "Vegas", "USA"]
+    >>> for ranges in mlm.find_ranges(tokens):
+    ...     print(ranges)
+    [(1, 3, 'Las Vegas'), (3, 4, 'USA')]
+    [(0, 3, 'North Las Vegas')]
+
+    Strings of in-memory lexicons (sets, lists, dicts - keys are used)
+    are put into a single token-level trie, so a document is scanned
+    once regardless of the number of such lexicons. Lexicons which
+    support prefix search (``marisa_trie`` tries, ``dawg`` DAWGs)
+    are not copied to memory; they are matched one by one using
+    :class:`LongestMatch`.
+    """
+    def __init__(self, lexicons):
+        self.lexicons = list(lexicons)
+        self._matchers = dict(
+            (index, LongestMatch(known))
+            for index, known in enumerate(self.lexicons)
+            if _prefix_search_func(known) is not None
+        )
+        self._build()
+
+    @property
+    def max_lengths(self):
+        """ Maximum number of tokens in a string of each lexicon """
+        return [
+            self._matchers[index].max_length if index in self._matchers
+            else max_length
+            for index, max_length in enumerate(self._trie_max_lengths)
+        ]
+
+    @property
+    def max_length(self):
+        return max(self.max_lengths) if self.lexicons else 0
+
+    def _build(self):
+        # lexicons which support prefix search are indexed by
+        # their matchers on first lookup
+        self._trie = {}
+        self._trie_max_lengths = []
+        self._trie_max_length = 0
+        for index, known in enumerate(self.lexicons):
+            if index in self._matchers:
+                self._trie_max_lengths.append(0)
+                continue
+            keys_iter = known.iterkeys() if hasattr(known, 'iterkeys') else known
+            max_length = 0
+            for key in keys_iter:
+                max_length = max(max_length, len(key.split()))
+                node = self._trie
+                for part in key.split(' '):
+                    node = node.setdefault(part, {})
+                indices = node.get(_TRIE_END, ())
+                if index not in indices:
+                    node[_TRIE_END] = indices + (index,)
+            self._trie_max_lengths.append(max_length)
+            self._trie_max_length = max(self._trie_max_length, max_length)
+
+    def find_ranges(self, tokens):
+        if not self._trie_max_length:
+            all_ranges = [[] for _ in self.lexicons]
+        elif any(' ' in token for token in tokens):
+            # the token trie doesn't know how to split such tokens
+            all_ranges = [
+                _find_joined_matches(known, max_length, tokens)
+                if index not in self._matchers else []
+                for index, (known, max_length)
+                in enumerate(zip(self.lexicons, self._trie_max_lengths))
+            ]
+        else:
+            all_ranges = self._find_trie_matches(tokens)
+        return [
+            self._matchers[index].find_ranges(tokens)
+            if index in self._matchers else
+            sorted(_remove_overlapping(
+                sorted(ranges, key=lambda k: k[1]-k[0], reverse=True),
+                len(tokens)
+            ))
+            for index, ranges in enumerate(all_ranges)
+        ]
+
+    def _find_trie_matches(self, tokens):
+        # the longest matching range for each start position and lexicon
+        all_ranges = [[] for _ in self.lexicons]
+        trie = self._trie
+        max_lengths = self._trie_max_lengths
+        n_tokens = len(tokens)
+        for start in range(n_tokens):
+            node = trie
+            match_ends = None
+            for end in range(start, min(n_tokens, start + self._trie_max_length)):
+                node = node.get(tokens[end])
+                if node is None:
+                    break
+                indices = node.get(_TRIE_END)
+                if indices is None:
+                    continue
+                length = end + 1 - start
+                for index in indices:
+                    if length <= max_lengths[index]:
+                        if match_ends is None:
+                            match_ends = {}
+                        match_ends[index] = end + 1
+            if match_ends is not None:
+                for index, end in match_ends.items():
+                    all_ranges[index].append((start, end, " ".join(tokens[start:end])))
+        return all_ranges
+
+    def __getstate__(self):
+        # the trie is rebuilt when unpickled
+        dct = self.__dict__.copy()
+        del dct['_trie']
+        del dct['_trie_max_length']
+        return dct
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._build()
+
+
 def substrings(txt, min_length, max_length, pad=''):
     """
     >>> substrings("abc", 1, 100)
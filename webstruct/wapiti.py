@@ -8,9 +8,11 @@ of Wapiti_ models, templates and data files.
 """
 
 from __future__ import absolute_import
+import io
 import os
 import re
 import six
+import bisect
 import shlex
 import tempfile
 import copy
@@ -74,6 +76,134 @@ def create_wapiti_pipeline(model_filename=None,
     ])
 
 
+def skip_unused_features(pipeline):
+    """
+    Make the feature extractor of a trained pipeline created by
+    :func:`create_wapiti_pipeline` compute only features the model uses
+    (see :func:`get_used_features` and
+    :meth:`.HtmlFeatureExtractor.set_used_features`).
+    Predictions don't change, but feature functions which can't produce
+    used features are skipped. Refitting the pipeline removes
+    the restriction.
+    """
+    fe, crf = pipeline.steps[0][1], pipeline.steps[-1][1]
+    fe.set_used_features(get_used_features(crf, fe))
+    return pipeline
+
+
+def get_used_features(crf, fe=None):
+    """
+    Return a set of features (in :meth:`.HtmlFeatureExtractor.set_used_features`
+    format) used by a trained :class:`WapitiCRF` model.
+
+    With the default :class:`WapitiFeatureEncoder` Wapiti features are
+    created from columns, so the result contains names of all features
+    which have non-zero weights for some of their values in unigram
+    template features and names of all features which are used
+    in ``feature_template``. With :class:`WapitiObservationEncoder`
+    observations are converted back to feature names using
+    ``fe.feature_encoder`` vocabulary.
+    """
+    observations = read_used_observations(crf.modelfile.name)
+    encoder = crf.feature_encoder
+
+    if not getattr(encoder, 'uses_template', True):
+        feature_names = getattr(getattr(fe, 'feature_encoder', None),
+                                'feature_names_', None)
+        if feature_names is None:
+            raise ValueError("can't get names of encoded features")
+        used = set()
+        for obs in observations:
+            feature_id = obs[1:].partition('=')[0]
+            if obs.startswith('u') and feature_id.isdigit():
+                used.add(feature_names[int(feature_id)])
+        return used
+
+    names = set(encoder.feature_names_)
+    used = set()
+    for obs in observations:
+        # observations of unigram template lines: ufeat:<name>=<value>
+        if obs[1:6] == 'feat:':
+            name = obs[6:].partition('=')[0]
+            if name in names:
+                used.add(name)
+    for line in crf.feature_template.splitlines():
+        if _wapiti_line_is_comment(line):
+            continue
+        for m in WAPITI_MACRO_PATTERN.finditer(line):
+            column = m.group('column')
+            if column.isdigit():
+                column = encoder.feature_names_[int(column)]
+            used.add(column)
+    return used
+
+
+def read_used_observations(model_filename):
+    r"""
+    Return a set of observations which have non-zero weights
+    in a Wapiti model file::
+
+        >>> model = io.StringIO(u"#mdl#2#2\n#rdr#0/0/0\n"
+        ...                     u"#qrk#2\n1:O,\n5:B-PER,\n"
+        ...                     u"#qrk#3\n1:*,\n6:ufoo=1,\n6:ufoo=2,\n"
+        ...                     u"2=0x1p+0\n8=-0x1.8p-1\n")
+        >>> sorted(read_used_observations(model))
+        ['*', 'ufoo=2']
+
+    Weights of an observation are stored after weights of previous
+    observations: ``Y`` unigram weights for ``u`` observations,
+    ``Y * Y`` bigram weights for ``b`` observations and both
+    for ``*`` observations (``Y`` is the number of labels).
+    """
+    if isinstance(model_filename, six.string_types):
+        with io.open(model_filename, encoding='utf8') as f:
+            return read_used_observations(f)
+    lines = iter(model_filename)
+    if not next(lines).startswith('#mdl#'):
+        raise ValueError("not a Wapiti model file")
+    reader = next(lines)
+    n_patterns = int(reader[len('#rdr#'):].split('/')[0])
+    for _ in range(n_patterns):
+        next(lines)
+    n_labels = len(_read_wapiti_quark(lines))
+    observations = _read_wapiti_quark(lines)
+
+    indices = []
+    for line in lines:
+        index, sep, weight = line.strip().partition('=')
+        if sep and float.fromhex(weight) != 0:
+            indices.append(int(index))
+    indices.sort()
+
+    used = set()
+    offset = 0
+    for obs in observations:
+        size = 0
+        if obs[:1] in ('u', '*'):
+            size += n_labels
+        if obs[:1] in ('b', '*'):
+            size += n_labels * n_labels
+        pos = bisect.bisect_left(indices, offset)
+        if pos < len(indices) and indices[pos] < offset + size:
+            used.add(obs)
+        offset += size
+    return used
+
+
+def _read_wapiti_quark(lines):
+    """ Read a list of strings saved by Wapiti: "#qrk#N" and N strings """
+    header = next(lines)
+    if not header.startswith('#qrk#'):
+        raise ValueError("invalid Wapiti model file")
+    strings = []
+    for _ in range(int(header[len('#qrk#'):])):
+        # <length>:<string>,
+        line = next(lines).rstrip('\n')
+        length, _, value = line.partition(':')
+        strings.append(value[:int(length)])
+    return strings
+
+
 def merge_top_n(chains):
     """
     Take first (most probable) as base for resulting chain
@@ -223,11 +353,13 @@ class WapitiCRF(BaseSequenceClassifier):
                     _, out_dev = tempfile.mkstemp(dir=self.tempdir, suffix=".txt", prefix="wapiti-dev-data")
                     to_unlink.append(out_dev)
 
-            template_fn = self._create_wapiti_feature_template_file()
-            to_unlink.append(template_fn)
-
             # run wapiti training
-            args = ['train', '--pattern', template_fn] + self.train_args
+            args = ['train']
+            if getattr(self.feature_encoder, 'uses_template', True):
+                template_fn = self._create_wapiti_feature_template_file()
+                to_unlink.append(template_fn)
+                args += ['--pattern', template_fn]
+            args += self.train_args
             if dev_fn:
                 args += ['--devel', dev_fn]
             args += [train_fn, self.modelfile.name]
@@ -430,6 +562,57 @@ class WapitiFeatureEncoder(BaseEstimator, TransformerMixin):
 
 
 
+class WapitiObservationEncoder(BaseEstimator, TransformerMixin):
+    """
+    Feature encoder for :class:`WapitiCRF` which converts
+    :class:`~.EncodedDocument` instances (see
+    :mod:`webstruct.feature_encoding`) to Wapiti data file lines
+    with raw observations: a feature with id N becomes ``uN`` unigram
+    observation (``uN=value`` if its value is not 1), and each token
+    gets ``*`` observation for label unigram and bigram features::
+
+        >>> from webstruct.feature_encoding import FeatureVocabulary
+        >>> vocab = FeatureVocabulary().fit([[{'token': 'foo', 'upper': False}]])
+        >>> doc = vocab.transform_single([{'token': 'foo', 'upper': False}, {}])
+        >>> WapitiObservationEncoder().transform_single(doc)
+        ['* u0 u1=0.0', '*']
+
+    Wapiti is trained without a pattern file when this encoder is used,
+    so ``feature_template`` and ``unigrams_scope`` of :class:`WapitiCRF`
+    are ignored.
+    """
+    uses_template = False
+
+    def fit(self, X, y=None):
+        return self
+
+    def partial_fit(self, X, y=None):
+        return self
+
+    def transform_single(self, doc):
+        """
+        Transform an :class:`~.EncodedDocument` to a list
+        of Wapiti data file lines.
+        """
+        lines = []
+        for ids, values in doc:
+            observations = ['*']
+            for feature_id, value in zip(ids, values):
+                if value == 1:
+                    observations.append('u%d' % feature_id)
+                else:
+                    # repr keeps all significant digits, unlike %g
+                    observations.append('u%d=%r' % (feature_id, float(value)))
+            lines.append(' '.join(observations))
+        return lines
+
+    def transform(self, X):
+        return [self.transform_single(doc) for doc in X]
+
+    def reset(self):
+        pass
+
+
 WAPITI_MACRO_PATTERN = re.compile(r'''
     (?P<macro>%[xXtTmM])
     \[
@@ -95,16 +95,20 @@ def apply_wa_title(tree):
         if not titles:
             wa_title.drop_tree()
             return
-        title = titles[0]
-        head = title.getparent()
-        head.insert(head.index(title), wa_title)
-        title.drop_tree()
-        wa_title.tag = 'title'
-        for attr in wa_title.attrib:
-            wa_title.attrib.pop(attr)
+        _replace_title(titles[0], wa_title)
         return
 
 
+def _replace_title(title, wa_title):
+    """ Replace ``<title>`` element with a ``<wa-title>`` element """
+    head = title.getparent()
+    head.insert(head.index(title), wa_title)
+    title.drop_tree()
+    wa_title.tag = 'title'
+    for attr in wa_title.attrib:
+        wa_title.attrib.pop(attr)
+
+
 def _fix_sax_attributes(attrs):
     """ Fix sax startElement attributes for lxml < 3.1.2 """
     if LXML_VERSION >= (3, 1, 2):